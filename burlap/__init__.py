@@ -3,6 +3,11 @@ from __future__ import absolute_import
 
 import copy
 import os
+import json
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 import re
 import sys
 import types
@@ -14,13 +19,16 @@ from pprint import pprint
 
 try:
     from fabric.api import env
-    from fabric.tasks import WrappedCallableTask
+    from fabric.tasks import Task, WrappedCallableTask
     from fabric.utils import _AliasDict
     from fabric.api import hide, settings
     from fabric.decorators import task, runs_once
 
     import yaml
 
+    # Use the much faster libyaml parser when it's installed.
+    YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
     # Variables cached per-role. Must be after deepcopy.
     env._rc = type(env)()
 
@@ -74,15 +82,31 @@ __version__ = '.'.join(map(str, VERSION))
 
 burlap_populate_stack = int(os.environ.get('BURLAP_POPULATE_STACK', 1))
 no_load = int(os.environ.get('BURLAP_NO_LOAD', 0))
+eager_load = int(os.environ.get('BURLAP_EAGER_LOAD', 0))
+
+# Caches the names of the tasks and satchels in every submodule, so they can be listed without importing them.
+SATCHEL_INDEX_FN = os.path.join('.burlap', 'satchels.json')
+
+# Caches the parsed contents of every role settings file, so each is only parsed again after it changes.
+SETTINGS_CACHE_FN = os.path.join('.burlap', 'settings.pickle')
 
-def _get_environ_handler(name, d):
+# Parsed settings files, of the form {filename: (mtime, size, data)}, loaded from SETTINGS_CACHE_FN when first needed.
+_yaml_files = None
+
+_yaml_files_changed = False
+
+def _get_environ_handler(name, d=None):
     """
     Dynamically creates a Fabric task for each configuration role.
+
+    If no settings are given, they're loaded when the task is run.
     """
 
     def func(site=None, **kwargs):
         from fabric import state
 
+        config = load_yaml_settings(name) if d is None else d
+
         # We can't auto-set default_site, because that break tasks that have
         # to operate over multiple sites.
         # If a task requires a site, it can pull from default_site as needed.
@@ -115,7 +139,7 @@ def _get_environ_handler(name, d):
         env[common.ROLE] = os.environ[common.ROLE] = name
         if site:
             env[common.SITE] = os.environ[common.SITE] = site
-        env.update(d)
+        env.update(config)
 
         # Load host retriever.
         retriever = None
@@ -142,7 +166,7 @@ def _get_environ_handler(name, d):
         env[common.ROLE] = os.environ[common.ROLE] = name
         if site:
             env[common.SITE] = os.environ[common.SITE] = site
-        env.update(d)
+        env.update(config)
 
         # Dynamically retrieve hosts.
         if env.hosts_retriever:
@@ -167,6 +191,9 @@ def _get_environ_handler(name, d):
             elif env.host_string:
                 env.is_local = 'localhost' in env.host_string or '127.0.0.1' in env.host_string
 
+        # Import any lazily loaded satchels used by the role.
+        common.load_satchels((env.get('services') or []) + (env.get('satchels') or []))
+
         for cb in common.post_role_load_callbacks:
             cb()
 
@@ -206,11 +233,60 @@ def find_yaml_settings_fn(name, local=False, fn='settings.yaml'):
     if os.path.isfile(settings_fn):
         return settings_fn
 
+def load_yaml_file(fn):
+    """
+    Returns the parsed contents of a YAML file, reusing the contents parsed earlier if the file hasn't changed since.
+    """
+    global _yaml_files, _yaml_files_changed
+    if _yaml_files is None:
+        try:
+            with open(SETTINGS_CACHE_FN, 'rb') as fin:
+                _yaml_files = pickle.load(fin)
+        except Exception: # pylint: disable=broad-except
+            _yaml_files = {}
+    fn = os.path.abspath(fn)
+    st = os.stat(fn)
+    entry = _yaml_files.get(fn)
+    if entry and entry[:2] == (st.st_mtime, st.st_size):
+        data = entry[2]
+    else:
+        with open(fn) as fin:
+            data = yaml.load(fin, Loader=YamlLoader)
+        _yaml_files[fn] = (st.st_mtime, st.st_size, data)
+        _yaml_files_changed = True
+    # Callers merge settings into the returned data, so the cached copy must be protected.
+    return copy.deepcopy(data)
+
+def save_yaml_files():
+    """
+    Saves all parsed settings files to the disk cache, if any were parsed since it was loaded.
+    """
+    global _yaml_files_changed
+    if not _yaml_files_changed:
+        return
+    try:
+        if not os.path.isdir(os.path.dirname(SETTINGS_CACHE_FN)):
+            os.makedirs(os.path.dirname(SETTINGS_CACHE_FN))
+        with open(SETTINGS_CACHE_FN, 'wb') as fout:
+            pickle.dump(_yaml_files, fout, pickle.HIGHEST_PROTOCOL)
+        _yaml_files_changed = False
+    except (IOError, OSError, pickle.PicklingError) as e:
+        print('Unable to save settings cache: %s' % e, file=sys.stderr)
+
 def load_yaml_settings(name, priors=None, verbose=0):
+    """
+    Returns the settings for the given role, merged with those of the roles it inherits and the files it includes.
+    """
     verbose = int(verbose)
+    if priors is not None:
+        return _load_yaml_settings(name, priors, verbose)
+    try:
+        return _load_yaml_settings(name, set(), verbose)
+    finally:
+        save_yaml_files()
+
+def _load_yaml_settings(name, priors, verbose):
     config = type(env)()
-    if priors is None:
-        priors = set()
     if name in priors:
         return config
     priors.add(name)
@@ -221,15 +297,15 @@ def load_yaml_settings(name, priors=None, verbose=0):
         return config
     if verbose:
         print('Loading settings:', settings_fn)
-    config.update(yaml.safe_load(open(settings_fn)) or type(env)())
+    config.update(load_yaml_file(settings_fn) or type(env)())
 
     if 'inherits' in config:
         parent_name = config['inherits']
         del config['inherits']
-        parent_config = load_yaml_settings(
+        parent_config = _load_yaml_settings(
             parent_name,
-            priors=priors,
-            verbose=verbose)
+            priors,
+            verbose)
         parent_config.update(config)
         config = parent_config
 
@@ -242,7 +318,7 @@ def load_yaml_settings(name, priors=None, verbose=0):
         assert include_fn, 'Invalid include file: %s' % _include_fn
         if verbose:
             print('Loading include settings:', include_fn)
-        data = yaml.safe_load(open(include_fn))
+        data = load_yaml_file(include_fn)
         config.update(data)
 
     # Load local overrides.
@@ -250,7 +326,7 @@ def load_yaml_settings(name, priors=None, verbose=0):
     if settings_local_fn:
         if verbose:
             print('Loading local settings:', settings_local_fn)
-        data = yaml.safe_load(open(settings_local_fn)) or type(env)()
+        data = load_yaml_file(settings_local_fn) or type(env)()
         includes = data.pop('includes', [])
         config.update(data)
 
@@ -261,7 +337,7 @@ def load_yaml_settings(name, priors=None, verbose=0):
             assert include_fn, 'Invalid include file: %s' % _include_fn
             if verbose:
                 print('Loading include settings:', include_fn)
-            data = yaml.safe_load(open(include_fn))
+            data = load_yaml_file(include_fn)
             config.update(data)
 
     config['includes'] = load_includes
@@ -295,12 +371,7 @@ def populate_fabfile():
 
         export BURLAP_POPULATE_STACK=0
     """
-    stack = inspect.stack()
-    fab_frame = None
-    for frame_obj, script_fn, line, _, _, _ in stack:
-        if 'fabfile.py' in script_fn:
-            fab_frame = frame_obj
-            break
+    fab_frame = get_fabfile_frame()
     if not fab_frame:
         return
     try:
@@ -327,11 +398,148 @@ def populate_fabfile():
             locals_[_module_alias] = locals()[_module_alias]
 
     finally:
-        del stack
+        del fab_frame
+
+def get_fabfile_frame():
+    """
+    Returns the stack frame of the fabfile importing burlap, or None if burlap isn't being imported by a fabfile.
+    """
+    for frame_obj, script_fn, _, _, _, _ in inspect.stack():
+        if 'fabfile.py' in script_fn:
+            return frame_obj
+
+class LazyTask(Task):
+    """
+    A placeholder for a task in a submodule that hasn't been imported yet, which imports it the first time the task is used.
+    """
+
+    def __init__(self, namespace, module_name, name, doc=None, **kwargs):
+        super(LazyTask, self).__init__(name=name, **kwargs)
+        self.namespace = namespace
+        self.module_name = module_name
+        self.__doc__ = doc
+
+    def load(self):
+        """
+        Returns the actual task, importing its module if necessary.
+        """
+        common.import_satchel_module(self.module_name)
+        return getattr(sys.modules[self.namespace], self.name)
+
+    def __call__(self, *args, **kwargs):
+        return self.run(*args, **kwargs)
+
+    def run(self, *args, **kwargs):
+        return self.load().run(*args, **kwargs)
+
+    def __details__(self):
+        return self.load().__details__()
+
+    def __getattr__(self, k):
+        # Settings like hosts or parallel are only known once the actual task is loaded.
+        if k.startswith('__') or k in ('namespace', 'module_name'):
+            raise AttributeError(k)
+        return getattr(self.load(), k)
+
+class LazyModule(types.ModuleType):
+    """
+    A placeholder for a submodule that hasn't been imported yet, containing a LazyTask for each of its tasks.
+    """
+
+    def __init__(self, namespace, module_name, tasks):
+        # The index is loaded from JSON, so its names must be converted from unicode.
+        namespace = str(namespace)
+        module_name = str(module_name)
+        super(LazyModule, self).__init__(namespace)
+        self._module_name = module_name
+        for attr_name, data in tasks.items():
+            setattr(self, str(attr_name), LazyTask(
+                namespace=namespace,
+                module_name=module_name,
+                name=str(data['name']),
+                doc=data['doc'],
+                aliases=data['aliases'] and [str(_) for _ in data['aliases']],
+                default=data['default']))
+
+    def __getattr__(self, k):
+        if k.startswith('__'):
+            raise AttributeError(k)
+        common.import_satchel_module(self._module_name)
+        return getattr(sys.modules[self.__name__], k)
+
+def get_satchel_index_fingerprint():
+    """
+    Returns a value identifying the current version of all submodules, so a stale index can be detected.
+    """
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    files = []
+    for fn in sorted(os.listdir(package_dir)):
+        if fn.endswith('.py'):
+            st = os.stat(os.path.join(package_dir, fn))
+            files.append([fn, st.st_mtime, st.st_size])
+    return [__version__, package_dir, files]
+
+def load_satchel_index():
+    """
+    Returns the cached index of tasks and satchels, or None if it's missing or stale.
+    """
+    try:
+        with open(SATCHEL_INDEX_FN) as fin:
+            index = json.load(fin)
+    except (IOError, ValueError):
+        return
+    if index.get('fingerprint') != json.loads(json.dumps(get_satchel_index_fingerprint())):
+        return
+    return index
+
+def build_satchel_index(modules):
+    """
+    Returns an index of the tasks in each of the given imported submodules, and in the virtual modules
+    of the satchels they define, along with the module defining each satchel.
+    """
+    from fabric.main import is_task_object
+
+    satchels = {}
+    for name, satchel in common.all_satchels.items():
+        module_name = common.get_class_module_name(satchel)
+        if module_name.startswith('burlap.') and module_name[7:] in modules:
+            module_name = module_name[7:]
+        satchels[name] = module_name
+
+    namespaces = {}
+    for namespace, module_name in list(modules.items()) + [(_, satchels.get(_.upper())) for _ in common.post_import_modules]:
+        if not module_name or namespace not in sys.modules:
+            continue
+        module_vars = vars(sys.modules[namespace])
+        tasks = {}
+        for attr_name, obj in module_vars.items():
+            if '__all__' in module_vars and attr_name not in module_vars['__all__']:
+                continue
+            if is_task_object(obj):
+                tasks[attr_name] = dict(
+                    name=obj.name if obj.name != 'undefined' else attr_name,
+                    doc=obj.__doc__,
+                    aliases=obj.aliases,
+                    default=obj.is_default)
+        namespaces[namespace] = dict(module=module_name, tasks=tasks)
+
+    return dict(
+        fingerprint=get_satchel_index_fingerprint(),
+        satchels=satchels,
+        namespaces=namespaces)
+
+def save_satchel_index(index):
+    try:
+        if not os.path.isdir(os.path.dirname(SATCHEL_INDEX_FN)):
+            os.makedirs(os.path.dirname(SATCHEL_INDEX_FN))
+        with open(SATCHEL_INDEX_FN, 'w') as fout:
+            json.dump(index, fout)
+    except (IOError, OSError) as e:
+        print('Unable to save satchel index: %s' % e, file=sys.stderr)
 
 def load_role_handler(name):
-    _config = load_yaml_settings(name)
-    _f = _get_environ_handler(name, _config)
+    # Settings are only loaded once the role is used.
+    _f = _get_environ_handler(name)
     _f = WrappedCallableTask(_f, name=name)
     return _f
 
@@ -349,19 +557,36 @@ if common and not no_load:
             exec(_cmd) # pylint: disable=exec-used
             role_commands[_var_name] = _f
 
-    # Auto-import all sub-modules.
+    # Only import sub-modules when they're first used, if we're running from a fabfile,
+    # and the names of their tasks are already known.
+    satchel_index = None
+    under_fabfile = burlap_populate_stack and get_fabfile_frame() is not None
+    if under_fabfile and not eager_load:
+        satchel_index = load_satchel_index()
+
     sub_modules = {}
     sub_modules['common'] = common
     __all__ = []
-    for loader, module_name, is_pkg in  pkgutil.walk_packages(__path__):
-        if module_name in locals():
-            continue
-        if module_name.startswith('tests'):
-            continue
-        __all__.append(module_name)
-#         print('Importing: %s' % module_name, file=sys.stderr)
-        module = loader.find_module(module_name).load_module(module_name)
-        sub_modules[module_name] = module
+    if satchel_index:
+        for _namespace, _data in satchel_index['namespaces'].items():
+            __all__.append(str(_namespace))
+            sub_modules[_namespace] = LazyModule(_namespace, _data['module'], _data['tasks'])
+        for _name, _module_name in satchel_index['satchels'].items():
+            if _name not in common.all_satchels:
+                common.lazy_satchels[str(_name)] = str(_module_name)
+    else:
+        # Auto-import all sub-modules.
+        for loader, module_name, is_pkg in  pkgutil.walk_packages(__path__):
+            if module_name in locals():
+                continue
+            if module_name.startswith('tests'):
+                continue
+            __all__.append(module_name)
+#             print('Importing: %s' % module_name, file=sys.stderr)
+            module = loader.find_module(module_name).load_module(module_name)
+            sub_modules[module_name] = module
+        if under_fabfile:
+            save_satchel_index(build_satchel_index(dict((_, _) for _ in sub_modules if _ != 'common')))
 
     if burlap_populate_stack:
         populate_fabfile()
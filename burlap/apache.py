@@ -6,6 +6,7 @@ import sys
 from burlap import ServiceSatchel
 from burlap.constants import *
 from burlap.decorators import task
+from burlap.files import invalidate_stats
 
 class ApacheSatchel(ServiceSatchel):
 
@@ -350,31 +351,40 @@ class ApacheSatchel(ServiceSatchel):
 
         target_sites = self.genv.available_sites_by_host.get(hostname, None)
 
+        # Look up every site's user file with a single command, instead of once per user.
+        user_files = []
         for _site, site_data in self.iter_sites(site=site, setter=self.set_site_specifics):
-            if self.verbose:
-                print('~'*80, file=sys.stderr)
-                print('Site:', _site, file=sys.stderr)
-                print('env.apache_auth_basic:', r.env.auth_basic, file=sys.stderr)
-
-            # Only load site configurations that are allowed for this host.
-            if target_sites is not None:
-                assert isinstance(target_sites, (tuple, list))
-                if _site not in target_sites:
-                    continue
+            if r.env.auth_basic and (target_sites is None or _site in target_sites):
+                r.env.apache_site = _site
+                user_files.append(r.format(r.env.auth_basic_authuserfile))
 
-            if not r.env.auth_basic:
-                continue
+        with self.get_satchel('file').cached_stats(user_files):
+            for _site, site_data in self.iter_sites(site=site, setter=self.set_site_specifics):
+                if self.verbose:
+                    print('~'*80, file=sys.stderr)
+                    print('Site:', _site, file=sys.stderr)
+                    print('env.apache_auth_basic:', r.env.auth_basic, file=sys.stderr)
 
-            assert r.env.auth_basic_users, 'No apache auth users specified.'
-            for username, password in r.env.auth_basic_users:
-                r.env.auth_basic_username = username
-                r.env.auth_basic_password = password
-                r.env.apache_site = _site
-                r.env.fn = r.format(r.env.auth_basic_authuserfile)
-                if self.files.exists(r.env.fn):
-                    r.sudo('htpasswd -b {fn} {auth_basic_username} {auth_basic_password}')
-                else:
-                    r.sudo('htpasswd -b -c {fn} {auth_basic_username} {auth_basic_password}')
+                # Only load site configurations that are allowed for this host.
+                if target_sites is not None:
+                    assert isinstance(target_sites, (tuple, list))
+                    if _site not in target_sites:
+                        continue
+
+                if not r.env.auth_basic:
+                    continue
+
+                assert r.env.auth_basic_users, 'No apache auth users specified.'
+                for username, password in r.env.auth_basic_users:
+                    r.env.auth_basic_username = username
+                    r.env.auth_basic_password = password
+                    r.env.apache_site = _site
+                    r.env.fn = r.format(r.env.auth_basic_authuserfile)
+                    if self.file_exists(r.env.fn):
+                        r.sudo('htpasswd -b {fn} {auth_basic_username} {auth_basic_password}')
+                    else:
+                        r.sudo('htpasswd -b -c {fn} {auth_basic_username} {auth_basic_password}')
+                        invalidate_stats(r.env.fn)
 
     @task
     def install_auth_basic_user_file_all(self):
@@ -468,7 +478,7 @@ class ApacheSatchel(ServiceSatchel):
         manifest['media_timestamp'] = self.get_media_timestamp()
         return manifest
 
-    @task
+    @task(keys=['modevasive_*'])
     def configure_modevasive(self):
         """
         Installs the mod-evasive Apache module for combating DDOS attacks.
@@ -502,7 +512,7 @@ class ApacheSatchel(ServiceSatchel):
             if self.last_manifest.modevasive_enabled:
                 self.disable_mod('evasive')
 
-    @task
+    @task(keys=['modsecurity_*'])
     def configure_modsecurity(self):
         """
         Installs the mod-security Apache module.
@@ -541,7 +551,7 @@ class ApacheSatchel(ServiceSatchel):
         elif not self.env.modsecurity_enabled and self.last_manifest.modsecurity_enabled:
             self.disable_mod('modsecurity')
 
-    @task
+    @task(keys=['modrpaf_*'])
     def configure_modrpaf(self):
         """
         Installs the mod-rpaf Apache module.
@@ -560,10 +570,13 @@ class ApacheSatchel(ServiceSatchel):
     def configure_site(self, full=1, site=None, delete_old=0):
         """
         Configures Apache to host one or more websites.
+
+        Returns true if any configuration file was changed.
         """
         from burlap import service
 
         r = self.local_renderer
+        changed = False
 
         print('Configuring Apache...', file=sys.stderr)
 
@@ -580,6 +593,12 @@ class ApacheSatchel(ServiceSatchel):
             if r.env.delete_site_command:
                 r.sudo(r.env.delete_site_command)
 
+            # Look up the hashes of all the existing site configurations at once.
+            if r.env.sites_available:
+                self.prefetch_remote_hashes(
+                    [os.path.join(r.env.sites_available, _site+'.conf') for _site, _ in self.iter_sites(site=site)],
+                    use_sudo=True)
+
             for _site, site_data in self.iter_sites(site=site, setter=self.set_site_specifics):
                 r = self.local_renderer
 
@@ -600,7 +619,7 @@ class ApacheSatchel(ServiceSatchel):
                     fn = self.render_to_file(r.env.wsgi_template)
                     r.env.wsgi_dir = r.env.remote_dir = os.path.split(r.env.wsgi_scriptalias)[0]
                     r.sudo('mkdir -p {remote_dir}')
-                    r.put(local_path=fn, remote_path=r.env.wsgi_scriptalias, use_sudo=True)
+                    changed = r.put(local_path=fn, remote_path=r.env.wsgi_scriptalias, use_sudo=True).changed or changed
 
                 # Write site configuration.
                 r.pc('Writing site configuration for site %s...' % _site)
@@ -617,7 +636,7 @@ class ApacheSatchel(ServiceSatchel):
                     formatter=partial(r.format, ignored_variables=self.env.ignored_template_variables))
                 r.env.site_conf = _site+'.conf'
                 r.env.site_conf_fqfn = os.path.join(r.env.sites_available, r.env.site_conf)
-                r.put(local_path=fn, remote_path=r.env.site_conf_fqfn, use_sudo=True)
+                changed = r.put(local_path=fn, remote_path=r.env.site_conf_fqfn, use_sudo=True).changed or changed
 
                 self.enable_site(_site)
 
@@ -632,23 +651,48 @@ class ApacheSatchel(ServiceSatchel):
             # Write master Apache configuration file.
             if r.env.manage_httpd_conf:
                 fn = self.render_to_file('apache/apache_httpd.template.conf')
-                r.put(local_path=fn, remote_path=r.env.conf, use_sudo=True)
+                changed = r.put(local_path=fn, remote_path=r.env.conf, use_sudo=True).changed or changed
 
             # Write Apache listening ports configuration.
             if r.env.manage_ports_conf:
                 fn = self.render_to_file('apache/apache_ports.template.conf')
-                r.put(local_path=fn, remote_path=r.env.ports_path, use_sudo=True)
+                changed = r.put(local_path=fn, remote_path=r.env.ports_path, use_sudo=True).changed or changed
 
         r.sudo('chown -R {apache_web_user}:{apache_web_group} {apache_root}')
 
+        return changed
+
+    # Site configuration depends on nearly every setting, except those only used by the other deployers.
+    # The modsecurity_enabled flag is kept, since enabling modsecurity appends to the httpd configuration.
+    @task(keys=['*', '!modevasive_*', '!modrpaf_*', '!modsecurity_download_url', '!auth_basic_users', '!media_timestamp', '!sync_sets'])
+    def configure_sites(self):
+        """
+        Writes the configuration for all sites and the main Apache configuration files.
+        """
+        self.config_changed = self.configure_site(full=1, site=ALL)
+
+    @task(keys=['auth_basic*', 'available_sites*', 'specifics'])
+    def configure_auth_basic(self):
+        """
+        Writes the basic auth user file for all sites.
+        """
+        self.install_auth_basic_user_file(site=ALL)
+
+    @task(keys=['media_timestamp', 'sync_sets'])
+    def configure_media(self):
+        """
+        Uploads media changed since the last deployment.
+        """
+        self.sync_media()
+
     @task(precursors=['packager', 'user', 'hostname', 'ip'])
     def configure(self):
         self.configure_modevasive()
         self.configure_modsecurity()
         self.configure_modrpaf()
-        self.configure_site(full=1, site=ALL)
-        self.install_auth_basic_user_file(site=ALL)
-        self.sync_media()
+        self.configure_sites()
+        self.configure_auth_basic()
+        self.configure_media()
         #self.install_ssl(site=ALL)
 
 apache = ApacheSatchel()
@@ -15,6 +15,9 @@ class BuildBotSatchel(ServiceSatchel):
 
     name = 'buildbot'
 
+    # The manifest only reads settings and hashes local files.
+    concurrent_record_manifest = True
+
     @property
     def packager_system_packages(self):
         return {
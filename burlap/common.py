@@ -9,15 +9,22 @@ import copy
 import tempfile
 import time
 import importlib
+import pkgutil
 import warnings
 import glob
 import pipes
 import json
 import getpass
 import subprocess
-import uuid
 import inspect
+import threading
+import traceback
 from collections import namedtuple, OrderedDict
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from multiprocessing.pool import ThreadPool
 from pprint import pprint
 #from datetime import date
 
@@ -38,6 +45,7 @@ from fabric.api import (
 )
 from fabric.contrib import files
 from fabric import state
+from fabric.utils import _AttributeDict
 import fabric.api
 
 from .constants import *
@@ -57,6 +65,153 @@ OS = namedtuple('OS', ['type', 'distro', 'release'])
 
 ROLE_DIR = 'roles'
 
+# Marks keys that didn't exist before an overlay added them.
+_MISSING = object()
+
+def _get_env_bucket(k):
+    return k.split('_', 1)[0] if isinstance(k, basestring) else None
+
+class IndexedEnv(_AttributeDict):
+    """
+    A version of Fabric's env dictionary that indexes its keys by the text before their first underscore,
+    so the keys in a satchel's namespace can be found without scanning the entire environment.
+
+    The index is only built the first time a namespace is queried, and is then kept up to date on every change.
+    """
+
+    def _get_index(self):
+        index = self.__dict__.get('_prefix_index')
+        if index is None:
+            index = {}
+            for k in dict.__iter__(self):
+                index.setdefault(_get_env_bucket(k), set()).add(k)
+            self.__dict__['_prefix_index'] = index
+        return index
+
+    def _index_add(self, k):
+        index = self.__dict__.get('_prefix_index')
+        if index is not None:
+            index.setdefault(_get_env_bucket(k), set()).add(k)
+
+    def _index_discard(self, k):
+        index = self.__dict__.get('_prefix_index')
+        if index is not None:
+            index.get(_get_env_bucket(k), set()).discard(k)
+
+    def _journal(self, k):
+        """
+        Records the value a key had before the top overlay first changed it, so it can be restored when the overlay is popped.
+        """
+        layers = self.__dict__.get('_layers')
+        if not layers:
+            return
+        layer = layers[-1]
+        # Internally maintained variables, like hostname caches, outlive overlays.
+        if k in layer or (isinstance(k, six.string_types) and k.startswith('_')):
+            return
+        v = dict.get(self, k, _MISSING)
+        if isinstance(v, (list, dict, set)):
+            v = copy.deepcopy(v)
+        layer[k] = v
+
+    def __setitem__(self, k, v):
+        self._journal(k)
+        dict.__setitem__(self, k, v)
+        self._index_add(k)
+
+    def __delitem__(self, k):
+        self._journal(k)
+        dict.__delitem__(self, k)
+        self._index_discard(k)
+
+    def update(self, *args, **kwargs):
+        if self.__dict__.get('_prefix_index') is None and not self.__dict__.get('_layers'):
+            dict.update(self, *args, **kwargs)
+            return
+        for k, v in six.iteritems(dict(*args, **kwargs)):
+            self[k] = v
+
+    def setdefault(self, k, default=None):
+        if k not in self:
+            self._journal(k)
+        ret = dict.setdefault(self, k, default)
+        self._index_add(k)
+        return ret
+
+    def pop(self, k, *args):
+        if k in self:
+            self._journal(k)
+        ret = dict.pop(self, k, *args)
+        self._index_discard(k)
+        return ret
+
+    def popitem(self):
+        k, v = dict.popitem(self)
+        self._journal(k)
+        # The journal must record the value being removed, which is already gone from the dictionary.
+        layers = self.__dict__.get('_layers')
+        if layers and layers[-1].get(k, None) is _MISSING:
+            layers[-1][k] = copy.deepcopy(v) if isinstance(v, (list, dict, set)) else v
+        self._index_discard(k)
+        return k, v
+
+    def clear(self):
+        for k in list(dict.__iter__(self)):
+            self._journal(k)
+        dict.clear(self)
+        self.__dict__['_prefix_index'] = None
+
+    def push_layer(self):
+        """
+        Starts a copy-on-write overlay, so every change made until the matching pop_layer() call can be reverted.
+
+        Only the keys actually changed are recorded, and only their mutable values are copied.
+        Note, changes made to a mutable value in-place, without reassigning its key, are not reverted.
+
+        Returns the overlay, which must be passed to pop_layer().
+        """
+        layer = {}
+        self.__dict__.setdefault('_layers', []).append(layer)
+        return layer
+
+    def pop_layer(self, layer):
+        """
+        Reverts all changes made since the given overlay was pushed.
+
+        If overlays are popped out of order, the changes made under this overlay are instead
+        inherited by the overlay pushed after it, and are reverted when that overlay is popped.
+        """
+        layers = self.__dict__.get('_layers') or []
+        i = next((i for i, _layer in enumerate(layers) if _layer is layer), None)
+        if i is None:
+            return
+        del layers[i]
+        if i < len(layers):
+            layers[i].update(layer)
+            return
+        for k, v in six.iteritems(layer):
+            if v is _MISSING:
+                if dict.__contains__(self, k):
+                    dict.__delitem__(self, k)
+                    self._index_discard(k)
+            else:
+                dict.__setitem__(self, k, v)
+                self._index_add(k)
+
+    def iter_prefixed(self, prefix):
+        """
+        Returns a generator yielding a (name, value) tuple for each key of the form "<prefix>_<name>".
+        """
+        prefix = prefix + '_'
+        for k in list(self._get_index().get(_get_env_bucket(prefix), ())):
+            if k.startswith(prefix):
+                yield k[len(prefix):], dict.__getitem__(self, k)
+
+# Index Fabric's global env in-place, so existing references to it stay valid.
+# Note, _AttributeDict stores attributes as keys, so the class has to be set on the underlying object.
+if not isinstance(env, IndexedEnv):
+    object.__setattr__(env, '__class__', IndexedEnv)
+
 default_env = None
 
 def init_env():
@@ -136,6 +291,7 @@ state_variables = [
     'manifest_deployers',
     'manifest_deployers_befores',
     'manifest_deployers_takes_diff',
+    'manifest_deployers_keys',
 
     'post_callbacks',
     'post_role_load_callbacks',
@@ -167,6 +323,7 @@ manifest_deployers = type(env)() #{component:[func]}
 manifest_deployers_befores = type(env)() #{component:[pending components that must be run first]}
 #manifest_deployers_afters = type(env)() #{component:[pending components that must be run last]}
 manifest_deployers_takes_diff = type(env)()
+manifest_deployers_keys = type(env)() #{func:[manifest keys that trigger it]}
 
 post_callbacks = []
 post_role_load_callbacks = []
@@ -177,6 +334,10 @@ post_import_modules = set()
 
 all_satchels = {}
 
+# Satchels that haven't been imported yet, of the form {SATCHEL NAME: module name}.
+# Only populated when satchels are loaded lazily.
+lazy_satchels = {}
+
 SATCHEL_NAME_PATTERN = re.compile(r'^[a-z][a-z0-9]*$')
 
 # CMD_VAR_REGEX = re.compile(r'(?:^|[^{]+)(?<!\\){([^{}]+)}')
@@ -353,7 +514,7 @@ def str_to_component_list(s):
     lst = [clean_service_name(name) for name in str_to_list(s)]
     return lst
 
-def add_deployer(event, func, before=None, after=None, takes_diff=False):
+def add_deployer(event, func, before=None, after=None, takes_diff=False, keys=None):
 
     before = before or []
 
@@ -375,6 +536,9 @@ def add_deployer(event, func, before=None, after=None, takes_diff=False):
 
     manifest_deployers_takes_diff[func] = takes_diff
 
+    if keys is not None:
+        manifest_deployers_keys[func] = list(keys)
+
 def resolve_deployer(func_name):
 
     if '.' in func_name:
@@ -382,8 +546,9 @@ def resolve_deployer(func_name):
     else:
         mod_name = 'fabfile'
 
+    load_satchels([mod_name])
     if mod_name.upper() in all_satchels:
-        ret = all_satchels[mod_name.upper()].configure
+        ret = getattr(all_satchels[mod_name.upper()], func_name)
     else:
         ret = getattr(importlib.import_module(mod_name), func_name)
 
@@ -450,85 +615,147 @@ def is_local():
     env.is_local = env.host_string in ('localhost', '127.0.0.1')
     return env.is_local
 
-def format(s, lenv, genv, prefix=None, ignored_variables=None): # pylint: disable=redefined-builtin
-
-    verbose = get_verbose()
+# The maximum number of compiled format strings kept in memory.
+FORMAT_CACHE_SIZE = 2048
 
-    ignored_variables = set(ignored_variables or [])
+class CompiledFormat(object):
+    """
+    A format string parsed once, so it can be rendered repeatedly against different variables.
 
-    # Resolve all variable names.
-    cnt = 0
-    while 1:
-        cnt += 1
-        if cnt > 10:
-            raise Exception('Too many variables containing variables.')
+    Escaped variables (e.g. "{{var}}") and ignored variables are swapped for placeholders ahead of time,
+    so rendering is a single call to str.format() followed by restoring the placeholders.
+    """
 
-        var_names = CMD_VAR_REGEX.findall(s)
-#         if verbose:
-#             print('format.s:', s)
-#             print('found var_names:', var_names)
+    def __init__(self, s, prefix=None, ignored_variables=frozenset()):
 
-        if not var_names:
-            break
-        elif set(var_names).issubset(ignored_variables):
-            break
-
-        # Lookup local and global variable values.
-        var_values = {}
-        for var_name in var_names:
+        # The names to lookup, in order, along with the names they may be found under,
+        # of the form [(var_name, [(in_lenv, key)])].
+        self.lookups = []
+        for var_name in OrderedDict.fromkeys(CMD_VAR_REGEX.findall(s)):
             if var_name in ignored_variables:
                 continue
-            elif var_name in lenv:
-                # Find local variable name in local namespace.
-                if verbose:
-                    print('Found %s in lenv.' % var_name)
-                var_values[var_name] = lenv[var_name]
-            elif var_name in genv:
-                # Find prefixed variable in global namespace.
-                if verbose:
-                    print('Found %s in genv.' % var_name)
-                var_values[var_name] = genv[var_name]
-            elif prefix and prefix+'_'+var_name in genv:
-                # Find unprefixed variable in global namespace.
-                if verbose:
-                    print('Found prefix+%s in genv.' % var_name)
-                var_values[var_name] = genv[prefix+'_'+var_name]
-            elif prefix and var_name.startswith(prefix+'_') and var_name[len(prefix+'_'):] in lenv:
-                # Find prefixed variable in local namespace.
-                if verbose:
-                    print('Found prefix-%s in genv.' % var_name)
-                var_values[var_name] = lenv[var_name[len(prefix+'_'):]]
+            candidates = [(True, var_name), (False, var_name)]
+            if prefix:
+                candidates.append((False, prefix+'_'+var_name))
+                if var_name.startswith(prefix+'_'):
+                    candidates.append((True, var_name[len(prefix+'_'):]))
+            self.lookups.append((var_name, candidates))
+
+        # If there's nothing to lookup, then the string is rendered as-is.
+        self.is_static = not self.lookups
+        if self.is_static:
+            return
+
+        placeholders = []
+        template = s
+        for k in CMD_ESCAPED_VAR_REGEX.findall(s):
+            placeholder = '\x1a%i\x1a' % len(placeholders)
+            placeholders.append((k, placeholder))
+            template = template.replace(k, placeholder)
+        for _vn in ignored_variables:
+            # We can't escape ignored variables by setting their value to themselves, because the variables may use
+            # Python ":" operator, conflicting with curly brace string interpolation.
+            k = '{%s}' % _vn
+            placeholder = '\x1a%i\x1a' % len(placeholders)
+            placeholders.append((k, placeholder))
+            template = template.replace(k, placeholder)
+        self.template = template
+        self.placeholders = placeholders
+
+        # Determine if the rendered string can only contain new variables when they're introduced by a value,
+        # so rendering can usually stop after a single pass.
+        try:
+            dummy_values = dict((var_name, 'x') for var_name, _ in self.lookups)
+            self.is_final = CompiledFormat(self._render(dummy_values), prefix, ignored_variables).is_static
+        except Exception: # pylint: disable=broad-except
+            self.is_final = False
+
+    def lookup(self, lenv, genv, verbose=False):
+        """
+        Returns a dictionary of the values of all referenced variables.
+        """
+        var_values = {}
+        for var_name, candidates in self.lookups:
+            for in_lenv, key in candidates:
+                if in_lenv:
+                    if key in lenv:
+                        if verbose:
+                            print('Found %s in lenv.' % key)
+                        var_values[var_name] = lenv[key]
+                        break
+                elif key in genv:
+                    if verbose:
+                        print('Found %s in genv.' % key)
+                    var_values[var_name] = genv[key]
+                    break
             else:
                 raise Exception((
                     'Command references variable "%s" which is not found '
                     'in either the local or global namespace.') % var_name)
+        return var_values
 
-        escaped_var_names = dict(
-            (k, str(uuid.uuid4()))
-            for k in CMD_ESCAPED_VAR_REGEX.findall(s)
-        )
-        for k, v in escaped_var_names.iteritems():
-            s = s.replace(k, v)
+    def _render(self, var_values):
+        s = self.template.format(**var_values)
+        for k, placeholder in self.placeholders:
+            s = s.replace(placeholder, k)
+        return s
+
+    def render(self, lenv, genv, verbose=False):
+        """
+        Returns a tuple of the form (s, is_final), where is_final is true if the rendered string has no variables left to resolve.
+        """
+        var_values = self.lookup(lenv, genv, verbose=verbose)
+        is_final = self.is_final and all(isinstance(v, basestring) and '{' not in v for v in var_values.itervalues())
+        return self._render(var_values), is_final
+
+# Compiled format strings, of the form {(s, prefix, ignored_variables): CompiledFormat}.
+# The cache is split into two generations. Once the recent generation is full, it replaces the old generation,
+# which approximates evicting the least recently used half without having to track the order of every lookup.
+_format_cache = {}
+_format_cache_old = {}
+_format_cache_lock = threading.Lock()
+
+def clear_format_cache():
+    with _format_cache_lock:
+        _format_cache.clear()
+        _format_cache_old.clear()
+
+def compile_format(s, prefix=None, ignored_variables=None):
+    """
+    Returns the compiled form of a format string, from a bounded least-recently-used cache.
+    """
+    global _format_cache, _format_cache_old
+    key = (s, prefix, frozenset(ignored_variables) if ignored_variables else frozenset())
+    compiled = _format_cache.get(key)
+    if compiled is not None:
+        return compiled
+    with _format_cache_lock:
+        compiled = _format_cache_old.get(key) or CompiledFormat(s, prefix=key[1], ignored_variables=key[2])
+        if len(_format_cache) >= FORMAT_CACHE_SIZE//2:
+            _format_cache_old = _format_cache
+            _format_cache = {}
+        _format_cache[key] = compiled
+    return compiled
 
-#         if verbose:
-#             print('var_values:')
-#             pprint(var_values, indent=4)
+def format(s, lenv, genv, prefix=None, ignored_variables=None): # pylint: disable=redefined-builtin
 
-        for _vn in ignored_variables:
-            # We can't escape ignroed variables this way, because the variables may use Python ":" operator,
-            # conflicting with curly brace string interpolation.
-            #var_values[_vn] = '{%s}' % _vn
-            k = '{%s}' % _vn
-            v = str(uuid.uuid4())
-            escaped_var_names[k] = v
-            s = s.replace(k, v)
+    verbose = get_verbose()
+
+    # Resolve all variable names.
+    # Another pass is only needed when the values of the last pass contained variables.
+    cnt = 0
+    while 1:
+        cnt += 1
+        if cnt > 10:
+            raise Exception('Too many variables containing variables.')
 
-#         print('var_values:', var_values)
-#         print('s:', s)
-        s = s.format(**var_values)
+        compiled = compile_format(s, prefix=prefix, ignored_variables=ignored_variables)
+        if compiled.is_static:
+            break
 
-        for k, v in escaped_var_names.iteritems():
-            s = s.replace(v, k)
+        s, is_final = compiled.render(lenv, genv, verbose=verbose)
+        if is_final:
+            break
 
     s = s.replace(r'\{', '{')
     s = s.replace(r'\}', '}')
@@ -556,6 +783,9 @@ class Renderer(object):
         # If true, getattr will return None if no attribute set.
         self._set_default = set_default
 
+        # Wrapped satchel methods, of the form {attrname: (function, wrapped method)}.
+        self._wrapped = {}
+
     def format(self, s, **kwargs):
         return format(s, lenv=self.lenv, genv=self.genv, prefix=self.obj.name.lower(), **kwargs)
 
@@ -582,82 +812,109 @@ class Renderer(object):
     def __getitem__(self, key):
         return getattr(self, key)
 
-    def __getattr__(self, attrname):
+    # The wrappers applied to satchel methods, by method name prefix, checked in order.
+    # Note, install_config matches the put wrapper first, so it's not passed a formatter.
+    wrapper_prefixes = (
+        (('local', '_local', 'run', '_run', 'comment', 'pc', 'sudo'), '_wrap_command'),
+        (('reboot',), '_wrap_passthrough'),
+        (('put', 'install_script', 'install_config'), '_wrap_put'),
+        (('sed',), '_wrap_sed'),
+        (('append',), '_wrap_append'),
+    )
 
-        # Alias .env to the default type.
-        if attrname == 'env':
-            attrname = self.env_type
+    # The name of the wrapper used for each attribute name, of the form {attrname: wrapper name or None}.
+    _wrapper_names = {}
 
-        if attrname in ('obj', 'lenv', 'genv', 'env_type', '_set_default'):
-            return super(LocalRenderer, self).__getattribute__(attrname)
+    @classmethod
+    def get_wrapper_name(cls, attrname):
+        """
+        Returns the name of the method used to wrap the satchel method with the given name, or None if it's not wrapped.
+        """
+        try:
+            return cls._wrapper_names[attrname]
+        except KeyError:
+            pass
+        wrapper_name = None
+        for prefixes, _wrapper_name in cls.wrapper_prefixes:
+            if attrname.startswith(prefixes):
+                wrapper_name = _wrapper_name
+                break
+        cls._wrapper_names[attrname] = wrapper_name
+        return wrapper_name
+
+    def _wrap_command(self, func):
 
-        def wrap(func):
+        def _wrap(cmd, *args, **kwargs):
+            cmd = self.format(cmd)
+            return func(cmd, *args, **kwargs)
 
-            def _wrap(cmd, *args, **kwargs):
-                cmd = self.format(cmd)
-                return func(cmd, *args, **kwargs)
+        return _wrap
 
-            return _wrap
+    def _wrap_passthrough(self, func):
+        # For non-command functions, just pass-through.
 
-        def wrap2(func):
-            # For non-command functions, just pass-through.
+        def _wrap(*args, **kwargs):
+            return func(*args, **kwargs)
 
-            def _wrap(*args, **kwargs):
-                return func(*args, **kwargs)
+        return _wrap
 
-            return _wrap
+    def _wrap_put(self, func):
 
-        def put_wrap2(func):
-            # For non-command functions, just pass-through.
+        def _wrap(*args, **kwargs):
+            kwargs.setdefault('remote_path', kwargs.get('local_path'))
+            kwargs['local_path'] = self.format(kwargs['local_path'])
+            kwargs['remote_path'] = self.format(kwargs['remote_path'])
+            return func(*args, **kwargs)
 
-            def _wrap(*args, **kwargs):
-                kwargs.setdefault('remote_path', kwargs.get('local_path'))
-                kwargs['local_path'] = self.format(kwargs['local_path'])
-                kwargs['remote_path'] = self.format(kwargs['remote_path'])
-                return func(*args, **kwargs)
+        return _wrap
 
-            return _wrap
+    def _wrap_sed(self, func):
 
-        def install_config_wrap(func):
-            # For non-command functions, just pass-through.
+        def _wrap(*args, **kwargs):
+            kwargs['filename'] = self.format(kwargs['filename'])
+            return func(*args, **kwargs)
 
-            def _wrap(*args, **kwargs):
-                kwargs.setdefault('remote_path', kwargs.get('local_path'))
-                kwargs['local_path'] = self.format(kwargs['local_path'])
-                kwargs['remote_path'] = self.format(kwargs['remote_path'])
-                kwargs['formatter'] = self.format
-                return func(*args, **kwargs)
+        return _wrap
 
-            return _wrap
+    def _wrap_append(self, func):
 
-        def sed_wrap2(func):
-            # For non-command functions, just pass-through.
+        def _wrap(*args, **kwargs):
+            args = list(args)
 
-            def _wrap(*args, **kwargs):
+            if len(args) >= 1:
+                args[0] = self.format(args[0])
+            else:
+                kwargs['text'] = self.format(kwargs['text'])
+
+            if len(args) >= 2:
+                args[1] = self.format(args[1])
+            else:
                 kwargs['filename'] = self.format(kwargs['filename'])
-                return func(*args, **kwargs)
 
-            return _wrap
+            return func(*args, **kwargs)
 
-        def append_wrap2(func):
-            # For non-command functions, just pass-through.
+        return _wrap
 
-            def _wrap(*args, **kwargs):
-                args = list(args)
+    def _get_class_func(self, attrname):
+        func = getattr(type(self.obj), attrname, None)
+        return getattr(func, '__func__', func)
 
-                if len(args) >= 1:
-                    args[0] = self.format(args[0])
-                else:
-                    kwargs['text'] = self.format(kwargs['text'])
+    def __getattr__(self, attrname):
 
-                if len(args) >= 2:
-                    args[1] = self.format(args[1])
-                else:
-                    kwargs['filename'] = self.format(kwargs['filename'])
+        # Alias .env to the default type.
+        if attrname == 'env':
+            attrname = self.env_type
 
-                return func(*args, **kwargs)
+        if attrname in ('obj', 'lenv', 'genv', 'env_type', '_set_default', '_wrapped'):
+            return super(LocalRenderer, self).__getattribute__(attrname)
 
-            return _wrap
+        # Reuse the previously wrapped method, unless it has since been replaced on the satchel or its class.
+        try:
+            func, ret = self._wrapped[attrname]
+            if attrname not in self.obj.__dict__ and self._get_class_func(attrname) is func:
+                return ret
+        except KeyError:
+            pass
 
         try:
             ret = getattr(self.obj, attrname)
@@ -674,28 +931,14 @@ class Renderer(object):
 
         # If we're calling a command executor, wrap it so that it automatically formats
         # the command string using our preferred environment dictionary when called.
-        if attrname.startswith('local') \
-        or attrname.startswith('_local') \
-        or attrname.startswith('run') \
-        or attrname.startswith('run_or_local') \
-        or attrname.startswith('_run') \
-        or attrname.startswith('comment') \
-        or attrname.startswith('pc') \
-        or attrname.startswith('sudo') \
-        or attrname.startswith('sudo_or_local'):
-            ret = wrap(ret)
-        elif attrname.startswith('reboot'):
-            ret = wrap2(ret)
-        elif attrname.startswith('put') \
-        or attrname.startswith('install_script') \
-        or attrname.startswith('install_config'):
-            ret = put_wrap2(ret)
-        elif attrname.startswith('install_config'):
-            ret = install_config_wrap(ret)
-        elif attrname.startswith('sed'):
-            ret = sed_wrap2(ret)
-        elif attrname.startswith('append'):
-            ret = append_wrap2(ret)
+        method = ret
+        wrapper_name = self.get_wrapper_name(attrname)
+        if wrapper_name:
+            ret = getattr(self, wrapper_name)(ret)
+
+        # Only cache methods defined on the satchel's class, since properties and other attributes may change.
+        if isinstance(method, types.MethodType) and method.__self__ is self.obj and attrname not in self.obj.__dict__:
+            self._wrapped[attrname] = (method.__func__, ret)
 
         return ret
 
@@ -707,12 +950,58 @@ class GlobalRenderer(Renderer):
 
     env_type = 'genv'
 
+def import_satchel_module(module_name):
+    """
+    Imports one of burlap's submodules the same way they're imported when burlap is loaded,
+    so any satchels it defines are registered.
+
+    Settings already in the environment, like those loaded for the current role, take precedence over the defaults the satchels set.
+    """
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    env_before = dict(env)
+    post_callbacks_count = len(post_callbacks)
+    if '.' in module_name:
+        module = importlib.import_module(module_name)
+    else:
+        loader = pkgutil.get_importer(os.path.dirname(os.path.abspath(__file__))).find_module(module_name)
+        assert loader, 'Unknown module: %s' % module_name
+        module = loader.load_module(module_name)
+    for k, v in six.iteritems(env_before):
+        if env.get(k, _MISSING) is not v:
+            env[k] = v
+    for cb in post_callbacks[post_callbacks_count:]:
+        cb()
+    for name, _module_name in list(lazy_satchels.items()):
+        if _module_name == module_name:
+            del lazy_satchels[name]
+    return module
+
+def load_satchels(names):
+    """
+    Imports the given satchels, along with any satchels their deployers must be run after, if they're not already loaded.
+    """
+    pending = [_.strip().upper() for _ in names]
+    while pending:
+        name = pending.pop()
+        if name in all_satchels or name not in lazy_satchels:
+            continue
+        import_satchel_module(lazy_satchels[name])
+        pending.extend(manifest_deployers_befores.get(name, []))
+
 def get_satchel(name):
-    return all_satchels[name.strip().upper()]
+    name = name.strip().upper()
+    if name not in all_satchels:
+        load_satchels([name])
+    return all_satchels[name]
 
 def reset_all_satchels():
+    from burlap.trackers import clear_thumbprints
     for name, satchel in all_satchels.items():
         satchel.clear_caches()
+    clear_thumbprints()
+    clear_template_cache()
+    clear_remote_hashes()
 
 def is_callable(obj, name):
     """
@@ -736,6 +1025,14 @@ class Satchel(object):
         #OS: [package1, package2, ...],
     }
 
+    # If true, record_manifest() only reads the global environment, never modifying it (e.g. by iterating over sites),
+    # so it may run at the same time as other satchels' record_manifest(). Otherwise, it's run on its own.
+    concurrent_record_manifest = False
+
+    # If true, the satchel's deployment functions never modify the global environment (e.g. by iterating over sites),
+    # so they may run at the same time as other components in the same dependency level.
+    concurrent_deploy = False
+
     # These files will have their changes tracked.
     # You can specify dynamic values by using brace notation to refer to a satchel variable.
     # e.g. templates = ['{my_conf_template}']
@@ -781,6 +1078,7 @@ class Satchel(object):
             self.tasks += ('configure',)
 
         # Register select instance methods as Fabric tasks.
+        deployer_tasks = []
         for task_name in self.get_tasks():
             task = add_class_methods_as_module_level_functions_for_fabric(
                 instance=self,
@@ -791,17 +1089,34 @@ class Satchel(object):
 
             # If task is marked as a deployer, then add it to the deployer list.
             if hasattr(task.wrapped, 'is_deployer') or task_name == 'configure':
-                add_deployer(
-                    event=self.name,
-                    func=task.wrapped.fabric_name,#deployer.func,
-                    before=getattr(task.wrapped, 'deploy_before', []),#deployer.before,
-                    after=getattr(task.wrapped, 'deploy_after', []),#deployer.after,
-                    takes_diff=getattr(task.wrapped, 'deployer_takes_diff', False))
+                deployer_tasks.append((task_name, task))
 
             # Collect callbacks to run after basic satchel init is complete.
             if hasattr(task.wrapped, 'is_post_callback'):
                 post_callbacks.append(task.wrapped)
 
+        # If any deployer declares the manifest keys it depends on, then configure() only bundles those deployers
+        # for manual use, so it's no longer run on every change, but its precursors still apply to the satchel.
+        if any(getattr(task.wrapped, 'deploy_keys', None) is not None for _, task in deployer_tasks):
+            configure_before = []
+            for task_name, task in list(deployer_tasks):
+                if task_name == 'configure' and not getattr(task.wrapped, 'is_deployer', False):
+                    configure_before = getattr(task.wrapped, 'deploy_before', [])
+                    deployer_tasks.remove((task_name, task))
+            manifest_deployers_befores.setdefault(self.name.upper(), [])
+            manifest_deployers_befores[self.name.upper()].extend(map(str.upper, configure_before))
+
+        # Run deployers in the order they're defined in the satchel.
+        deployer_tasks.sort(key=lambda item: getattr(item[1].wrapped, 'deploy_order', 0))
+        for task_name, task in deployer_tasks:
+            add_deployer(
+                event=self.name,
+                func=task.wrapped.fabric_name,#deployer.func,
+                before=getattr(task.wrapped, 'deploy_before', []),#deployer.before,
+                after=getattr(task.wrapped, 'deploy_after', []),#deployer.after,
+                takes_diff=getattr(task.wrapped, 'deployer_takes_diff', False),
+                keys=getattr(task.wrapped, 'deploy_keys', None))
+
         deployers = self.get_deployers()
         if deployers:
             for deployer in deployers:
@@ -868,9 +1183,8 @@ class Satchel(object):
         Removes this satchel from global registeries.
         """
 
-        for k in env.keys():
-            if k.startswith(self.env_prefix):
-                del env[k]
+        for k, _ in list(env.iter_prefixed(self.name)):
+            del env[self.env_prefix + k]
 
         try:
             del all_satchels[self.name.upper()]
@@ -882,6 +1196,9 @@ class Satchel(object):
         except KeyError:
             pass
 
+        for func_name in manifest_deployers.get(self.name.upper(), []):
+            manifest_deployers_keys.pop(func_name, None)
+
         try:
             del manifest_deployers[self.name.upper()]
         except KeyError:
@@ -1062,9 +1379,8 @@ class Satchel(object):
         Returns a version of env filtered to only include the variables in our namespace.
         """
         _env = type(env)()
-        for _k, _v in six.iteritems(env):
-            if _k.startswith(self.name+'_'):
-                _env[_k[len(self.name)+1:]] = _v
+        for _k, _v in env.iter_prefixed(self.name):
+            _env[_k] = _v
         return _env
 
     @property
@@ -1137,6 +1453,9 @@ class Satchel(object):
     def upload_content(self, *args, **kwargs):
         return upload_content(*args, **kwargs)
 
+    def prefetch_remote_hashes(self, *args, **kwargs):
+        return prefetch_remote_hashes(*args, **kwargs)
+
     def find_template(self, template):
         return find_template(template)
 
@@ -1409,7 +1728,7 @@ class Satchel(object):
             manifest['_%s' % template] = get_file_hash(fqfn)
 
         for tracker in self.get_trackers():
-            manifest['_tracker_%s' % tracker.get_natural_key_hash()] = tracker.get_thumbprint()
+            manifest['_tracker_%s' % tracker.get_natural_key_hash()] = tracker.get_current_thumbprint()
 
         return manifest
 
@@ -1497,13 +1816,17 @@ class Service(object):
     # This command will be automatically run after every deployment.
     post_deploy_command = None #'restart'
 
+    # Whether the configuration applied during the current deployment changed anything, or None if none was applied.
+    # The post deployment command is skipped when it's false, so an unchanged service isn't needlessly restarted.
+    config_changed = None
+
     def __init__(self):
         assert self.name
         self.name = self.name.strip().lower()
         service_restarters[self.name.upper()] = [self.restart]
         service_stoppers[self.name.upper()] = [self.stop]
         if self.post_deploy_command:
-            service_post_deployers[self.name.upper()] = [getattr(self, self.post_deploy_command)]
+            service_post_deployers[self.name.upper()] = [self.run_post_deploy_command]
 
         super(Service, self).__init__()
 
@@ -1531,6 +1854,15 @@ class Service(object):
                 module_alias=self.name,
             )
 
+    def run_post_deploy_command(self):
+        """
+        Runs the post deployment command, unless the configuration applied during this deployment was unchanged.
+        """
+        if self.config_changed is False:
+            print('Skipping %s of service %s, since its configuration is unchanged.' % (self.post_deploy_command, self.name))
+            return
+        getattr(self, self.post_deploy_command)()
+
     @property
     def commands(self):
         # {action: {os_version_distro: command}}
@@ -1879,13 +2211,14 @@ def files_exists_or_dryrun(path, *args, **kwargs):
 #             print(cmd)
 #         return False
 #     else:
-    from fabric.contrib.files import exists
+    from burlap.files import file as _file
     # Expand ~, since this isn't done automatically.
     if path and path.startswith('~'):
         path = '/home/%s/%s' % (env.user, path[1:])
     if env.host_string in LOCALHOSTS:
         return os.path.exists(path)
-    return exists(path, *args, **kwargs)
+    use_sudo = kwargs.get('use_sudo', args[0] if args else False)
+    return _file.stat(path, use_sudo=use_sudo, strict=False) is not None
 
 def write_temp_file_or_dryrun(content, *args, **kwargs):
     """
@@ -1954,6 +2287,9 @@ def local_or_dryrun(*args, **kwargs):
         cmd = args[0]
         print('[%s@localhost] local: %s' % (getpass.getuser(), cmd))
     else:
+        from burlap.sshmux import add_control_options
+        if args:
+            args = [add_control_options(args[0])] + list(args[1:])
         return local(*args, **kwargs)
 
 def run_or_dryrun(*args, **kwargs):
@@ -2110,11 +2446,86 @@ def rsync_or_dryrun(**kwargs):
     if dryrun:
         print(cmd)
     else:
-        _local(cmd, **kwargs)
+        from burlap.sshmux import add_control_options
+        _local(add_control_options(cmd), **kwargs)
+
+# SHA-256 hashes of remote files fetched ahead of uploads, of the form {host_string: {remote_path: hash or None}}.
+# Each hash is only used by the next upload to its path, so commands run in between can't make it stale.
+_remote_hashes = {}
+
+class PutResult(list):
+    """
+    The remote paths written by a put, like the list Fabric's put() returns,
+    along with whether any remote file was changed.
+    """
+
+    def __init__(self, paths=(), changed=True):
+        super(PutResult, self).__init__(paths)
+        self.changed = changed
+        self.failed = getattr(paths, 'failed', [])
+        self.succeeded = not self.failed
+
+def clear_remote_hashes():
+    _remote_hashes.clear()
+
+def prefetch_remote_hashes(paths, use_sudo=False):
+    """
+    Looks up the hashes of the given files on the current host with a single command,
+    so the uploads that follow don't each need their own.
+
+    Returns a dictionary of the form {path: hash}, where missing or unreadable files hash to None.
+    """
+    paths = [_ for _ in paths if _]
+    host_hashes = _remote_hashes.setdefault(env.host_string, {})
+    if not paths or get_dryrun():
+        return {}
+    ret = {}
+    if env.host_string in LOCALHOSTS or env.is_local:
+        for path in paths:
+            ret[path] = get_file_hash(path, hash_name='sha256') if os.path.isfile(path) else None
+    else:
+        # sha256sum prints nothing for missing files, and escapes names containing backslashes or newlines,
+        # so those are simply treated as missing.
+        cmd = 'sha256sum %s 2>/dev/null; true' % ' '.join(pipes.quote(_) for _ in paths)
+        with settings(warn_only=True):
+            with hide('running', 'stdout', 'stderr', 'warnings'):
+                output = (_sudo if use_sudo else _run)(cmd)
+        found = {}
+        for line in (output or '').splitlines():
+            match = re.match(r'^([0-9a-f]{64}) [ \*](.+)$', line.strip('\r'))
+            if match:
+                found[match.group(2)] = match.group(1)
+        for path in paths:
+            ret[path] = found.get(path)
+    host_hashes.update(ret)
+    return ret
+
+def is_put_changed(local_path, remote_path, use_sudo=False):
+    """
+    Returns true if the given local file differs from the remote file it would be uploaded to, or if that can't be determined.
+    """
+    if not isinstance(local_path, six.string_types) or not os.path.isfile(local_path):
+        return True
+    if not remote_path or remote_path.endswith('/') or remote_path.startswith('~'):
+        return True
+    host_hashes = _remote_hashes.setdefault(env.host_string, {})
+    if remote_path in host_hashes:
+        remote_hash = host_hashes.pop(remote_path)
+    else:
+        remote_hash = prefetch_remote_hashes([remote_path], use_sudo=use_sudo).get(remote_path)
+        host_hashes.pop(remote_path, None)
+    return remote_hash != get_file_hash(local_path, hash_name='sha256')
 
 def put_or_dryrun(*args, **kwargs):
+    """
+    Uploads a file to the current host, unless the remote file already has the same contents.
+
+    Returns the remote paths, with a `changed` attribute that's false if the upload was skipped.
+    Pass check_changed=False to always upload.
+    """
     dryrun = get_dryrun(kwargs.get('dryrun'))
     use_sudo = kwargs.get('use_sudo', False)
+    check_changed = kwargs.pop('check_changed', True)
     real_remote_path = None
     if 'dryrun' in kwargs:
         del kwargs['dryrun']
@@ -2148,16 +2559,27 @@ def put_or_dryrun(*args, **kwargs):
             sudo_or_dryrun('mv %s %s' % (remote_path, real_remote_path))
             env.put_remote_path = real_remote_path
 
-        return [real_remote_path]
+        return PutResult([real_remote_path])
     else:
+        remote_path = kwargs.get('remote_path')
+        if check_changed and 'mode' not in kwargs and not kwargs.get('mirror_local_mode') \
+        and not is_put_changed(kwargs['local_path'], remote_path, use_sudo=use_sudo):
+            if get_verbose():
+                print('Skipping upload of unchanged %s.' % remote_path)
+            env.put_remote_path = remote_path
+            return PutResult([remote_path], changed=False)
+        from burlap.files import invalidate_stats
         if env.host_string in LOCALHOSTS or env.is_local:
             if use_sudo:
                 sudo_or_dryrun('cp {local_path} {remote_path}'.format(**kwargs))
             else:
                 local_or_dryrun('cp {local_path} {remote_path}'.format(**kwargs))
-            env.put_remote_path = kwargs.get('remote_path')
+            env.put_remote_path = remote_path
+            ret = PutResult([remote_path])
         else:
-            return _put(**kwargs)
+            ret = PutResult(_put(**kwargs))
+        invalidate_stats([_ for _ in list(ret) + [remote_path] if _])
+        return ret
 
 
 def get_or_dryrun(**kwargs):
@@ -2212,33 +2634,29 @@ def get_component_settings(prefixes=None):
     data = {}
     for name in prefixes:
         name = name.lower().strip()
-        for k in sorted(env):
-            if k.startswith('%s_' % name):
-                new_k = k[len(name)+1:]
-                data[new_k] = env[k]
+        for new_k, v in env.iter_prefixed(name):
+            data[new_k] = v
     return data
 
 
 def get_last_modified_timestamp(path, ignore=None):
     """
     Recursively finds the most recent timestamp in the given directory.
+
+    ignore = A list of file name patterns to exclude.
     """
+    from burlap.fsindex import get_last_modified_timestamp as _get_last_modified_timestamp
     ignore = ignore or []
     if not isinstance(path, basestring):
         return
-    ignore_str = ''
     if ignore:
         assert isinstance(ignore, (tuple, list))
-        ignore_str = ' '.join("! -name '%s'" % _ for _ in ignore)
-    cmd = 'find "'+path+'" ' + ignore_str + ' -type f -printf "%T@ %p\n" | sort -n | tail -1 | cut -f 1 -d " "'
-         #'find '+path+' -type f -printf "%T@ %p\n" | sort -n | tail -1 | cut -d " " -f1
-    ret = subprocess.check_output(cmd, shell=True)
+    ret = _get_last_modified_timestamp(path, ignore=ignore)
+    if ret is None:
+        return
     # Note, we round now to avoid rounding errors later on where some formatters
     # use different decimal contexts.
-    try:
-        ret = round(float(ret), 2)
-    except ValueError:
-        return
+    ret = round(float(ret), 2)
     return ret
 
 
@@ -2472,35 +2890,18 @@ def get_packager():
     """
     Returns the packager detected on the remote system.
     """
-
-    # TODO: remove once fabric stops using contextlib.nested.
-    # https://github.com/fabric/fabric/issues/1364
-    import warnings
-    warnings.filterwarnings("ignore", category=DeprecationWarning)
-
-    common_packager = get_rc('common_packager')
-    if common_packager:
-        return common_packager
-    #TODO:cache result by current env.host_string so we can handle multiple hosts with different OSes
-    with settings(warn_only=True):
-        with hide('running', 'stdout', 'stderr', 'warnings'):
-            ret = _run('cat /etc/fedora-release')
-            if ret.succeeded:
-                common_packager = YUM
-            else:
-                ret = _run('cat /etc/lsb-release')
-                if ret.succeeded:
-                    common_packager = APT
-                else:
-                    for pn in PACKAGERS:
-                        ret = _run('which %s' % pn)
-                        if ret.succeeded:
-                            common_packager = pn
-                            break
-    if not common_packager:
-        raise Exception('Unable to determine packager.')
-    set_rc('common_packager', common_packager)
-    return common_packager
+    from burlap.facts import get_facts
+
+    facts = get_facts()
+    if facts.get('fedora_release'):
+        return YUM
+    if facts.get('lsb_release_file'):
+        return APT
+    found = (facts.get('packagers') or '').split()
+    for pn in PACKAGERS:
+        if pn in found:
+            return pn
+    raise Exception('Unable to determine packager.')
 
 def _run_or_local(cmd):
     if env.host_string in LOCALHOSTS:
@@ -2513,45 +2914,53 @@ def get_os_version():
     """
     Returns a named tuple describing the operating system on the remote host.
     """
+    from burlap.facts import get_facts
 
-    # TODO: remove once fabric stops using contextlib.nested.
-    # https://github.com/fabric/fabric/issues/1364
-    import warnings
-    warnings.filterwarnings("ignore", category=DeprecationWarning)
-
-    common_os_version = get_rc('common_os_version')
-    if common_os_version:
-        return common_os_version
-    with settings(warn_only=True):
-        with hide('running', 'stdout', 'stderr', 'warnings'):
-
-            ret = _run_or_local('cat /etc/lsb-release')
-            if ret.succeeded:
-                return OS(
-                    type=LINUX,
-                    distro=UBUNTU,
-                    release=re.findall(r'DISTRIB_RELEASE=([0-9\.]+)', ret)[0])
-
-            ret = _run_or_local('cat /etc/debian_version')
-            if ret.succeeded:
-                return OS(
-                    type=LINUX,
-                    distro=DEBIAN,
-                    release=re.findall(r'([0-9\.]+)', ret)[0])
-
-            ret = _run_or_local('cat /etc/fedora-release')
-            if ret.succeeded:
-                return OS(
-                    type=LINUX,
-                    distro=FEDORA,
-                    release=re.findall(r'release ([0-9]+)', ret)[0])
-
-            raise Exception('Unable to determine OS version.')
+    facts = get_facts()
+
+    if facts.get('lsb_release_file'):
+        return OS(
+            type=LINUX,
+            distro=UBUNTU,
+            release=re.findall(r'DISTRIB_RELEASE=([0-9\.]+)', facts['lsb_release_file'])[0])
+
+    if facts.get('debian_version'):
+        return OS(
+            type=LINUX,
+            distro=DEBIAN,
+            release=re.findall(r'([0-9\.]+)', facts['debian_version'])[0])
+
+    if facts.get('fedora_release'):
+        return OS(
+            type=LINUX,
+            distro=FEDORA,
+            release=re.findall(r'release ([0-9]+)', facts['fedora_release'])[0])
+
+    raise Exception('Unable to determine OS version.')
+
+# Resolved template paths, of the form {(template dirs, template): path}.
+_template_paths = {}
+
+# Shared Jinja environments, of the form {(template dirs, data dir): jinja2.Environment}.
+_jinja_envs = {}
+
+def clear_template_cache():
+    """
+    Forgets all resolved template paths and compiled templates.
+    """
+    _template_paths.clear()
+    _jinja_envs.clear()
+
+def _find_template(template, template_dirs):
+    key = (template_dirs, template)
+    fqfn = _template_paths.get(key)
+    # Confirm the cached template still exists with a single stat, instead of one per template directory.
+    if fqfn and os.path.isfile(fqfn):
+        return fqfn
 
-def find_template(template):
     verbose = get_verbose()
     final_fqfn = None
-    for path in get_template_dirs():
+    for path in template_dirs:
         if verbose:
             print('Checking "%s" for "%s"...' % (path, template))
         fqfn = os.path.abspath(os.path.join(path, template))
@@ -2564,41 +2973,114 @@ def find_template(template):
     if not final_fqfn:
         raise IOError('Template not found: %s' % template)
 
+    _template_paths[key] = final_fqfn
     return final_fqfn
 
+def _get_template_dirs_key():
+    # Relative directories depend on the current working directory, so they're made absolute before they're used as a cache key.
+    return tuple(os.path.abspath(path) for path in get_template_dirs())
+
+def find_template(template):
+    return _find_template(template, _get_template_dirs_key())
+
 def get_template_contents(template):
     final_fqfn = find_template(template)
     return open(final_fqfn).read()
 
-def render_to_string(template, extra=None):
+def get_jinja_env():
     """
-    Renders the given template to a string.
+    Returns the Jinja environment that loads templates from the current role's template directories.
+
+    Compiled templates are kept in memory for the rest of the run, and in a bytecode cache under the burlap data directory,
+    if one is configured.
     """
-    #import django
-    #from django.template import Context, Template
-    #from django.template.loader import render_to_string
-    from jinja2 import Template
+    import jinja2
 
-    extra = extra or {}
+    template_dirs = _get_template_dirs_key()
+    data_dir = env.get('burlap_data_dir')
+    jinja_env = _jinja_envs.get((template_dirs, data_dir))
+    if jinja_env is not None:
+        return jinja_env
 
-    final_fqfn = find_template(template)
-    assert final_fqfn, 'Template not found: %s' % template
-    #from django.conf import settings
-#     try:
-#         settings.configure()
-#     except RuntimeError:
-#         pass
-
-    #content = render_to_string('template.txt', dict(env=env))
-    template_content = open(final_fqfn, 'r').read()
-    t = Template(template_content)
-    #c = Context(env)
-    if extra:
-        context = env.copy()
-        context.update(extra)
+    class TemplateLoader(jinja2.BaseLoader):
+        """
+        Loads templates from the first template directory containing them.
+        """
+
+        def get_source(self, environment, template):
+            try:
+                fqfn = _find_template(template, template_dirs)
+            except IOError:
+                raise jinja2.TemplateNotFound(template)
+            mtime = os.path.getmtime(fqfn)
+            with open(fqfn, 'rb') as fin:
+                source = fin.read().decode('utf-8')
+            return source, fqfn, lambda: os.path.isfile(fqfn) and os.path.getmtime(fqfn) == mtime
+
+    bytecode_cache = None
+    if data_dir:
+        cache_dir = os.path.abspath(os.path.join(data_dir, 'jinja'))
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+        except OSError:
+            # Templates are still cached in memory if the data directory isn't writable.
+            pass
+
+    jinja_env = _jinja_envs[(template_dirs, data_dir)] = jinja2.Environment(
+        loader=TemplateLoader(),
+        bytecode_cache=bytecode_cache,
+        auto_reload=True)
+    return jinja_env
+
+class TemplateContext(Mapping):
+    """
+    A read-only view of one or more dictionaries, searched in order, used to render templates without copying the environment.
+    """
+
+    def __init__(self, *maps):
+        self.maps = [_ for _ in maps if _]
+
+    def __getitem__(self, k):
+        for m in self.maps:
+            if k in m:
+                return m[k]
+        raise KeyError(k)
+
+    def __contains__(self, k):
+        return any(k in m for m in self.maps)
+
+    def __iter__(self):
+        seen = set()
+        for m in self.maps:
+            for k in m:
+                if k not in seen:
+                    seen.add(k)
+                    yield k
+
+    def __len__(self):
+        return len(set().union(*self.maps))
+
+def render_to_string(template, extra=None, lazy=False):
+    """
+    Renders the given template to a string.
+
+    If lazy is true, variables are looked up in the environment as the template needs them, instead of first copying the environment.
+    """
+    from jinja2.utils import concat
+
+    t = get_jinja_env().get_template(template)
+    if lazy:
+        context = t.new_context(TemplateContext(extra, env, t.globals), shared=True)
+        rendered_content = concat(t.root_render_func(context))
     else:
-        context = env
-    rendered_content = t.render(**context)
+        if extra:
+            context = env.copy()
+            context.update(extra)
+        else:
+            context = env
+        rendered_content = t.render(**context)
     rendered_content = rendered_content.replace('&quot;', '"')
     return rendered_content
 
@@ -2656,16 +3138,18 @@ def install_config(local_path=None, remote_path=None, render=True, extra=None, f
     """
     Returns a template to a remove file.
     If no filename given, a temporary filename will be generated and returned.
+    Returns true if the remote file was changed.
     """
     local_path = find_template(local_path)
     if render:
         extra = extra or {}
         local_path = render_to_file(template=local_path, extra=extra, formatter=formatter)
-    put_or_dryrun(local_path=local_path, remote_path=remote_path, use_sudo=True)
+    return put_or_dryrun(local_path=local_path, remote_path=remote_path, use_sudo=True).changed
 
 def install_script(*args, **kwargs):
-    install_config(*args, **kwargs)
+    changed = install_config(*args, **kwargs)
     sudo_or_dryrun('chmod +x %s' % env.put_remote_path)
+    return changed
 
 def write_to_file(content, fn=None, **kwargs):
 
@@ -2692,7 +3176,7 @@ def write_to_file(content, fn=None, **kwargs):
 def upload_content(content, fn, **kwargs):
     tmp_fn = write_to_file(content=content, **kwargs)
     use_sudo = kwargs.pop('use_sudo', env.host_string not in LOCALHOSTS)
-    put_or_dryrun(local_path=tmp_fn, remote_path=fn, use_sudo=use_sudo)
+    return put_or_dryrun(local_path=tmp_fn, remote_path=fn, use_sudo=use_sudo).changed
 
 def set_site(site):
     if site is None:
@@ -2724,7 +3208,6 @@ def iter_sites(sites=None, site=None, renderer=None, setter=None, no_secure=Fals
             sites = [(site, env.sites.get(site))]
 
     renderer = renderer #or render_remote_paths
-    env_default = save_env()
     for _site, site_data in sorted(sites):
         if no_secure and _site.endswith('_secure'):
             continue
@@ -2739,26 +3222,18 @@ def iter_sites(sites=None, site=None, renderer=None, setter=None, no_secure=Fals
                     print('Skipping site %s because not in among target sites.' % _site)
                 continue
 
-        env.update(env_default)
-        env.update(env.sites.get(_site, {}))
-        env.SITE = _site
-        if callable(renderer):
-            renderer()
-        if setter:
-            setter(_site)
-        yield _site, site_data
-
-    # Revert modified keys.
-    env.update(env_default)
-
-    # Remove keys that were added, not simply updated.
-    added_keys = set(env).difference(env_default)
-    for key in added_keys:
-        # Don't remove internally maintained variables, because these are used to cache hostnames
-        # used by iter_sites().
-        if key.startswith('_'):
-            continue
-        del env[key]
+        # Overlay the site's settings, reverting them, and any other changes, once the caller moves on.
+        layer = env.push_layer()
+        try:
+            env.update(env.sites.get(_site, {}))
+            env.SITE = _site
+            if callable(renderer):
+                renderer()
+            if setter:
+                setter(_site)
+            yield _site, site_data
+        finally:
+            env.pop_layer(layer)
 
 def pc(*args):
     """
@@ -2792,13 +3267,8 @@ def get_current_hostname():
         env.host_string = LOCALHOST_NAME
 
     if env.host_string not in env[key]:
-        with hide('running', 'stdout', 'stderr', 'warnings'):
-            print('Retrieving hostname...')
-            if env.host_string in LOCALHOSTS:
-                ret = _local('hostname', capture=True)
-            else:
-                ret = _run('hostname')
-        env[key][env.host_string] = str(ret).strip()
+        from burlap.facts import get_facts
+        env[key][env.host_string] = str(get_facts()['hostname']).strip()
 
     return env[key][env.host_string]
 
@@ -2830,6 +3300,55 @@ def topological_sort(source):
         pending = next_pending
         emitted = next_emitted
 
+def topological_levels(source):
+    """
+    Groups elements into dependency levels using Kahn's algorithm.
+
+    :arg source: list of ``(name, [list of dependancies])`` pairs
+    :returns: list of sorted lists of names, where each name only depends on names in earlier levels
+    """
+    if isinstance(source, dict):
+        source = source.items()
+    pending = dict((name, set(deps)) for name, deps in source)
+    levels = []
+    while pending:
+        level = sorted(name for name, deps in pending.items() if not deps)
+        if not level:
+            raise ValueError("cyclic or missing dependancy detected: %r" % (sorted(pending.items()),))
+        levels.append(level)
+        for name in level:
+            del pending[name]
+        for deps in pending.values():
+            deps.difference_update(level)
+    return levels
+
+def run_concurrently(funcs, max_workers=None):
+    """
+    Calls each function in a list of (key, func) pairs, using up to max_workers threads.
+
+    Returns a list of (key, result, error) tuples in the same order as the given functions,
+    where error is None if the function succeeded, or an (exception, traceback_string) tuple otherwise.
+    """
+
+    def _call(item):
+        key, func = item
+        try:
+            return key, func(), None
+        except (Exception, SystemExit) as e: # pylint: disable=broad-except
+            return key, None, (e, traceback.format_exc())
+
+    funcs = list(funcs)
+    max_workers = min(int(max_workers or 1), len(funcs))
+    if max_workers <= 1:
+        return [_call(item) for item in funcs]
+
+    pool = ThreadPool(max_workers)
+    try:
+        return pool.map(_call, funcs)
+    finally:
+        pool.close()
+        pool.join()
+
 def represent_ordereddict(dumper, data):
     value = []
 
@@ -2843,6 +3362,11 @@ def represent_ordereddict(dumper, data):
 
 yaml.add_representer(OrderedDict, represent_ordereddict)
 
+def represent_indexed_env(dumper, data):
+    return dumper.represent_mapping(u'tag:yaml.org,2002:map', data.items())
+
+yaml.add_representer(IndexedEnv, represent_indexed_env)
+
 #TODO:make thread/process safe with lockfile?
 
 shelf = Shelf()
@@ -1,7 +1,10 @@
 from __future__ import print_function
 
+import os
 import sys
 
+from fabric.api import settings, hide
+
 from burlap import ServiceSatchel
 from burlap.constants import *
 from burlap.decorators import task
@@ -35,6 +38,8 @@ class CronSatchel(ServiceSatchel):
         self.env.stdout_log_template = r'/var/log/cron-{SITE}-stdout.log'
         self.env.stderr_log_template = r'/var/log/cron-{SITE}-stderr.log'
         self.env.crontabs_selected = [] # [name]
+        # Where the rendered crontab is uploaded on the host before it's installed.
+        self.env.crontab_path = '/var/lib/burlap/crontab-{cron_user}'
 
         self.env.service_commands = {
             START:{
@@ -74,6 +79,8 @@ class CronSatchel(ServiceSatchel):
     def deploy(self, site=None):
         """
         Writes entire crontab to the host.
+
+        Returns true if the crontab was changed.
         """
         r = self.local_renderer
 
@@ -100,25 +107,35 @@ class CronSatchel(ServiceSatchel):
                     cron_crontabs.append(r.format(line))
 
         if not cron_crontabs:
-            return
+            return False
 
         cron_crontabs = self.env.crontab_headers + cron_crontabs
         cron_crontabs.append('\n')
         r.env.crontabs_rendered = '\n'.join(cron_crontabs)
         fn = self.write_to_file(content=r.env.crontabs_rendered)
         print('fn:', fn)
-        r.env.put_remote_path = r.put(local_path=fn)
-        if isinstance(r.env.put_remote_path, (tuple, list)):
-            r.env.put_remote_path = r.env.put_remote_path[0]
-        r.sudo('crontab -u {cron_user} {put_remote_path}')
+
+        # Compare against the installed crontab, so one that was edited or removed on the host,
+        # or never installed because a previous run failed, is always reinstalled.
+        with settings(hide('running', 'stdout'), warn_only=True):
+            installed = r.sudo('crontab -u {cron_user} -l 2>/dev/null || true')
+        if not self.dryrun and (installed or '').replace('\r\n', '\n').strip() == r.env.crontabs_rendered.strip():
+            return False
+
+        r.env.crontab_path = r.format(r.env.crontab_path)
+        r.sudo('mkdir -p %s' % os.path.dirname(r.env.crontab_path))
+        r.put(local_path=fn, remote_path=r.env.crontab_path, use_sudo=True, check_changed=False)
+        r.sudo('crontab -u {cron_user} {crontab_path}')
+        return True
 
     @task(precursors=['packager', 'user', 'tarball'])
     def configure(self, **kwargs):
         if self.env.enabled:
             kwargs['site'] = ALL
-            self.deploy(**kwargs)
+            changed = self.deploy(**kwargs)
             self.enable()
-            self.restart()
+            if changed:
+                self.restart()
         else:
             self.disable()
             self.stop()
@@ -1,21 +1,262 @@
 from __future__ import print_function
 
 import os
+import re
 import sys
+import time
+import signal
+import hashlib
+import threading
 import subprocess
+from pipes import quote
 from pprint import pprint
+from functools import partial
 
-from fabric.api import env#, runs_once
+from fabric.api import env, settings#, runs_once
 
 from burlap.constants import *
 from burlap import ServiceSatchel
-from burlap.common import LocalRenderer, pretty_bytes
+from burlap.common import LocalRenderer, pretty_bytes, run_concurrently
 from burlap.decorators import task, runs_once
 from burlap.common import str_to_callable
+from burlap.utils import get_file_hash
 
 CONNECTION_HANDLER_DJANGO = 'django'
 CONNECTION_HANDLER_CUSTOM = 'custom'
 
+# Compression tools usable by dumpload(), in order of preference.
+STREAM_COMPRESSORS = ('zstd', 'pigz', 'gzip')
+
+# Prefixes the checksum each end of a streamed transfer prints to stderr once it's done.
+STREAM_CHECKSUM_MARKER = 'burlap-checksum:'
+
+# Runs a pipeline containing a `tee {fifo}`, and afterwards prints the checksum of the data that passed through the tee.
+STREAM_SCRIPT = '''set -o pipefail
+d=$(mktemp -d)
+mkfifo $d/fifo
+sha256sum < $d/fifo > $d/sum &
+%(pipeline)s
+s=$?
+wait
+echo "%(marker)s $(cut -d' ' -f1 $d/sum)" >&2
+rm -Rf $d
+exit $s
+'''
+
+def get_manifest_fn(dump_fn):
+    """
+    Returns the path of the manifest listing the checksums of the files in the given snapshot.
+    """
+    return dump_fn.rstrip('/') + '.sha256'
+
+def iter_snapshot_files(dump_fn):
+    if os.path.isdir(dump_fn):
+        for dirpath, _, filenames in os.walk(dump_fn):
+            for filename in sorted(filenames):
+                yield os.path.join(dirpath, filename)
+    else:
+        yield dump_fn
+
+def get_snapshot_file_hash(fn):
+    with open(fn, 'rb') as fin:
+        return get_file_hash(fin, hash_name='sha256')
+
+def write_snapshot_manifest(dump_fn):
+    """
+    Writes the manifest of the local snapshot, in the format read by `sha256sum --check`.
+
+    Paths are relative to the snapshot's parent directory, so the manifest can be checked wherever the snapshot is copied to.
+    """
+    dump_fn = dump_fn.rstrip('/')
+    parent_dir = os.path.dirname(os.path.abspath(dump_fn))
+    with open(get_manifest_fn(dump_fn), 'w') as fout:
+        for fn in iter_snapshot_files(dump_fn):
+            fout.write('%s  %s\n' % (get_snapshot_file_hash(fn), os.path.relpath(os.path.abspath(fn), parent_dir)))
+
+def verify_snapshot_manifest(dump_fn):
+    """
+    Returns the paths of the files listed in the local snapshot's manifest that are missing or don't match their checksums.
+    """
+    parent_dir = os.path.dirname(os.path.abspath(dump_fn.rstrip('/')))
+    mismatches = []
+    with open(get_manifest_fn(dump_fn)) as fin:
+        for line in fin:
+            checksum, path = line.rstrip('\n').split('  ', 1)
+            fn = os.path.join(parent_dir, path)
+            if not os.path.isfile(fn) or get_snapshot_file_hash(fn) != checksum:
+                mismatches.append(path)
+    return mismatches
+
+# Matches the size of a whole database, or of a table's data and indexes, in the output of the size commands.
+SIZE_PATTERN = re.compile(r'^(\d+)$')
+TABLE_SIZE_PATTERN = re.compile(r'^(\S+)[|\t](\d+)[|\t](\d+)$')
+
+def parse_size(output):
+    """
+    Returns the database size printed by a size command, or 0 if there's none.
+    """
+    sizes = [int(_.group(1)) for _ in map(SIZE_PATTERN.match, (output or '').splitlines()) if _]
+    return sizes[-1] if sizes else 0
+
+def parse_table_sizes(output):
+    """
+    Returns a list of (table, data bytes, index bytes) for each table printed by a table sizes command, largest first.
+    """
+    tables = []
+    for line in (output or '').splitlines():
+        match = TABLE_SIZE_PATTERN.match(line.strip())
+        if match:
+            tables.append((match.group(1), int(match.group(2)), int(match.group(3))))
+    return sorted(tables, key=lambda t: t[1] + t[2], reverse=True)
+
+def run_on_host(host_string, command):
+    """
+    Runs a command on the given host and returns its output.
+
+    Unlike Fabric's run(), this doesn't depend on the current host, so it's safe to call for several hosts at once.
+    """
+    return subprocess.check_output(get_stream_args(host_string, command)).decode('utf-8')
+
+def fill_command(command, **values):
+    """
+    Replaces each {name} in the command with the given value, escaped for use inside double quotes.
+    """
+    for name, value in values.items():
+        for c in '\\"$`':
+            value = value.replace(c, '\\' + c)
+        command = command.replace('{%s}' % name, value)
+    return command
+
+def split_key_range(low, high, chunks, min_chunk_size=1):
+    """
+    Splits the integer key range [low, high] into up to the given number of chunks, each spanning at least min_chunk_size keys.
+
+    Returns a list of (start, end) pairs, where start is None for the first chunk and end is None for the last,
+    so keys outside the range, like rows inserted while they're copied, are still included.
+    """
+    chunks = max(1, min(int(chunks), (high - low + 1) // max(1, int(min_chunk_size))))
+    step = (high - low + 1) // chunks
+    bounds = [low + step * i for i in range(1, chunks)]
+    return list(zip([None] + bounds, bounds + [None]))
+
+def get_stream_script(pipeline):
+    return STREAM_SCRIPT % dict(pipeline=pipeline.replace('{fifo}', '$d/fifo'), marker=STREAM_CHECKSUM_MARKER)
+
+def get_stream_args(host_string, script):
+    """
+    Returns the arguments that run the given script on the given host, over ssh unless the host is localhost.
+    """
+    from fabric.network import normalize
+    from burlap.sshmux import get_control_options
+    if host_string in LOCALHOSTS:
+        return ['bash', '-c', script]
+    user, host, port = normalize(host_string)
+    args = ['ssh', '-o', 'StrictHostKeyChecking=no', '-p', str(port)]
+    key_filenames = env.key_filename or []
+    if not isinstance(key_filenames, (list, tuple)):
+        key_filenames = [key_filenames]
+    for key_filename in key_filenames:
+        args.extend(['-i', key_filename])
+    args.extend(get_control_options(host_string).split())
+    args.extend(['%s@%s' % (user, host), 'bash -c %s' % quote(script)])
+    return args
+
+def start_process_group():
+    """
+    Restores the default SIGPIPE handling Python disables, so a pipeline stops once its reader exits,
+    and starts a new process group, so the whole pipeline can be terminated.
+    """
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+    os.setsid()
+
+def relay_stream(src_args, dst_args, table_pattern=None, chunk_size=2**20, interval=1, label=None):
+    """
+    Pipes the stdout of the source command into the stdin of the destination command, printing the transfer rate,
+    and the tables seen in the source's stderr, as it goes.
+
+    Both commands must have been built from get_stream_script(), so the checksums of the data they sent and received
+    can be compared to the checksum of the data relayed. Raises an exception if either fails or the checksums differ.
+    """
+    src = subprocess.Popen(src_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=start_process_group)
+    dst = subprocess.Popen(dst_args, stdin=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=start_process_group)
+    table_pattern = table_pattern and re.compile(table_pattern)
+    checksums = {}
+    tables = []
+
+    def read_stderr(end, stream, pattern):
+        for line in iter(stream.readline, b''):
+            line = line.decode('utf-8', 'replace').rstrip()
+            if line.startswith(STREAM_CHECKSUM_MARKER):
+                checksums[end] = line.split()[-1]
+                continue
+            match = pattern and pattern.search(line)
+            if match:
+                tables.append(match.group(1))
+            else:
+                print('\n%s: %s' % (end, line), file=sys.stderr)
+
+    threads = [
+        threading.Thread(target=read_stderr, args=('source', src.stderr, table_pattern)),
+        threading.Thread(target=read_stderr, args=('destination', dst.stderr, None)),
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    def print_progress():
+        seconds = max(time.time() - start, 0.001)
+        sys.stderr.write('\r%s%.1f MB relayed, %.1f MB/s, %i tables%s\x1b[K' % (
+            '%s: ' % label if label else '', size/1e6, size/1e6/seconds, len(tables), ', %s' % tables[-1] if tables else ''))
+        sys.stderr.flush()
+
+    checksum = hashlib.sha256()
+    size = 0
+    start = last = time.time()
+    dst_exited = False
+    while True:
+        data = os.read(src.stdout.fileno(), chunk_size)
+        if not data:
+            break
+        try:
+            dst.stdin.write(data)
+        except IOError:
+            # The destination exited early, so its status explains why.
+            dst_exited = True
+            break
+        checksum.update(data)
+        size += len(data)
+        if time.time() - last >= interval:
+            last = time.time()
+            print_progress()
+    try:
+        dst.stdin.close()
+    except IOError:
+        pass
+    if dst_exited:
+        # Otherwise the source would block forever writing to a pipe nobody reads.
+        src.stdout.close()
+        try:
+            os.killpg(src.pid, signal.SIGTERM)
+        except OSError:
+            pass
+    src_status = src.wait()
+    dst_status = dst.wait()
+    for thread in threads:
+        thread.join()
+    print_progress()
+    sys.stderr.write('\n')
+
+    if dst_exited:
+        raise Exception('%sThe load exited early with status %s.' % ('%s: ' % label if label else '', dst_status))
+    if src_status:
+        raise Exception('%sThe dump failed with status %s.' % ('%s: ' % label if label else '', src_status))
+    if dst_status:
+        raise Exception('%sThe load failed with status %s.' % ('%s: ' % label if label else '', dst_status))
+    checksums['relay'] = checksum.hexdigest()
+    if len(set(checksums.values())) != 1 or len(checksums) != 3:
+        raise Exception('The stream was corrupted in transit. Checksums: %s' % checksums)
+    return dict(size=size, seconds=time.time() - start, tables=tables, checksum=checksums['relay'])
+
 class DatabaseSatchel(ServiceSatchel):
 
     name = 'db'
@@ -46,6 +287,52 @@ class DatabaseSatchel(ServiceSatchel):
         # This overrides the built-in load command.
         self.env.load_command = None
 
+        # If true, snapshots are already compressed, so rsync doesn't compress them again when they're transferred.
+        self.env.dump_compressed = True
+
+        # Writes the manifest of the snapshot {dump_fn} on the host it was dumped on, checked before it's loaded.
+        self.env.manifest_command = 'cd {dump_dir} && find {dump_name} -type f -print0 | xargs -0 sha256sum > {dump_name}.sha256'
+
+        # Checks the snapshot {remote_dump_fn} against its manifest on the host it's loaded on.
+        self.env.verify_manifest_command = 'cd {remote_dump_dir} && sha256sum --check --quiet {remote_dump_name}.sha256'
+
+        # The maximum rate, in KB/s, that snapshots are transferred at. If None, transfers are unlimited.
+        self.env.transfer_bwlimit = None
+
+        # The number of times an interrupted snapshot transfer is resumed before giving up.
+        self.env.transfer_retries = 3
+
+        # Prints the size of the database in bytes, including its indexes.
+        self.env.size_command = None
+
+        # Prints a "table|data bytes|index bytes" line for each table in the database.
+        self.env.table_sizes_command = None
+
+        # The path whose filesystem the database is loaded onto, checked by loadable().
+        self.env.free_space_path = '/'
+
+        # The estimated size of a compressed snapshot, as a fraction of the database's size, used by loadable()
+        # when there's no local snapshot to measure.
+        self.env.snapshot_size_ratio = 0.3
+
+        # The temporary space needed while a restore builds indexes, as a multiple of the largest index.
+        self.env.index_build_overhead = 1.0
+
+        # Run the SQL in {sql} against the database and print the results, one row per line, with columns separated by tabs or "|".
+        # The first connects as the database's user, to read from the source, and the second as root, to change the destination.
+        self.env.query_command = None
+        self.env.root_query_command = None
+
+        # Used by load_table() to write the rows of {table} matching {where} to stdout, and to load them from stdin.
+        self.env.table_dump_command = None
+        self.env.table_load_command = None
+
+        # The number of chunks load_table() splits each table into by its primary key, copied in parallel.
+        self.env.table_chunks = 4
+
+        # The smallest number of primary key values in a chunk. Smaller tables are copied in fewer chunks.
+        self.env.table_min_chunk_size = 100000
+
         # {hostname: {username: ?, password: ?}}
         self.env.root_logins = {}
 
@@ -54,6 +341,21 @@ class DatabaseSatchel(ServiceSatchel):
 
         self.env.default_db_name = 'default'
 
+        # Commands that write the database to stdout, and load it from stdin, used by dumpload().
+        self.env.dump_stream_command = None
+        self.env.load_stream_command = None
+
+        # A regular expression matching each table's name in the stderr of the dump stream command, used to report progress.
+        self.env.dump_stream_table_pattern = None
+
+        # The tool dumpload() compresses the stream with, one of zstd, pigz or gzip, or none to disable compression.
+        # If None, the best tool installed on both hosts is used.
+        self.env.stream_compression = None
+
+        # The compression level used by dumpload().
+        # If None, zstd adapts its level to the speed of the network, and pigz and gzip use their fastest level.
+        self.env.stream_compression_level = None
+
     def clear_caches(self):
         super(DatabaseSatchel, self).clear_caches()
         self._database_renderers.clear()
@@ -191,43 +493,133 @@ class DatabaseSatchel(ServiceSatchel):
     def configure(self, *args, **kwargs):
         super(DatabaseSatchel, self).configure(*args, **kwargs)
 
+    def get_free_space_command(self, path=None):
+        return "df -Pk %s | tail -n 1 | awk '{print $4}'" % quote(path or self.env.free_space_path)
+
     @task
-    def get_free_space(self):
+    def get_free_space(self, path=None):
         """
         Return free space in bytes.
         """
-        cmd = "df -k | grep -vE '^Filesystem|tmpfs|cdrom|none|udev|cgroup' | awk '{ print($1 \" \" $4 }'"
-        lines = [_ for _ in self.run(cmd).strip().split('\n') if _.startswith('/')]
-        assert len(lines) == 1, 'Ambiguous devices: %s' % str(lines)
-        device, kb = lines[0].split(' ')
-        free_space = int(kb) * 1024
+        free_space = parse_size(self.run(self.get_free_space_command(path))) * 1024
         self.vprint('free_space (bytes):', free_space)
         return free_space
 
     @task
-    def get_size(self):
-        """
-        Retrieves the size of the database in bytes.
-        """
-        #TODO:remove django hardcoding
-#         dj = self.get_satchel('dj')
-#         dj.set_db(site=env.SITE, role=env.ROLE)
-#         r = self.local_renderer
-#         if 'postgres' in self.genv.db_engine or 'postgis' in self.genv.db_engine:
-#             output = r.run('psql --user=%(db_postgresql_postgres_user)s --tuples-only -c "SELECT pg_database_size(\'%(db_name)s\');"')
-#             output = self.run(cmd)
-#             output = int(output.strip().split('\n')[-1].strip())
-#             self.vprint('database size (bytes):', output)
-#             return output
-#         else:
+    def get_size(self, name=None, site=None, tables=0):
+        """
+        Retrieves the size of the database in bytes, including its indexes.
+
+        If tables=1, the size of each table's data and indexes is also printed.
+        """
+        r = self.database_renderer(name=name, site=site)
+        assert r.env.size_command, 'No size command is defined.'
+        size = parse_size(r.run(r.env.size_command))
+        if int(tables):
+            for table, data_bytes, index_bytes in parse_table_sizes(r.run(r.env.table_sizes_command)):
+                print('%s: %.02f %s data, %.02f %s indexes' % ((table,) + pretty_bytes(data_bytes) + pretty_bytes(index_bytes)))
+        self.vprint('database size (bytes):', size)
+        return size
+
+    def get_table_key_sql(self, table):
+        """
+        Returns the SQL printing the name and type of each column in the table's primary key.
+        """
+        raise NotImplementedError
+
+    def get_table_key_range(self, query, table):
+        """
+        Returns the table's primary key column, and its smallest and largest values, or None if the table can't be split into chunks,
+        because it's empty or doesn't have a single integer primary key.
+        """
+        columns = [re.split(r'[|\t]', _) for _ in query(self.get_table_key_sql(table)).splitlines() if _.strip()]
+        if len(columns) != 1 or len(columns[0]) != 2 or 'int' not in columns[0][1].lower():
+            return
+        column = columns[0][0]
+        values = re.split(r'[|\t]', query('SELECT MIN(%s), MAX(%s) FROM %s' % (column, column, table)).strip().splitlines()[-1])
+        if not all(_.strip().lstrip('-').isdigit() for _ in values):
+            return
+        return column, int(values[0]), int(values[1])
+
+    def prepare_table_load(self, query, table):
+        """
+        Empties the table on the destination and disables its indexes, so its rows are loaded faster.
+
+        Returns a value passed to finish_table_load().
+        """
+        raise NotImplementedError
+
+    def finish_table_load(self, query, table, prepared):
+        """
+        Rebuilds the indexes disabled by prepare_table_load().
+        """
         raise NotImplementedError
 
     @task
-    def load_table(self, table_name, src, dst='localhost', name=None, site=None):
+    def load_table(self, table_name, src, dst='localhost', name=None, site=None, chunks=None):
         """
         Directly transfers a table between two databases.
+
+        The rows are streamed from the first host of the source role into the first host of the destination role,
+        through localhost, like dumpload(). The destination table is emptied first, and its indexes are rebuilt once it's loaded.
+        Tables with a single integer primary key are copied in parallel chunks of key values.
+
+        The table isn't loaded atomically. If a chunk fails, the rows of the other chunks are kept and the table is left
+        partly loaded, its indexes are still rebuilt, and the failure is raised once the table is finished.
+
+        Several tables can be given, separated by spaces.
         """
-        raise NotImplementedError
+        tables = table_name.split() if isinstance(table_name, basestring) else list(table_name)
+
+        src_host, src_r = self.get_role_database(src, name=name, site=site)
+        assert src_r.env.table_dump_command, 'No table dump command is defined.'
+        src_command = src_r.format(src_r.env.table_dump_command, ignored_variables=['table', 'where'])
+        src_query = partial(self.run_query, src_host, src_r.format(src_r.env.query_command, ignored_variables=['sql']))
+
+        dst_host, dst_r = self.get_role_database(dst, name=name, site=site)
+        assert dst_r.env.table_load_command, 'No table load command is defined.'
+        dst_command = dst_r.format(dst_r.env.table_load_command, ignored_variables=['table', 'where'])
+        dst_query = partial(self.run_query, dst_host, dst_r.format(dst_r.env.root_query_command, ignored_variables=['sql']))
+
+        compress, decompress = self.get_stream_compression(dst_r, src_host, dst_host)
+        chunks = int(chunks or dst_r.env.table_chunks or 1)
+
+        for table in tables:
+            if self.dryrun:
+                print('[%s] %s | %s' % (src_host, fill_command(src_command, table=table, where='1=1'), compress))
+                print('[%s] %s | %s' % (dst_host, decompress, fill_command(dst_command, table=table)))
+                continue
+
+            key_range = self.get_table_key_range(src_query, table) if chunks > 1 else None
+            wheres = ['1=1']
+            if key_range:
+                column, low, high = key_range
+                wheres = [' AND '.join(
+                    ([] if start is None else ['%s >= %i' % (column, start)]) + ([] if end is None else ['%s < %i' % (column, end)])
+                ) or '1=1' for start, end in split_key_range(low, high, chunks, dst_r.env.table_min_chunk_size)]
+
+            dst_r.pc('Copying table %s in %i chunks.' % (table, len(wheres)))
+            prepared = self.prepare_table_load(dst_query, table)
+            try:
+                funcs = []
+                for i, where in enumerate(wheres):
+                    src_args = get_stream_args(src_host, get_stream_script('%s | %s | tee {fifo}' % (
+                        fill_command(src_command, table=table, where=where), compress)))
+                    dst_args = get_stream_args(dst_host, get_stream_script('tee {fifo} | %s | %s' % (
+                        decompress, fill_command(dst_command, table=table))))
+                    label = '%s %i/%i' % (table, i + 1, len(wheres))
+                    funcs.append((label, partial(relay_stream, src_args, dst_args, label=label)))
+                errors = [(label, error) for label, _, error in run_concurrently(funcs, max_workers=chunks) if error]
+            finally:
+                self.finish_table_load(dst_query, table, prepared)
+            if errors:
+                raise Exception('Unable to copy table %s:\n%s' % (table, '\n'.join('%s: %s' % (label, error[1]) for label, error in errors)))
+
+    def run_query(self, host_string, command, sql):
+        """
+        Runs the SQL on the given host, using a query command formatted for its database, and returns its output.
+        """
+        return run_on_host(host_string, fill_command(command, sql=sql))
 
     @task
     def load_db_set(self, name, r=None):
@@ -238,46 +630,78 @@ class DatabaseSatchel(ServiceSatchel):
         db_set = r.genv.db_sets.get(name, {})
         r.genv.update(db_set)
 
-    @task
-    def loadable(self, src, dst):
+    def get_snapshot_size(self, dump_fn):
         """
-        Determines if there's enough space to load the target database.
+        Returns the total size of the local snapshot in bytes.
         """
-        from fabric import state
-        from fabric.task_utils import crawl
-
-        src_task = crawl(src, state.commands)
-        assert src_task, 'Unknown source role: %s' % src
-
-        dst_task = crawl(dst, state.commands)
-        assert dst_task, 'Unknown destination role: %s' % src
-
-        # Get source database size.
-        src_task()
-        env.host_string = env.hosts[0]
-        src_size_bytes = self.get_size()
+        return sum(os.path.getsize(fn) for fn in iter_snapshot_files(dump_fn))
 
-        # Get target database size, if any.
-        dst_task()
-        env.host_string = env.hosts[0]
-        try:
-            dst_size_bytes = self.get_size()
-        except (ValueError, TypeError):
-            dst_size_bytes = 0
+    @task
+    def loadable(self, src, dst, name=None, site=None, dump_fn=None, stream=0):
+        """
+        Determines if there's enough space to load the target database.
 
-        # Get target host disk size.
-        free_space_bytes = self.get_free_space()
+        The sizes of the source and destination databases, and the destination's free space, are queried concurrently.
+        The space needed is the size of the source database, plus the temporary space used to build its largest index,
+        plus the compressed snapshot copied to the destination, unless stream=1, for dumpload().
+        The snapshot's size is measured if dump_fn is a local snapshot, and estimated otherwise.
+        """
+        src_host, src_r = self.get_role_database(src, name=name, site=site)
+        assert src_r.env.size_command and src_r.env.table_sizes_command, 'No size commands are defined.'
+        src_command = src_r.format('%s && %s' % (src_r.env.size_command, src_r.env.table_sizes_command))
+
+        dst_host, dst_r = self.get_role_database(dst, name=name, site=site)
+        dst_command = dst_r.format(dst_r.env.size_command)
+        free_space_command = self.get_free_space_command()
+
+        if self.dryrun:
+            print('[%s] %s' % (src_host, src_command))
+            print('[%s] %s' % (dst_host, dst_command))
+            print('[%s] %s' % (dst_host, free_space_command))
+            return
+
+        results = dict((key, (result, error)) for key, result, error in run_concurrently([
+            ('src', partial(run_on_host, src_host, src_command)),
+            ('dst', partial(run_on_host, dst_host, dst_command)),
+            ('free_space', partial(run_on_host, dst_host, free_space_command)),
+        ], max_workers=3))
+        for key in ('src', 'free_space'):
+            error = results[key][1]
+            if error:
+                raise Exception('Unable to check %s: %s' % (key, error[1]))
+
+        src_size_bytes = parse_size(results['src'][0])
+        src_tables = parse_table_sizes(results['src'][0])
+
+        # The target database may not exist yet.
+        dst_size_bytes = parse_size(results['dst'][0])
+
+        free_space_bytes = parse_size(results['free_space'][0]) * 1024
+
+        index_bytes = int(max([index_bytes for _, _, index_bytes in src_tables] or [0]) * float(dst_r.env.index_build_overhead))
+
+        if int(stream):
+            snapshot_bytes = 0
+        elif dump_fn and os.path.exists(dump_fn):
+            snapshot_bytes = self.get_snapshot_size(dump_fn)
+        else:
+            snapshot_bytes = int(src_size_bytes * float(dst_r.env.snapshot_size_ratio))
 
         # Deduct existing database size, because we'll be deleting it.
-        balance_bytes = free_space_bytes + dst_size_bytes - src_size_bytes
+        balance_bytes = free_space_bytes + dst_size_bytes - src_size_bytes - index_bytes - snapshot_bytes
         balance_bytes_scaled, units = pretty_bytes(balance_bytes)
 
         viable = balance_bytes >= 0
         if self.verbose:
             print('src_db_size:', pretty_bytes(src_size_bytes))
+            print('src_largest_tables:')
+            for table, data_bytes, _index_bytes in src_tables[:10]:
+                print('    %s:' % table, pretty_bytes(data_bytes + _index_bytes))
             print('dst_db_size:', pretty_bytes(dst_size_bytes))
+            print('dst_index_build_space:', pretty_bytes(index_bytes))
+            print('dst_snapshot_size:', pretty_bytes(snapshot_bytes))
             print('dst_free_space:', pretty_bytes(free_space_bytes))
-            print
+            print()
             if viable:
                 print('Viable! There will be %.02f %s of disk space left.' % (balance_bytes_scaled, units))
             else:
@@ -285,23 +709,100 @@ class DatabaseSatchel(ServiceSatchel):
 
         return viable
 
+    def get_role_database(self, role, name=None, site=None):
+        """
+        Loads the settings of the given role and returns its first host, along with a renderer for its database.
+        """
+        from fabric import state
+        from fabric.task_utils import crawl
+
+        role_task = crawl(role, state.commands)
+        assert role_task, 'Unknown role: %s' % role
+        role_task()
+        env.host_string = env.hosts[0]
+        return env.host_string, self.database_renderer(name=name, site=site, role=role)
+
+    def get_stream_compression(self, r, src_host, dst_host):
+        """
+        Returns the commands dumpload() compresses the stream with on the source host, and decompresses it with on the destination host.
+        """
+        from burlap.facts import get_fact
+
+        tool = r.env.stream_compression
+        src_tools = get_fact('compressors', src_host).split()
+        dst_tools = get_fact('compressors', dst_host).split()
+        if tool is None:
+            # Data compressed with pigz can be decompressed with gzip.
+            tool = 'none'
+            for _tool in STREAM_COMPRESSORS:
+                if _tool in src_tools and (_tool in dst_tools or (_tool == 'pigz' and 'gzip' in dst_tools)):
+                    tool = _tool
+                    break
+
+        level = r.env.stream_compression_level
+        if tool == 'zstd':
+            # Adaptive mode lowers the level when the network can keep up, and raises it when it can't.
+            return 'zstd -q -T0 %s' % ('-%s' % level if level else '--adapt'), 'zstd -q -d'
+        elif tool == 'pigz':
+            return 'pigz -%s' % (level or 1), 'pigz -d' if 'pigz' in dst_tools else 'gzip -d'
+        elif tool == 'gzip':
+            return 'gzip -%s' % (level or 1), 'gzip -d'
+        elif tool == 'none':
+            return 'cat', 'cat'
+        raise ValueError('Unknown stream compression: %s' % tool)
+
+    def prepare_stream_load(self, name=None, site=None):
+        """
+        Prepares the current host's database to be loaded by dumpload(), so its load stream command can restore into it.
+        """
+        self.load(prep_only=1, name=name, site=site)
+
     @task
-    def dumpload(self, site=None, role=None):
+    def dumpload(self, src, dst, name=None, site=None):
         """
-        Dumps and loads a database snapshot simultaneously.
-        Requires that the destination server has direct database access
-        to the source server.
+        Streams a database from the first host of the source role into the first host of the destination role.
+
+        The dump is compressed on the source, relayed through localhost, so the hosts don't need access to each other,
+        and decompressed straight into the destination's load command, so no snapshot is written to disk on any host.
+        The checksums of the stream on all three hosts are compared once it's done.
 
         This is better than a serial dump+load when:
         1. The network connection is reliable.
         2. You don't need to save the dump file.
+        """
+        src_host, src_r = self.get_role_database(src, name=name, site=site)
+        assert src_r.env.dump_stream_command, 'No dump stream command is defined.'
+        src_command = src_r.format(src_r.env.dump_stream_command)
+
+        dst_host, dst_r = self.get_role_database(dst, name=name, site=site)
+        assert dst_r.env.load_stream_command, 'No load stream command is defined.'
+        compress, decompress = self.get_stream_compression(dst_r, src_host, dst_host)
+        self.prepare_stream_load(name=name, site=site)
+        dst_command = dst_r.format(dst_r.env.load_stream_command)
+
+        src_args = get_stream_args(src_host, get_stream_script('%s | %s | tee {fifo}' % (src_command, compress)))
+        dst_args = get_stream_args(dst_host, get_stream_script('tee {fifo} | %s | %s' % (decompress, dst_command)))
+        if self.dryrun:
+            print('[%s] %s | %s' % (src_host, src_command, compress))
+            print('[%s] %s | %s' % (dst_host, decompress, dst_command))
+            return
+
+        dst_r.pc('Streaming database from %s to %s.' % (src_host, dst_host))
+        stats = relay_stream(src_args, dst_args, table_pattern=src_r.env.dump_stream_table_pattern)
+        self.vprint('Relayed %s bytes in %.1f seconds with checksum %s.' % (stats['size'], stats['seconds'], stats['checksum']))
+        return stats
+
+    def is_directory_dump(self, r):
+        """
+        Returns true if the database's snapshots are directories, rather than single files.
+        """
+        return False
 
-        The benefits of this over a dump+load are:
-        1. Usually runs faster, since the load and dump happen in parallel.
-        2. Usually takes up less disk space since no separate dump file is
-            downloaded.
+    def get_dump_command(self, r):
         """
-        raise NotImplementedError
+        Returns the command that writes the database's snapshot to {dump_fn}.
+        """
+        return r.env.dump_command
 
     def render_fn(self, fn):
         return subprocess.check_output('echo %s' % fn, shell=True)
@@ -341,8 +842,6 @@ class DatabaseSatchel(ServiceSatchel):
 
         to_local = int(to_local)
 
-        dump_fn = dump_fn or r.env.dump_fn_template
-
         # Render the snapshot filename.
         r.env.dump_fn = self.get_default_db_fn(
             fn_template=dump_fn,
@@ -354,23 +853,31 @@ class DatabaseSatchel(ServiceSatchel):
         # Dump the database to a snapshot file.
         #if not os.path.isfile(os.path.abspath(r.env.dump_fn))):
         r.pc('Dumping database snapshot.')
+        dump_command = self.get_dump_command(r)
+        r.env.dump_dir, r.env.dump_name = os.path.split(r.env.dump_fn.rstrip('/'))
         if from_local:
-            r.local(r.env.dump_command)
+            r.local(dump_command)
+            if not self.dryrun:
+                write_snapshot_manifest(r.env.dump_fn)
         elif use_sudo:
-            r.sudo(r.env.dump_command)
+            r.sudo(dump_command)
+            r.sudo(r.env.manifest_command)
         else:
-            r.run(r.env.dump_command)
+            r.run(dump_command)
+            r.run(r.env.manifest_command)
 
         # Download the database dump file on the remote host to localhost.
         if not from_local and to_local:
             r.pc('Downloading database snapshot to localhost.')
-            r.local('rsync -rvz --progress --recursive --no-p --no-g '
-                '--rsh "ssh -o StrictHostKeyChecking=no -i {key_filename}" {user}@{host_string}:{dump_fn} {dump_fn}')
+            self.download_snapshot(r)
 
             # Delete the snapshot file on the remote system.
             if int(cleanup):
                 r.pc('Deleting database snapshot on remote host.')
-                r.sudo('rm {dump_fn}')
+                if self.is_directory_dump(r):
+                    r.sudo('rm -Rf {dump_fn} {dump_fn}.sha256')
+                else:
+                    r.sudo('rm -f {dump_fn} {dump_fn}.sha256')
 
         # Move the database snapshot to an archive directory.
         if to_local and int(archive):
@@ -378,10 +885,56 @@ class DatabaseSatchel(ServiceSatchel):
             db_fn = r.render_fn(r.env.dump_fn)
             r.env.archive_fn = '%s/%s' % (env.db_dump_archive_dir, os.path.split(db_fn)[-1])
             r.local('mv %s %s' % (db_fn, env.archive_fn))
+            r.local('mv %s %s' % (get_manifest_fn(db_fn), get_manifest_fn(env.archive_fn)))
 
         return r.env.dump_fn
 
+    def get_transfer_options(self, r):
+        """
+        Returns the rsync options used to transfer snapshots.
+        """
+        # Partially transferred files are kept, so a retry only sends the rest.
+        options = ['-rv', '--partial', '--progress', '--no-p', '--no-g']
+        if not r.env.dump_compressed:
+            options.append('-z')
+        if r.env.transfer_bwlimit:
+            options.append('--bwlimit=%s' % r.env.transfer_bwlimit)
+        if self.is_directory_dump(r):
+            # Files left over from an older snapshot with the same name are removed.
+            options.append('--delete')
+        return ' '.join(options)
+
+    def transfer_snapshot(self, r, command):
+        """
+        Runs the rsync command transferring a snapshot, resuming it if it's interrupted.
+        """
+        r.env.transfer_options = self.get_transfer_options(r)
+        retries = int(r.env.transfer_retries or 0)
+        for attempt in range(retries + 1):
+            with settings(warn_only=attempt < retries):
+                ret = r.local(command)
+            if not getattr(ret, 'failed', False):
+                return ret
+            print('Snapshot transfer interrupted, resuming (%i of %i)...' % (attempt + 1, retries), file=sys.stderr)
+
+    def download_snapshot(self, r):
+        """
+        Copies the snapshot at {dump_fn} on the current host, along with its manifest, to the same path on localhost,
+        and checks it against the manifest.
+        """
+        r.env.dump_dir = os.path.dirname(r.env.dump_fn.rstrip('/'))
+        r.local('mkdir -p {dump_dir}')
+        self.transfer_snapshot(r, 'rsync {transfer_options} --rsh "ssh -o StrictHostKeyChecking=no -i {key_filename}" '
+            '{user}@{host_string}:{dump_fn} {user}@{host_string}:{dump_fn}.sha256 {dump_dir}/')
+        if not self.dryrun:
+            mismatches = verify_snapshot_manifest(r.env.dump_fn)
+            if mismatches:
+                raise Exception('Downloaded snapshot does not match its manifest: %s' % ', '.join(mismatches))
+
     def upload_snapshot(self, name=None, site=None, local_dump_fn=None, remote_dump_fn=None):
+        """
+        Copies the local snapshot, along with its manifest if it has one, to the current host.
+        """
         r = self.database_renderer(name=name, site=site)
         print('Uploading database snapshot...')
 
@@ -393,9 +946,35 @@ class DatabaseSatchel(ServiceSatchel):
         if remote_dump_fn:
             r.env.remote_dump_fn = remote_dump_fn
 
-        r.local('rsync -rvz --progress --no-p --no-g '
-            '--rsh "ssh -o StrictHostKeyChecking=no -i {key_filename}" '
-            '{local_dump_fn} {user}@{host_string}:{remote_dump_fn}')
+        # The snapshot keeps its name, so the paths in its manifest still match.
+        r.env.remote_dump_dir, remote_dump_name = os.path.split(r.env.remote_dump_fn.rstrip('/'))
+        assert remote_dump_name == os.path.basename(r.env.local_dump_fn.rstrip('/')), \
+            'The remote snapshot %s must have the same name as the local snapshot.' % r.env.remote_dump_fn
+
+        r.env.local_manifest_fn = ''
+        if self.dryrun or os.path.isfile(get_manifest_fn(r.env.local_dump_fn)):
+            r.env.local_manifest_fn = get_manifest_fn(r.env.local_dump_fn)
+
+        self.transfer_snapshot(r, 'rsync {transfer_options} --rsh "ssh -o StrictHostKeyChecking=no -i {key_filename}" '
+            '{local_dump_fn} {local_manifest_fn} {user}@{host_string}:{remote_dump_dir}/')
+
+    def verify_snapshot(self, r):
+        """
+        Checks the snapshot at {remote_dump_fn} on the current host against its manifest, raising an exception if it doesn't match.
+
+        Snapshots without a manifest aren't checked.
+        """
+        if not self.dryrun and not os.path.isfile(get_manifest_fn(r.env.dump_fn)):
+            print('Warning: Snapshot %s has no manifest, so it could not be verified.' % r.env.dump_fn, file=sys.stderr)
+            return
+        r.pc('Verifying database snapshot.')
+        if self.is_local and not self.dryrun:
+            mismatches = verify_snapshot_manifest(r.env.dump_fn)
+            if mismatches:
+                raise Exception('Snapshot does not match its manifest: %s' % ', '.join(mismatches))
+        else:
+            r.env.remote_dump_dir, r.env.remote_dump_name = os.path.split(r.env.remote_dump_fn.rstrip('/'))
+            r.run(r.env.verify_manifest_command)
 
     @task
     @runs_once
@@ -3,10 +3,11 @@ Convenience decorators for use in fabfiles.
 """
 from __future__ import with_statement
 
+from functools import wraps
+
 #from Crypto import Random
 
 #from fabric import tasks
-from fabric.api import runs_once as _runs_once
 
 #from .context_managers import settings
 from burlap.tasks import WrappedCallableTask
@@ -43,7 +44,7 @@ def task_or_dryrun(*args, **kwargs):
 
     return wrapper if invoked else wrapper(func)
 
-_METHOD_ATTRIBUTES = ['deploy_before', 'is_post_callback']
+_METHOD_ATTRIBUTES = ['deploy_before', 'is_post_callback', 'is_task', 'is_deployer', 'deploy_keys']
 
 def _task(meth):
     meth.is_task = True
@@ -62,6 +63,7 @@ def _task(meth):
         for attr in _METHOD_ATTRIBUTES:
             if hasattr(meth, attr):
                 setattr(wrapper, attr, getattr(meth, attr))
+        wrapper.deploy_order = meth.__code__.co_firstlineno
         return wrapper
     return meth
 
@@ -79,9 +81,18 @@ def task(*args, **kwargs):
         def my_method(self):
             ...
 
+        @task(keys=['sites', 'media_*'])
+        def my_deployer(self):
+            ...
+
+    Passing keys marks the method as a deployer that is only run when one of the
+    named manifest keys has changed. Keys may contain shell-style wildcards,
+    and keys prefixed with "!" exclude any matching keys.
+    Once a satchel has such deployers, its configure() is no longer run during deployments.
     """
     precursors = kwargs.pop('precursors', None)
     post_callback = kwargs.pop('post_callback', False)
+    keys = kwargs.pop('keys', None)
     if args and callable(args[0]):
         # direct decoration, @task
         return _task(*args)
@@ -94,17 +105,26 @@ def task(*args, **kwargs):
             #from burlap.common import post_callbacks
             #post_callbacks.append(meth)
             meth.is_post_callback = True
+        if keys is not None:
+            meth.is_deployer = True
+            meth.deploy_keys = list(keys)
         return _task(meth)
     return wrapper
 
 def runs_once(meth):
     """
     A wrapper around Fabric's runs_once() to support our dryrun feature.
+
+    Once marked as done, by setting a return_value, the method returns it instead of running again.
     """
     from burlap.common import get_dryrun, runs_once_methods
     if get_dryrun():
-        pass
-    else:
-        runs_once_methods.append(meth)
-        _runs_once(meth)
-    return meth
+        return meth
+
+    @wraps(meth)
+    def wrapper(*args, **kwargs):
+        if hasattr(wrapper, 'return_value'):
+            return wrapper.return_value
+        return meth(*args, **kwargs)
+    runs_once_methods.append(wrapper)
+    return wrapper
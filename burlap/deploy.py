@@ -1,21 +1,39 @@
 from __future__ import print_function
 
+import os
 import sys
+import gzip
+import shutil
+import json
 import socket
+import hashlib
+import tarfile
+import tempfile
+import traceback
+from fnmatch import fnmatch
 from pprint import pprint
 from functools import partial
 from StringIO import StringIO
 
 import yaml
 
-from fabric.api import execute, get
+from fabric.api import execute, get, settings, hide
 
 from burlap import ContainerSatchel
 from burlap.constants import *
 from burlap.decorators import task
-from burlap.common import manifest_recorder, success_str, manifest_deployers_befores, topological_sort, resolve_deployer, \
-    manifest_deployers_takes_diff, manifest_deployers, str_to_component_list, assert_valid_satchel, clean_service_name
+from burlap.tasks import WrappedCallableTask
+from burlap.common import manifest_recorder, success_str, fail_str, manifest_deployers_befores, topological_sort, resolve_deployer, \
+    manifest_deployers_takes_diff, manifest_deployers, str_to_component_list, assert_valid_satchel, clean_service_name, \
+    run_concurrently, _run_or_local, topological_levels, all_satchels, manifest_deployers_keys, runs_once_methods
 from burlap import exceptions
+from burlap.facts import get_facts
+
+# The version of the sharded manifest format written to the manifest index.
+MANIFEST_VERSION = 1
+
+# Marks a manifest shard that could not be read.
+_INVALID_SHARD = object()
 
 def iter_dict_differences(a, b):
     """
@@ -28,9 +46,9 @@ def iter_dict_differences(a, b):
         if a_value != b_value:
             yield k, (a_value, b_value)
 
-def get_component_order(component_names):
+def get_component_dependencies(component_names):
     """
-    Given a list of components, re-orders them according to inter-component dependencies so the most depended upon are first.
+    Returns a dictionary mapping each component to the set of given components that must be deployed before it.
     """
     assert isinstance(component_names, (tuple, list))
     component_dependences = {}
@@ -38,12 +56,43 @@ def get_component_order(component_names):
         deps = set(manifest_deployers_befores.get(_name, []))
         deps = deps.intersection(component_names)
         component_dependences[_name] = deps
-    component_order = list(topological_sort(component_dependences.items()))
+    return component_dependences
+
+def get_component_order(component_names):
+    """
+    Given a list of components, re-orders them according to inter-component dependencies so the most depended upon are first.
+    """
+    component_order = list(topological_sort(get_component_dependencies(component_names).items()))
     return component_order
 
-def get_deploy_funcs(components, current_thumbprint, previous_thumbprint, preview=False):
+def get_component_levels(component_names):
     """
-    Returns a generator yielding the named functions needed for a deployment.
+    Given a list of components, groups them into levels so each component only depends on components in earlier levels.
+
+    Components within the same level have no ordering between them and may be deployed simultaneously.
+    """
+    return topological_levels(get_component_dependencies(component_names))
+
+def get_changed_keys(patterns, last, current):
+    """
+    Returns the sorted manifest keys matching the given patterns whose values differ between two manifests.
+
+    A key matches if it matches any pattern, and none of the patterns prefixed with "!".
+    """
+    includes = [pattern for pattern in patterns if not pattern.startswith('!')]
+    excludes = [pattern[1:] for pattern in patterns if pattern.startswith('!')]
+    changed_keys = [k for k, _ in iter_dict_differences(last or {}, current or {})]
+    return sorted(
+        k for k in changed_keys
+        if any(fnmatch(k, pattern) for pattern in includes) and not any(fnmatch(k, pattern) for pattern in excludes)
+    )
+
+def iter_deploy_funcs(components, current_thumbprint, previous_thumbprint):
+    """
+    Returns a generator yielding a (func_name, func, changed_keys) tuple for each function needed for a deployment.
+
+    Deployers that declare the manifest keys they depend on are skipped unless one of those keys changed,
+    and changed_keys lists the keys that triggered them. For all other deployers changed_keys is None.
     """
     for component in components:
         funcs = manifest_deployers.get(component, [])
@@ -56,21 +105,99 @@ def get_deploy_funcs(components, current_thumbprint, previous_thumbprint, previe
 
             takes_diff = manifest_deployers_takes_diff.get(func_name, False)
 
-            func = resolve_deployer(func_name)
             current = current_thumbprint.get(component)
             last = previous_thumbprint.get(component)
+
+            changed_keys = None
+            keys = manifest_deployers_keys.get(func_name)
+            if keys is not None and isinstance(current, dict) and isinstance(last or {}, dict):
+                changed_keys = get_changed_keys(keys, last, current)
+                if not changed_keys:
+                    continue
+
+            func = resolve_deployer(func_name)
             if takes_diff:
-                yield func_name, partial(func, last=last, current=current)
+                yield func_name, partial(func, last=last, current=current), changed_keys
             else:
-                yield func_name, partial(func)
+                yield func_name, partial(func), changed_keys
+
+def get_deploy_funcs(components, current_thumbprint, previous_thumbprint, preview=False):
+    """
+    Returns a generator yielding the named functions needed for a deployment.
+    """
+    for func_name, func, _ in iter_deploy_funcs(components, current_thumbprint, previous_thumbprint):
+        yield func_name, func
+
+class HostPrefixedStream(object):
+    """
+    Wraps a file-like object so every line written to it is prefixed with the current host,
+    keeping the output of hosts deployed in parallel distinguishable.
+    """
+
+    def __init__(self, stream, host):
+        self.stream = stream
+        self.prefix = '[%s] ' % host
+        self._at_line_start = True
+
+    def write(self, s):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        else:
+            s = str(s)
+        if not s:
+            return
+        lines = s.split('\n')
+        out = []
+        for i, line in enumerate(lines):
+            if i:
+                out.append('\n')
+                self._at_line_start = True
+            if line:
+                # Fabric already prefixes the output of remote commands.
+                if self._at_line_start and not line.startswith(self.prefix):
+                    out.append(self.prefix)
+                out.append(line)
+                self._at_line_start = False
+        self.stream.write(''.join(out))
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
 
 class DeploySatchel(ContainerSatchel):
 
     name = 'deploy'
 
+    def __init__(self):
+        self._remote_manifests = {} # {host_string: manifest}
+        super(DeploySatchel, self).__init__()
+
+    def clear_caches(self):
+        super(DeploySatchel, self).clear_caches()
+        self._remote_manifests = {}
+
     def set_defaults(self):
         self.env.lockfile_path = '~/burlap/deploy.lock'
         self.env.data_dir = '~/burlap'
+
+        # The default number of hosts push() will deploy to simultaneously.
+        # A value of 0 or 1 deploys to each host serially.
+        self.env.parallel = 0
+
+        # The number of threads used to record the manifests of satchels that set concurrent_record_manifest simultaneously.
+        self.env.thumbprint_workers = 8
+
+        # If true, component manifests are recorded one at a time.
+        self.env.thumbprint_serial = False
+
+        # The maximum number of components in the same dependency level deployed simultaneously on a host.
+        # A value of 0 or 1 deploys each component serially.
+        # Only satchels that set concurrent_deploy are ever deployed alongside another component.
+        self.env.level_workers = 4
+
+        # Components that are never deployed alongside any other component, e.g. because they hold the apt lock,
+        # even if their satchels set concurrent_deploy.
+        self.env.exclusive_components = ['PACKAGER']
+
         self._plan_funcs = None
 
     @task
@@ -89,20 +216,44 @@ class DeploySatchel(ContainerSatchel):
         """
         r = self.local_renderer
         r.run_or_local('[ -d {data_dir} ] && rm -Rf {data_dir} || true')
+        self._remote_manifests.pop(self.genv.host_string, None)
 
     @property
     def manifest_filename(self):
         """
-        Returns the path to the manifest file.
+        Returns the path to the legacy single-file manifest.
         """
         r = self.local_renderer
         tp_fn = r.format(r.env.data_dir + '/manifest.yaml')
         return tp_fn
 
-    def get_current_thumbprint(self, components=None):
+    @property
+    def manifest_dir(self):
+        """
+        Returns the path to the directory containing the manifest index and one shard per component.
+        """
+        r = self.local_renderer
+        return r.format(r.env.data_dir + '/manifests')
+
+    @property
+    def manifest_index_filename(self):
+        return self.manifest_dir + '/index.json'
+
+    @property
+    def local_manifest_cache_dir(self):
+        """
+        Returns the local directory where downloaded manifest shards are cached by content hash.
+        """
+        return os.path.join(self.genv.burlap_data_dir, 'manifests')
+
+    def get_current_thumbprint(self, components=None, serial=None):
         """
         Returns a dictionary representing the current configuration state.
 
+        The manifests of satchels that set concurrent_record_manifest are recorded on a pool of threads,
+        unless serial is set, in which case they're recorded one at a time, which is easier to debug.
+        All other manifests are always recorded one at a time, since they may modify the global environment.
+
         Thumbprint is of the form:
 
             {
@@ -115,7 +266,9 @@ class DeploySatchel(ContainerSatchel):
         components = str_to_component_list(components)
         if self.verbose:
             print('deploy.get_current_thumbprint.components:', components)
-        manifest_data = {} # {component:data}
+        serial = int(self.env.thumbprint_serial if serial is None else serial)
+        concurrent_recorders = [] # [(manifest_key, func)]
+        serial_recorders = [] # [(manifest_key, func)]
         for component_name, func in sorted(manifest_recorder.iteritems()):
             self.vprint('Checking thumbprint for component %s...' % component_name)
             manifest_key = assert_valid_satchel(component_name)
@@ -126,13 +279,39 @@ class DeploySatchel(ContainerSatchel):
             elif components and service_name not in components:
                 self.vprint('Skipping non-matching component:', component_name)
                 continue
-            try:
-                self.vprint('Retrieving manifest for %s...' % component_name)
-                manifest_data[manifest_key] = func()
+            if serial or not self.get_satchel(manifest_key).concurrent_record_manifest:
+                serial_recorders.append((manifest_key, func))
+            else:
+                concurrent_recorders.append((manifest_key, func))
+
+        manifest_data = {} # {component:data}
+        for manifest_key, func in serial_recorders:
+            self.vprint('Retrieving manifest for %s...' % manifest_key)
+            manifest_data[manifest_key] = func()
+            if self.verbose:
+                pprint(manifest_data[manifest_key], indent=4)
+
+        if concurrent_recorders:
+            # Gathering facts temporarily changes the global environment, so make sure they're cached before starting any threads.
+            get_facts()
+            self.vprint('Retrieving manifests for %s...' % ', '.join(k for k, _ in concurrent_recorders))
+            errors = []
+            for manifest_key, data, error in run_concurrently(concurrent_recorders, max_workers=self.env.thumbprint_workers):
+                if error:
+                    errors.append((manifest_key, error))
+                    continue
+                manifest_data[manifest_key] = data
                 if self.verbose:
-                    pprint(manifest_data[manifest_key], indent=4)
-            except exceptions.AbortDeployment as e:
-                raise
+                    print('Manifest for %s:' % manifest_key)
+                    pprint(data, indent=4)
+            for manifest_key, (e, tb) in errors:
+                print(fail_str('Unable to record the manifest for component %s:\n%s' % (manifest_key, tb)), file=sys.stderr)
+                if isinstance(e, exceptions.AbortDeployment):
+                    raise e
+            if errors:
+                raise exceptions.AbortDeployment(
+                    'Unable to record the manifest for components: %s' % ', '.join(k for k, _ in errors))
+
         return manifest_data
 
     def get_previous_thumbprint(self, components=None):
@@ -149,21 +328,177 @@ class DeploySatchel(ContainerSatchel):
 
         """
         components = str_to_component_list(components)
+        raw_data = self.get_remote_manifest(components=components)
+        if raw_data is None:
+            return
+        manifest_data = {}
+        for k, v in raw_data.items():
+            manifest_key = assert_valid_satchel(k)
+            service_name = clean_service_name(k)
+            if components and service_name not in components:
+                continue
+            manifest_data[manifest_key] = v
+        return manifest_data
+
+    def get_remote_manifest(self, components=None):
+        """
+        Returns the manifest last recorded on the current host, or None if no manifest exists.
+
+        Only the index and the shards for the given components are downloaded. Shards are verified against the content hash
+        recorded in the index and cached locally by that hash, so unchanged shards are never downloaded twice.
+        Hosts that still have a legacy manifest.yaml are read transparently.
+
+        Everything downloaded is cached until the next fake() or reset_all_satchels(),
+        so every satchel reading its last manifest doesn't cause another download.
+        """
+        components = str_to_component_list(components)
+        hs = self.genv.host_string
+        if hs not in self._remote_manifests:
+            index = self.get_manifest_index()
+            if index is None:
+                self._remote_manifests[hs] = dict(index=None, data=self.get_legacy_manifest())
+            else:
+                self._remote_manifests[hs] = dict(index=index, data={})
+        cache = self._remote_manifests[hs]
+
+        if cache['index'] is None:
+            return cache['data']
+
+        manifest_data = {}
+        for manifest_key, content_hash in sorted(cache['index']['components'].items()):
+            if components and clean_service_name(manifest_key) not in components:
+                continue
+            if manifest_key not in cache['data']:
+                cache['data'][manifest_key] = self.get_manifest_shard(manifest_key, content_hash)
+            if cache['data'][manifest_key] is not _INVALID_SHARD:
+                manifest_data[manifest_key] = cache['data'][manifest_key]
+        return manifest_data
+
+    def get_manifest_index(self):
+        """
+        Returns the manifest index on the current host, or None if the host has no sharded manifest.
+
+        The index is of the form:
+
+            {
+                "version": 1,
+                "components": {component_name: content_hash},
+            }
+
+        """
+        with settings(warn_only=True):
+            with hide('running', 'stdout', 'stderr', 'warnings'):
+                ret = _run_or_local('cat %s' % self.manifest_index_filename)
+        if ret.failed:
+            return
+        return json.loads(ret)
+
+    def get_legacy_manifest(self):
+        """
+        Returns the data in the legacy single-file manifest, or None if the host has none.
+        """
         tp_fn = self.manifest_filename
-        tp_text = None
         if self.file_exists(tp_fn):
             fd = StringIO()
             get(tp_fn, fd)
-            tp_text = fd.getvalue()
-            manifest_data = {}
-            raw_data = yaml.load(tp_text)
-            for k, v in raw_data.items():
-                manifest_key = assert_valid_satchel(k)
-                service_name = clean_service_name(k)
-                if components and service_name not in components:
-                    continue
-                manifest_data[manifest_key] = v
-            return manifest_data
+            return yaml.load(fd.getvalue())
+
+    def get_manifest_shard(self, manifest_key, content_hash):
+        """
+        Returns the recorded manifest for a single component, loading it from the local cache if possible.
+        """
+        local_fn = os.path.join(self.local_manifest_cache_dir, '%s.yaml.gz' % content_hash)
+        if os.path.isfile(local_fn):
+            with open(local_fn, 'rb') as fin:
+                content = fin.read()
+        else:
+            fd = StringIO()
+            get('%s/%s.yaml.gz' % (self.manifest_dir, manifest_key), fd)
+            content = fd.getvalue()
+
+        text = gzip.GzipFile(fileobj=StringIO(content), mode='rb').read()
+        if hashlib.sha256(text).hexdigest() != content_hash:
+            print(fail_str('Manifest for component %s does not match its content hash. Treating it as undeployed.' % manifest_key),
+                file=sys.stderr)
+            return _INVALID_SHARD
+
+        if not os.path.isfile(local_fn):
+            self.cache_manifest_shard(content_hash, content)
+        return yaml.load(text)
+
+    def cache_manifest_shard(self, content_hash, content):
+        if not os.path.isdir(self.local_manifest_cache_dir):
+            os.makedirs(self.local_manifest_cache_dir)
+        local_fn = os.path.join(self.local_manifest_cache_dir, '%s.yaml.gz' % content_hash)
+        with open(local_fn, 'wb') as fout:
+            fout.write(content)
+
+    def write_manifest(self, manifest_data):
+        """
+        Records the manifest on the current host as an index plus one compressed shard per component.
+
+        Only shards whose content changed since the last recorded index are uploaded,
+        in a single archive, and a legacy manifest.yaml is removed once its data has been migrated.
+        """
+        r = self.local_renderer
+
+        last_index = (self.get_manifest_index() or {}).get('components', {})
+        index = dict(version=MANIFEST_VERSION, components={})
+
+        tmp_dir = tempfile.mkdtemp()
+        shard_fns = []
+        for manifest_key, data in sorted(manifest_data.items()):
+            text = yaml.dump(data)
+            content_hash = hashlib.sha256(text).hexdigest()
+            index['components'][manifest_key] = content_hash
+            if last_index.get(manifest_key) == content_hash:
+                continue
+            fd = StringIO()
+            # A fixed mtime keeps the compressed content of identical shards identical.
+            with gzip.GzipFile(fileobj=fd, mode='wb', mtime=0) as fout:
+                fout.write(text)
+            self.cache_manifest_shard(content_hash, fd.getvalue())
+            shard_fn = '%s.yaml.gz' % manifest_key
+            with open(os.path.join(tmp_dir, shard_fn), 'wb') as fout:
+                fout.write(fd.getvalue())
+            shard_fns.append(shard_fn)
+
+        with open(os.path.join(tmp_dir, 'index.json'), 'w') as fout:
+            json.dump(index, fout, indent=4, sort_keys=True)
+
+        # Write the index last, so it never references a shard that hasn't been extracted yet.
+        tar_fn = os.path.join(tmp_dir, 'manifests.tar')
+        tar = tarfile.open(tar_fn, 'w')
+        for shard_fn in shard_fns + ['index.json']:
+            tar.add(os.path.join(tmp_dir, shard_fn), arcname=shard_fn)
+        tar.close()
+
+        r.env.manifest_dir = self.manifest_dir
+        r.env.manifest_tar = self.manifest_dir + '/.manifests.tar'
+        r.env.manifest_filename = self.manifest_filename
+        r.env.stale_shards = ' '.join(
+            '{manifest_dir}/%s.yaml.gz' % _ for _ in sorted(set(last_index).difference(index['components'])))
+        r.run_or_local('mkdir -p {manifest_dir}')
+        try:
+            r.put(local_path=tar_fn, remote_path=r.env.manifest_tar)
+        finally:
+            shutil.rmtree(tmp_dir)
+        r.run_or_local('tar -xf {manifest_tar} -C {manifest_dir} && rm -f {manifest_tar} {manifest_filename} {stale_shards}')
+
+    @task
+    def migrate_manifest(self):
+        """
+        Converts a legacy manifest.yaml on the remote server to the sharded manifest format.
+        """
+        manifest_data = self.get_remote_manifest()
+        if self._remote_manifests[self.genv.host_string]['index'] is not None:
+            print('Manifest for host %s is already sharded.' % self.genv.host_string)
+            return
+        if manifest_data is None:
+            print('No manifest found for host %s.' % self.genv.host_string)
+            return
+        self.write_manifest(manifest_data)
+        self.reset_all_satchels()
 
     @task
     def lock(self):
@@ -209,9 +544,7 @@ class DeploySatchel(ContainerSatchel):
         else:
             current_tp = self.get_current_thumbprint(components=components) or {}
 
-        tp_text = yaml.dump(current_tp)
-        r = self.local_renderer
-        r.upload_content(content=tp_text, fn=self.manifest_filename)
+        self.write_manifest(current_tp)
 
         # Ensure all cached manifests are cleared, so they reflect the newly deployed changes.
         self.reset_all_satchels()
@@ -220,6 +553,34 @@ class DeploySatchel(ContainerSatchel):
         """
         Calculates the components functions that need to be executed for a deployment.
         """
+        component_order, plan_levels = self.get_plan_levels(components=components)
+        plan_funcs = [
+            (func_name, plan_func)
+            for level in plan_levels
+            for _, component_funcs in level
+            for func_name, plan_func, _ in component_funcs
+        ]
+        return component_order, plan_funcs
+
+    def is_exclusive_component(self, component):
+        """
+        Returns true if the component must never be deployed alongside another component.
+        """
+        component = component.upper()
+        if component in set(map(str.upper, self.env.exclusive_components or [])):
+            return True
+        # Fabric's environment is shared by all threads, so only satchels that never modify it can share a level.
+        satchel = all_satchels.get(component)
+        return not (satchel and satchel.concurrent_deploy)
+
+    def get_plan_levels(self, components=None):
+        """
+        Calculates the deployment plan as a list of dependency levels.
+
+        Returns a tuple of the form (component_order, plan_levels), where each level is a list of
+        (component, [(func_name, func, changed_keys)]) pairs that can be run simultaneously.
+        Each exclusive component is placed in a level of its own, ahead of the rest of its level.
+        """
 
         current_tp = self.get_current_thumbprint(components=components) or {}
         previous_tp = self.get_previous_thumbprint(components=components) or {}
@@ -234,13 +595,27 @@ class DeploySatchel(ContainerSatchel):
         if self.verbose:
             print('Differences:')
             pprint(differences, indent=4)
-        component_order = get_component_order([k for k, (_, _) in differences])
+        component_levels = get_component_levels([k for k, (_, _) in differences])
+        component_order = [component for level in component_levels for component in level]
         if self.verbose:
             print('component_order:')
             pprint(component_order, indent=4)
-        plan_funcs = list(get_deploy_funcs(component_order, current_tp, previous_tp))
 
-        return component_order, plan_funcs
+        plan_levels = []
+        for level in component_levels:
+            shared_level = []
+            for component in level:
+                component_funcs = list(iter_deploy_funcs([component], current_tp, previous_tp))
+                if not component_funcs:
+                    continue
+                if self.is_exclusive_component(component):
+                    plan_levels.append([(component, component_funcs)])
+                else:
+                    shared_level.append((component, component_funcs))
+            if shared_level:
+                plan_levels.append(shared_level)
+
+        return component_order, plan_levels
 
     @task
     def preview(self, components=None, ask=0):
@@ -252,17 +627,23 @@ class DeploySatchel(ContainerSatchel):
 
         self.init()
 
-        component_order, plan_funcs = self.get_component_funcs(components=components)
+        component_order, plan_levels = self.get_plan_levels(components=components)
 
         print('\n%i changes found for host %s.\n' % (len(component_order), self.genv.host_string))
-        if component_order and plan_funcs:
+        if component_order and plan_levels:
             if self.verbose:
                 print('These components have changed:\n')
                 for component in sorted(component_order):
                     print((' '*4)+component)
             print('Deployment plan for host %s:\n' % self.genv.host_string)
-            for func_name, _ in plan_funcs:
-                print(success_str((' '*4)+func_name))
+            for i, level in enumerate(plan_levels, 1):
+                exclusive = len(level) == 1 and self.is_exclusive_component(level[0][0])
+                print((' '*4)+'Level %i%s:' % (i, ' (exclusive)' if exclusive else ''))
+                for _, component_funcs in level:
+                    for func_name, _, changed_keys in component_funcs:
+                        if changed_keys:
+                            func_name = '%s (%s)' % (func_name, ', '.join(changed_keys))
+                        print(success_str((' '*8)+func_name))
         if component_order:
             print()
 
@@ -273,13 +654,26 @@ class DeploySatchel(ContainerSatchel):
             else:
                 sys.exit(0)
 
+        return component_order
+
     @task
-    def push(self, components=None, yes=0):
+    def push(self, components=None, yes=0, parallel=None):
         """
         Executes all satchel configurators to apply pending changes to the server.
+
+        parallel = The maximum number of hosts to deploy to simultaneously.
+            If greater than 1, each host is previewed, planned and deployed in its own process,
+            and a summary of each host's result is shown once all hosts have finished.
         """
+        parallel = int(self.env.parallel if parallel is None else parallel or 0)
+        if parallel > 1 and len(self.genv.hosts) > 1:
+            # Fabric calls us once per host, but the first call deploys to all hosts,
+            # so the remaining calls have nothing left to do.
+            if self.genv.host_string == self.genv.hosts[0]:
+                self.push_parallel(components=components, yes=yes, pool_size=parallel)
+            return
+
         from burlap import notifier
-        service = self.get_satchel('service')
         self.lock()
         try:
 
@@ -290,17 +684,156 @@ class DeploySatchel(ContainerSatchel):
                 if self.genv.host_string == self.genv.hosts[0]:
                     execute(partial(self.preview, components=components, ask=1))
 
-            component_order, plan_funcs = self.get_component_funcs(components=components)
-
-            service.pre_deploy()
-            for func_name, plan_func in plan_funcs:
-                print('Executing %s...' % func_name)
-                plan_func()
-            self.fake(components=components)
-            service.post_deploy()
+            self.apply(components=components)
             notifier.notify_post_deployment()
 
         finally:
             self.unlock()
 
+    def run_component_funcs(self, component_funcs):
+        """
+        Runs each of a component's deployment functions in order.
+        """
+        for func_name, plan_func, _ in component_funcs:
+            print('Executing %s...' % func_name)
+            plan_func()
+
+    def run_plan_level(self, level):
+        """
+        Runs the components in a single dependency level, up to level_workers at a time.
+
+        All components in the level are allowed to finish before any failure is raised,
+        so the next level is never started after a failure.
+        """
+        max_workers = int(self.env.level_workers or 1)
+        if len(level) == 1 or max_workers <= 1:
+            for _, component_funcs in level:
+                self.run_component_funcs(component_funcs)
+            return
+
+        # Gathering facts temporarily changes the global environment, so make sure they're cached before starting any threads.
+        get_facts()
+        results = run_concurrently(
+            [(component, partial(self.run_component_funcs, component_funcs)) for component, component_funcs in level],
+            max_workers=max_workers)
+        failed = []
+        for component, _, error in results:
+            if error:
+                failed.append(component)
+                print(fail_str('Unable to deploy component %s:' % component))
+                print(error[1])
+        if failed:
+            raise exceptions.AbortDeployment('Unable to deploy components: %s' % ', '.join(failed))
+
+    def apply(self, components=None):
+        """
+        Runs the deployment plan for the current host and records the new thumbprint.
+
+        Returns the list of components deployed.
+        """
+        service = self.get_satchel('service')
+        component_order, plan_levels = self.get_plan_levels(components=components)
+        service.pre_deploy()
+        for level in plan_levels:
+            self.run_plan_level(level)
+        self.fake(components=components)
+        service.post_deploy()
+        return component_order
+
+    def push_host(self, components=None):
+        """
+        Locks and deploys the current host, without any user confirmation or notification.
+        """
+        self.lock()
+        try:
+            return self.apply(components=components)
+        finally:
+            self.unlock()
+
+    def _run_on_host(self, func, runs_once_host, *args, **kwargs):
+        """
+        Calls the function for the current host with its output prefixed by the host,
+        returning a (success, result) tuple instead of raising, so a failed host
+        does not abort the hosts still running.
+
+        This runs in a child process per host, so tasks that only run once are marked as done
+        on every host except runs_once_host, instead of being repeated for every host.
+        """
+        host = self.genv.host_string
+        if host != runs_once_host:
+            for meth in runs_once_methods:
+                if not hasattr(meth, 'return_value'):
+                    meth.return_value = None
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = HostPrefixedStream(stdout, host)
+        sys.stderr = HostPrefixedStream(stderr, host)
+        try:
+            return True, func(*args, **kwargs)
+        except (Exception, SystemExit) as e: # pylint: disable=broad-except
+            traceback.print_exc()
+            return False, str(e) or type(e).__name__
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            sys.stdout, sys.stderr = stdout, stderr
+
+    def execute_parallel(self, func, hosts, pool_size, *args, **kwargs):
+        """
+        Runs the function against each host, up to pool_size hosts at a time.
+        Tasks that only run once are run by the first host, like the other tasks that only target hosts[0].
+
+        Returns a dictionary of the form {host: (success, result)}.
+        """
+        name = getattr(func, '__name__', None) or getattr(getattr(func, 'func', None), '__name__', None)
+        host_task = WrappedCallableTask(partial(self._run_on_host, func, hosts[0], *args, **kwargs), name='deploy.%s' % name)
+        with settings(parallel=True, pool_size=pool_size):
+            results = execute(host_task, hosts=hosts)
+        for host in hosts:
+            # Fabric records an exception instead of a result if the child process itself died.
+            if not isinstance(results.get(host), tuple):
+                results[host] = (False, str(results.get(host)))
+        return results
+
+    def push_parallel(self, components=None, yes=0, pool_size=2):
+        """
+        Deploys to all hosts in the current role, up to pool_size hosts at a time.
+
+        Each host keeps its own lock and manifest. The confirmation prompt and the post-deployment notification
+        are only run once, from the parent process, so they aren't repeated by every host.
+        """
+        from burlap import notifier
+
+        hosts = list(self.genv.hosts)
+        yes = int(yes)
+
+        if not yes:
+            results = self.execute_parallel(partial(self.preview, components=components), hosts, pool_size)
+            failed = sorted(host for host, (success, _) in results.items() if not success)
+            if failed:
+                raise exceptions.AbortDeployment('Unable to preview hosts: %s' % ', '.join(failed))
+            if not any(component_order for _, component_order in results.values()):
+                print('No changes found on any host.')
+                return
+            if not raw_input('Begin deployment? [yn] ').strip().lower().startswith('y'):
+                sys.exit(0)
+
+        results = self.execute_parallel(partial(self.push_host, components=components), hosts, pool_size)
+
+        print('\nDeployment summary:\n')
+        failed = []
+        for host in hosts:
+            success, result = results[host]
+            if success:
+                print(success_str((' '*4)+'%s: %i components deployed' % (host, len(result or []))))
+            else:
+                failed.append(host)
+                print(fail_str((' '*4)+'%s: failed: %s' % (host, result)))
+        print()
+
+        if failed:
+            raise exceptions.AbortDeployment('Deployment failed on %i of %i hosts.' % (len(failed), len(hosts)))
+
+        with settings(host_string=hosts[-1]):
+            notifier.notify_post_deployment()
+
 deploy = DeploySatchel()
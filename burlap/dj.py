@@ -780,15 +780,19 @@ class DjangoSatchel(Satchel):
         manifest['migrations'] = self.get_migration_fingerprint()
         return manifest
 
-    @task(precursors=['packager', 'pip'])
+    @task(precursors=['packager', 'pip'], keys=['latest_timestamp', 'manage_media', 'configure_media_command'])
     def configure_media(self, *args, **kwargs):
+        if not self.env.manage_media:
+            return
         if self.has_media_changed():
             r = self.local_renderer
             assert r.env.local_project_dir
             r.local(r.env.configure_media_command)
 
-    @task(precursors=['packager', 'apache', 'pip', 'tarball', 'postgresql', 'mysql'])
+    @task(precursors=['packager', 'apache', 'pip', 'tarball', 'postgresql', 'mysql'], keys=['migrations', 'manage_migrations'])
     def configure_migrations(self):
+        if not self.env.manage_migrations:
+            return
         r = self.local_renderer
         assert r.env.local_project_dir
         last = self.last_manifest.migrations or {}
@@ -818,9 +822,7 @@ class DjangoSatchel(Satchel):
 
     @task(precursors=['packager', 'tarball'])
     def configure(self, *args, **kwargs):
-        if self.env.manage_media:
-            self.configure_media()
-        if self.env.manage_migrations:
-            self.configure_migrations()
+        self.configure_media()
+        self.configure_migrations()
 
 dj = DjangoSatchel()
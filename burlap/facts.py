@@ -0,0 +1,212 @@
+"""
+Facts about remote hosts, like their OS, architecture and hostname.
+
+All facts are gathered by running a single script on each host, which prints them as JSON.
+They're then cached in memory for the rest of the run, and on disk under the burlap data directory, for `facts_ttl` seconds.
+"""
+from __future__ import print_function
+
+import os
+import re
+import json
+import time
+import base64
+import errno
+import tempfile
+
+from fabric.api import env, settings, hide
+
+from burlap import Satchel
+from burlap.constants import *
+from burlap.decorators import task
+from burlap.common import _run, _local
+
+# Facts gathered during the current run, of the form {host_string: facts}.
+_facts = {}
+
+# Prints each fact as a JSON string, so they can all be parsed the same way.
+# Every command is allowed to fail, since not all systems support them.
+FACTS_SCRIPT = r'''
+_str() {
+    printf '"'
+    printf '%%s' "$1" | tr '\t\r' '  ' | sed -e 's/\\/\\\\/g' -e 's/"/\\"/g' | awk 'BEGIN { ORS = "" } { if (NR > 1) print "\\n"; print }'
+    printf '"'
+}
+_fact() {
+    printf '"%%s": ' "$1"
+    _str "$2"
+    printf ', '
+}
+_which() {
+    command -v "$1" 2>/dev/null
+}
+printf '{'
+_fact hostname "$(hostname 2>/dev/null)"
+_fact kernel "$(uname -s 2>/dev/null)"
+_fact kernel_version "$(uname -v 2>/dev/null)"
+_fact arch "$(uname -m 2>/dev/null)"
+_fact cpus "$(getconf _NPROCESSORS_ONLN 2>/dev/null || nproc 2>/dev/null || grep -c ^processor /proc/cpuinfo 2>/dev/null)"
+_fact lsb_release_file "$(cat /etc/lsb-release 2>/dev/null)"
+_fact debian_version "$(cat /etc/debian_version 2>/dev/null)"
+_fact fedora_release "$(cat /etc/fedora-release 2>/dev/null)"
+_fact redhat_release "$(cat /etc/redhat-release 2>/dev/null)"
+_fact arch_release "$(test -f /etc/arch-release && echo 1)"
+_fact gentoo_release "$(test -f /etc/gentoo-release && echo 1)"
+_fact lsb_release_bin "$(test -f /usr/bin/lsb_release && echo 1)"
+if _which lsb_release >/dev/null; then
+    _fact lsb_id "$(lsb_release --id --short 2>/dev/null)"
+    _fact lsb_release "$(lsb_release --release --short 2>/dev/null)"
+    _fact lsb_codename "$(lsb_release --codename --short 2>/dev/null)"
+    _fact lsb_desc "$(lsb_release --desc --short 2>/dev/null)"
+fi
+_fact packagers "$(for pn in %(packagers)s; do _which $pn >/dev/null && echo $pn; done)"
+_fact systemctl "$(_which systemctl)"
+_fact md5 "$(_which md5sum || _which md5)"
+_fact compressors "$(for pn in zstd pigz gzip; do _which $pn >/dev/null && echo $pn; done)"
+if test -f /usr/sbin/dladm; then
+    _fact dladm_links "$(/usr/sbin/dladm show-link 2>/dev/null)"
+fi
+_fact ifconfig_links "$(/sbin/ifconfig -s 2>/dev/null)"
+_fact sys_class_net "$(ls /sys/class/net 2>/dev/null)"
+printf '"version": %(version)i}\n'
+'''
+
+# Increment whenever the script changes, so facts cached on disk by older versions are discarded.
+FACTS_VERSION = 2
+
+def get_facts_script():
+    return FACTS_SCRIPT % dict(packagers=' '.join(PACKAGERS), version=FACTS_VERSION)
+
+def get_facts_fn(host_string):
+    data_dir = env.get('burlap_data_dir') or '.burlap'
+    return os.path.abspath(os.path.join(data_dir, 'facts', '%s.json' % re.sub(r'[^a-zA-Z0-9_\-\.@]+', '_', host_string)))
+
+def load_facts(host_string, ttl):
+    """
+    Returns the facts cached on disk for the given host, or None if there are none, or they're older than ttl seconds.
+    """
+    try:
+        with open(get_facts_fn(host_string)) as fin:
+            data = json.load(fin)
+    except (IOError, ValueError):
+        return
+    if data.get('version') != FACTS_VERSION or time.time() - data.get('timestamp', 0) > ttl:
+        return
+    return data.get('facts')
+
+def save_facts(host_string, facts):
+    """
+    Atomically replaces the facts cached on disk for the given host.
+    """
+    fn = get_facts_fn(host_string)
+    facts_dir = os.path.dirname(fn)
+    try:
+        if not os.path.isdir(facts_dir):
+            os.makedirs(facts_dir)
+        fd, tmp_fn = tempfile.mkstemp(dir=facts_dir, suffix='.tmp')
+    except OSError as e:
+        # Facts are still cached in memory if the data directory isn't writable.
+        if e.errno in (errno.EACCES, errno.EROFS):
+            return
+        raise
+    try:
+        with os.fdopen(fd, 'w') as fout:
+            json.dump({'version': FACTS_VERSION, 'timestamp': time.time(), 'facts': facts}, fout)
+        os.rename(tmp_fn, fn)
+    except Exception:
+        os.remove(tmp_fn)
+        raise
+
+def gather_facts(host_string):
+    """
+    Runs the facts script on the given host and returns the facts it printed.
+    """
+    # The script is encoded so it reaches the shell unchanged by Fabric's escaping.
+    cmd = 'echo %s | base64 -d | sh' % base64.b64encode(get_facts_script().encode('utf-8')).decode('ascii')
+    with settings(host_string=host_string, warn_only=True):
+        with hide('running', 'stdout', 'stderr', 'warnings'):
+            if host_string in LOCALHOSTS:
+                ret = _local(cmd, capture=True)
+            else:
+                ret = _run(cmd)
+    # Login scripts may print their own output, so only the last line is parsed.
+    lines = [_ for _ in (ret or '').splitlines() if _.startswith('{')]
+    try:
+        return json.loads(lines[-1])
+    except (IndexError, ValueError):
+        raise Exception('Unable to gather facts from %s: %s' % (host_string, ret))
+
+def get_facts(host_string=None, refresh=False):
+    """
+    Returns a dictionary of facts about the given host, or the current host, gathering them if they're not cached.
+    """
+    if not host_string:
+        if not env.host_string:
+            env.host_string = LOCALHOST_NAME
+        host_string = env.host_string
+
+    if not refresh and host_string in _facts:
+        return _facts[host_string]
+
+    ttl = int(env.get('facts_ttl') or 0)
+    facts = None
+    if not refresh and ttl > 0:
+        facts = load_facts(host_string, ttl)
+    if facts is None:
+        facts = gather_facts(host_string)
+        if ttl > 0:
+            save_facts(host_string, facts)
+    _facts[host_string] = facts
+    return facts
+
+def get_fact(name, host_string=None):
+    return get_facts(host_string=host_string).get(name) or ''
+
+def invalidate_facts(host_string=None):
+    """
+    Forgets the facts about the given host, or the current host, so they're gathered again the next time they're needed.
+    """
+    host_string = host_string or env.host_string
+    _facts.pop(host_string, None)
+    try:
+        os.remove(get_facts_fn(host_string))
+    except OSError:
+        pass
+
+def clear_facts():
+    """
+    Forgets the facts about all hosts gathered during the current run, but not those cached on disk.
+    """
+    _facts.clear()
+
+class FactsSatchel(Satchel):
+    """
+    Gathers and caches facts about each host.
+    """
+
+    name = 'facts'
+
+    def set_defaults(self):
+        # The number of seconds facts cached on disk are reused for. Set to 0 to disable the disk cache.
+        self.env.ttl = 3600
+
+    @task
+    def refresh(self):
+        """
+        Gathers the current host's facts again, replacing any cached facts.
+        """
+        facts = get_facts(refresh=True)
+        for k in sorted(facts):
+            self.vprint('%s: %s' % (k, facts[k]))
+        return facts
+
+    @task
+    def show(self):
+        """
+        Prints the current host's facts.
+        """
+        facts = get_facts()
+        for k in sorted(facts):
+            print('%s: %s' % (k, facts[k]))
+
+facts = FactsSatchel()
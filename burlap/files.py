@@ -6,21 +6,126 @@ from __future__ import print_function
 
 from pipes import quote
 import os
+import grp
+import pwd
+import stat
+from collections import OrderedDict
+from contextlib import contextmanager
 from tempfile import mkstemp
 from urlparse import urlparse
 import hashlib
 
-from fabric.api import run as _run, sudo as _sudo, abort, warn
+from fabric.api import env, run as _run, sudo as _sudo, abort, warn
 from fabric.api import hide
 from fabric.contrib.files import upload_template as _upload_template
-from fabric.contrib.files import exists
 
 from burlap.decorators import task
-from burlap.utils import run_as_root
+from burlap.utils import run_as_root, get_file_hash
 from burlap import ContainerSatchel
 
 BLOCKSIZE = 2 ** 20 # 1MB
 
+# Stats of remote paths looked up inside a cached_stats() block, of the form {host_string: {(path, use_sudo): stat or None}}.
+# Outside such a block every lookup runs a new command, since any other command may have changed the paths.
+_stats = {}
+
+# The number of cached_stats() blocks currently open.
+_stats_depth = [0]
+
+# Prints one line per path, in order, of the form "type|link|mode|owner|group|size|mtime|checksum", or "-" if the path doesn't exist.
+# Mode, owner and group describe a symbolic link itself, like stat, while the type describes what it points to, like test.
+STAT_SCRIPT = (
+    'for p in %(paths)s; do '
+    'if [ ! -e "$p" ] && [ ! -L "$p" ]; then echo -; continue; fi; '
+    't=other; [ -f "$p" ] && t=file; [ -d "$p" ] && t=dir; '
+    'l=0; [ -L "$p" ] && l=1; '
+    "s=$(stat -c '%%a|%%U|%%G|%%s|%%Y' \"$p\" 2>/dev/null || stat -f '%%Lp|%%Su|%%Sg|%%z|%%m' \"$p\" 2>/dev/null); "
+    'c=; %(checksum)s'
+    'echo "$t|$l|$s|$c"; '
+    'done'
+)
+
+STAT_CHECKSUM_SCRIPT = '[ $t = file ] && c=$(%(md5)s "$p" 2>/dev/null | cut -d" " -f1); '
+
+# Prints the MD5 checksum of each path, one per line in order, or "-" if the path can't be read.
+CHECKSUM_SCRIPT = 'for p in %(paths)s; do c=$(%(md5)s "$p" 2>/dev/null | cut -d" " -f1); echo "${c:--}"; done'
+
+def get_stat_cache(host_string=None):
+    return _stats.setdefault(host_string or env.host_string, {})
+
+def invalidate_stats(paths=None, host_string=None):
+    """
+    Forgets the cached stats of the given paths, and anything under them, on the given host, or the current host.
+    If no paths are given, all of the host's cached stats are forgotten.
+    """
+    cache = get_stat_cache(host_string)
+    if paths is None:
+        cache.clear()
+        return
+    if isinstance(paths, basestring):
+        paths = [paths]
+    prefixes = tuple(_.rstrip('/') + '/' for _ in paths)
+    for key in list(cache):
+        if key[0] in paths or key[0].startswith(prefixes):
+            del cache[key]
+
+def clear_stats():
+    _stats.clear()
+
+def local_stat(path, checksum=False):
+    """
+    Returns the stat of a local path, in the form returned by FileSatchel.stat_many().
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return
+    if os.path.isfile(path):
+        _type = 'file'
+    elif os.path.isdir(path):
+        _type = 'dir'
+    else:
+        _type = 'other'
+    try:
+        owner = pwd.getpwuid(st.st_uid).pw_name
+    except KeyError:
+        owner = str(st.st_uid)
+    try:
+        group = grp.getgrgid(st.st_gid).gr_name
+    except KeyError:
+        group = str(st.st_gid)
+    md5 = None
+    if checksum and _type == 'file':
+        md5 = get_file_hash(path, hash_name='md5')
+    return dict(
+        type=_type,
+        link=stat.S_ISLNK(st.st_mode),
+        mode='%o' % stat.S_IMODE(st.st_mode),
+        owner=owner,
+        group=group,
+        size=st.st_size,
+        mtime=int(st.st_mtime),
+        checksum=md5,
+    )
+
+def parse_stat(line):
+    if line == '-':
+        return
+    parts = line.split('|')
+    if len(parts) != 8:
+        raise ValueError('Unable to parse stat: %s' % line)
+    _type, link, mode, owner, group, size, mtime, checksum = parts
+    return dict(
+        type=_type,
+        link=link == '1',
+        mode=mode,
+        owner=owner,
+        group=group,
+        size=int(size) if size else None,
+        mtime=int(mtime) if mtime else None,
+        checksum=checksum or None,
+    )
+
 class watch(object):
     """
     Context manager to watch for changes to the contents of some files.
@@ -76,16 +181,12 @@ class watch(object):
         self.changed = False
 
     def __enter__(self):
-        with self.settings(hide('warnings')):
-            for filename in self.filenames:
-                self.digest[filename] = file.md5sum(filename, self.use_sudo)
+        self.digest = file.checksum_many(self.filenames, use_sudo=self.use_sudo)
         return self
 
     def __exit__(self, type, value, tb): # pylint: disable=redefined-builtin
-        for filename in self.filenames:
-            if self.md5sum(filename, self.use_sudo) != self.digest[filename]:
-                self.changed = True
-                break
+        digest = file.checksum_many(self.filenames, use_sudo=self.use_sudo)
+        self.changed = any(digest[_] != self.digest[_] for _ in self.filenames)
         if self.changed and self.callback:
             self.callback()
 
@@ -98,6 +199,98 @@ class FileSatchel(ContainerSatchel):
 
     name = 'file'
 
+    def clear_caches(self):
+        super(FileSatchel, self).clear_caches()
+        clear_stats()
+
+    def stat_many(self, paths, use_sudo=False, checksum=False, strict=True):
+        """
+        Looks up the type, mode, owner, group, size, modification time and, optionally, MD5 checksum
+        of several paths with a single command.
+
+        Returns a dictionary of the form {path: stat}, where each stat is a dictionary, or None if the path doesn't exist.
+        Inside a cached_stats() block, the results are reused until the block exits, or a write through this satchel invalidates them.
+        If the lookup fails, it aborts, unless strict is false, in which case the paths are reported as missing, like Fabric's exists().
+        """
+        if isinstance(paths, basestring):
+            paths = [paths]
+        use_sudo = bool(use_sudo)
+        cache = get_stat_cache() if _stats_depth[0] else {}
+        ret = {}
+        missing = []
+        for path in paths:
+            key = (path, use_sudo)
+            if key in cache and (not checksum or not cache[key] or cache[key]['type'] != 'file' or cache[key]['checksum']):
+                ret[path] = cache[key]
+            elif path not in missing:
+                missing.append(path)
+        if not missing:
+            return ret
+
+        if self.is_local and not use_sudo:
+            stats = [local_stat(_, checksum=checksum) for _ in missing]
+        else:
+            md5 = checksum and self.get_md5_command()
+            cmd = STAT_SCRIPT % dict(
+                paths=' '.join(quote(_) for _ in missing),
+                checksum=STAT_CHECKSUM_SCRIPT % dict(md5=md5) if md5 else '')
+            func = use_sudo and _sudo or _run
+            with self.settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+                output = func(cmd)
+            # Login scripts may print their own output, so only the last lines are parsed.
+            lines = output.splitlines()[-len(missing):]
+            try:
+                if output.failed or len(lines) != len(missing):
+                    raise ValueError(output)
+                stats = [parse_stat(_.strip()) for _ in lines]
+            except ValueError:
+                if strict:
+                    abort('Unable to stat %s: %s' % (', '.join(missing), output))
+                # Failed lookups are never cached.
+                ret.update((path, None) for path in missing)
+                return ret
+
+        for path, st in zip(missing, stats):
+            cache[(path, use_sudo)] = ret[path] = st
+        return ret
+
+    @contextmanager
+    def cached_stats(self, paths=None, use_sudo=False, checksum=False):
+        """
+        Looks up the given paths with a single command, and reuses their stats, along with any others looked up,
+        until the block exits.
+
+        Only wrap code that reads paths, or writes them through this satchel, since other commands aren't seen by the cache.
+        """
+        _stats_depth[0] += 1
+        try:
+            if paths:
+                self.stat_many(paths, use_sudo=use_sudo, checksum=checksum)
+            yield
+        finally:
+            _stats_depth[0] -= 1
+            if not _stats_depth[0]:
+                clear_stats()
+
+    def stat(self, path, use_sudo=False, checksum=False, strict=True):
+        """
+        Returns the stat of a single path, as returned by stat_many().
+        """
+        return self.stat_many([path], use_sudo=use_sudo, checksum=checksum, strict=strict)[path]
+
+    def get_md5_command(self):
+        """
+        Returns the command used to print the MD5 checksum of a file on the current host, followed by its name.
+        """
+        from burlap.facts import get_fact
+        md5 = get_fact('md5')
+        if not md5:
+            abort('No MD5 utility was found on this system.')
+        if os.path.basename(md5) == 'md5':
+            # BSD's md5 only prints the checksum first when reversed.
+            return '%s -r' % md5
+        return md5
+
     @task
     def is_file(self, path, use_sudo=False):
         """
@@ -105,10 +298,8 @@ class FileSatchel(ContainerSatchel):
         """
         if self.is_local and not use_sudo:
             return os.path.isfile(path)
-        else:
-            func = use_sudo and _sudo or _run
-            with self.settings(hide('running', 'warnings'), warn_only=True):
-                return func('[ -f "%(path)s" ]' % locals()).succeeded
+        st = self.stat(path, use_sudo=use_sudo)
+        return bool(st) and st['type'] == 'file'
 
     @task
     def is_dir(self, path, use_sudo=False):
@@ -117,50 +308,32 @@ class FileSatchel(ContainerSatchel):
         """
         if self.is_local and not use_sudo:
             return os.path.isdir(path)
-        else:
-            func = use_sudo and _sudo or _run
-            with self.settings(hide('running', 'warnings'), warn_only=True):
-                return func('[ -d "%(path)s" ]' % locals()).succeeded
+        st = self.stat(path, use_sudo=use_sudo)
+        return bool(st) and st['type'] == 'dir'
 
     @task
     def is_link(self, path, use_sudo=False):
         """
         Check if a path exists, and is a symbolic link.
         """
-        func = use_sudo and _sudo or _run
-        with self.settings(hide('running', 'warnings'), warn_only=True):
-            return func('[ -L "%(path)s" ]' % locals()).succeeded
+        st = self.stat(path, use_sudo=use_sudo)
+        return bool(st) and st['link']
 
     @task
     def get_owner(self, path, use_sudo=False):
         """
         Get the owner name of a file or directory.
         """
-        func = use_sudo and run_as_root or self.run
-        # I'd prefer to use quiet=True, but that's not supported with older
-        # versions of Fabric.
-        with self.settings(hide('running', 'stdout'), warn_only=True):
-            result = func('stat -c %%U "%(path)s"' % locals())
-            if result.failed and 'stat: illegal option' in result:
-                # Try the BSD version of stat
-                return func('stat -f %%Su "%(path)s"' % locals())
-            return result
+        st = self.stat(path, use_sudo=use_sudo)
+        return st and st['owner']
 
     @task
     def get_group(self, path, use_sudo=False):
         """
         Get the group name of a file or directory.
         """
-        func = use_sudo and run_as_root or self.run
-        # I'd prefer to use quiet=True, but that's not supported with older
-        # versions of Fabric.
-        with self.settings(hide('running', 'stdout'), warn_only=True):
-            result = func('stat -c %%G "%(path)s"' % locals())
-            if result.failed and 'stat: illegal option' in result:
-                # Try the BSD version of stat
-                return func('stat -f %%Sg "%(path)s"' % locals())
-            return result
-
+        st = self.stat(path, use_sudo=use_sudo)
+        return st and st['group']
 
     def get_mode(self, path, use_sudo=False):
         """
@@ -169,15 +342,8 @@ class FileSatchel(ContainerSatchel):
         Returns a string such as ``'0755'``, representing permissions as
         an octal number.
         """
-        func = use_sudo and run_as_root or self.run
-        # I'd prefer to use quiet=True, but that's not supported with older
-        # versions of Fabric.
-        with self.settings(hide('running', 'stdout'), warn_only=True):
-            result = func('stat -c %%a "%(path)s"' % locals())
-            if result.failed and 'stat: illegal option' in result:
-                # Try the BSD version of stat
-                return func('stat -f %%Op "%(path)s"|cut -c 4-6' % locals())
-            return result
+        st = self.stat(path, use_sudo=use_sudo)
+        return st and st['mode']
 
     @task
     def umask(self, use_sudo=False):
@@ -235,46 +401,36 @@ class FileSatchel(ContainerSatchel):
                 user = self.genv.user
             run_as_root('chown %s: %s' % (user, quote(destination)))
 
+    def checksum_many(self, paths, use_sudo=False):
+        """
+        Computes the MD5 sums of several files with a single command.
+
+        Returns a dictionary of the form {path: checksum}, where the checksum is None if the file doesn't exist or can't be read.
+        """
+        if isinstance(paths, basestring):
+            paths = [paths]
+        paths = list(OrderedDict.fromkeys(paths))
+        if not paths:
+            return {}
+        if self.is_local and not use_sudo:
+            return dict((_, get_file_hash(_, hash_name='md5') if os.path.isfile(_) else None) for _ in paths)
+        cmd = CHECKSUM_SCRIPT % dict(paths=' '.join(quote(_) for _ in paths), md5=self.get_md5_command())
+        func = use_sudo and _sudo or _run
+        with self.settings(hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
+            output = func(cmd)
+        # Login scripts may print their own output, so only the last lines are parsed.
+        lines = output.splitlines()[-len(paths):]
+        if output.failed or len(lines) != len(paths):
+            warn('Unable to compute the MD5 sums of %s: %s' % (', '.join(paths), output))
+            return dict.fromkeys(paths)
+        return dict((path, None if line.strip() == '-' else line.strip()) for path, line in zip(paths, lines))
+
     @task
     def md5sum(self, filename, use_sudo=False):
         """
         Compute the MD5 sum of a file.
         """
-        func = use_sudo and run_as_root or self.run
-        with self.settings(hide('running', 'stdout', 'stderr', 'warnings'),
-                      warn_only=True):
-            # Linux (LSB)
-            if exists(u'/usr/bin/md5sum'):
-                res = func(u'/usr/bin/md5sum %(filename)s' % locals())
-            # BSD / OS X
-            elif exists(u'/sbin/md5'):
-                res = func(u'/sbin/md5 -r %(filename)s' % locals())
-            # SmartOS Joyent build
-            elif exists(u'/opt/local/gnu/bin/md5sum'):
-                res = func(u'/opt/local/gnu/bin/md5sum %(filename)s' % locals())
-            # SmartOS Joyent build
-            # (the former doesn't exist, at least on joyent_20130222T000747Z)
-            elif exists(u'/opt/local/bin/md5sum'):
-                res = func(u'/opt/local/bin/md5sum %(filename)s' % locals())
-            # Try to find ``md5sum`` or ``md5`` on ``$PATH`` or abort
-            else:
-                md5sum = func(u'which md5sum')
-                md5 = func(u'which md5')
-                if exists(md5sum):
-                    res = func('%(md5sum)s %(filename)s' % locals())
-                elif exists(md5):
-                    res = func('%(md5)s %(filename)s' % locals())
-                else:
-                    abort('No MD5 utility was found on this system.')
-
-        if res.succeeded:
-            parts = res.split()
-            _md5sum = parts and parts[0] or None
-        else:
-            warn(res)
-            _md5sum = None
-
-        return _md5sum
+        return self.checksum_many([filename], use_sudo=use_sudo)[filename]
 
     @task
     def uncommented_lines(self, filename, use_sudo=False):
@@ -295,9 +451,10 @@ class FileSatchel(ContainerSatchel):
 
         Same as :py:func:`os.path.getmtime()`
         """
-        func = use_sudo and run_as_root or self.run
-        with self.settings(hide('running', 'stdout')):
-            return int(func('stat -c %%Y "%(path)s" ' % locals()).strip())
+        st = self.stat(path, use_sudo=use_sudo)
+        if not st:
+            raise OSError('No such file or directory: %s' % path)
+        return st['mtime']
 
     @task
     def copy(self, source, destination, recursive=False, use_sudo=False):
@@ -306,6 +463,7 @@ class FileSatchel(ContainerSatchel):
         """
         func = use_sudo and run_as_root or self.run
         options = '-r ' if recursive else ''
+        invalidate_stats(destination)
         func('/bin/cp {0}{1} {2}'.format(options, quote(source), quote(destination)))
 
     @task
@@ -314,6 +472,7 @@ class FileSatchel(ContainerSatchel):
         Move a file or directory
         """
         func = use_sudo and run_as_root or self.run
+        invalidate_stats([source, destination])
         func('/bin/mv {0} {1}'.format(quote(source), quote(destination)))
 
     @task
@@ -322,6 +481,7 @@ class FileSatchel(ContainerSatchel):
         Create a symbolic link to a file or directory
         """
         func = use_sudo and run_as_root or self.run
+        invalidate_stats(destination)
         func('/bin/ln -s {0} {1}'.format(quote(source), quote(destination)))
 
     @task
@@ -331,11 +491,12 @@ class FileSatchel(ContainerSatchel):
         """
         func = use_sudo and run_as_root or self.run
         options = '-r ' if recursive else ''
+        invalidate_stats(path)
         func('/bin/rm {0}{1}'.format(options, quote(path)))
 
     @task
     def upload(self, src, dst=None):
-        dst = self.put_or_dryrun(local_path=src, remote_path=dst)
+        dst = self.put(local_path=src, remote_path=dst)
         print('Uploaded to %s' % (dst,))
 
     @task
@@ -395,66 +556,72 @@ class FileSatchel(ContainerSatchel):
         """
         func = use_sudo and run_as_root or self.run
 
-        # 1) Only a path is given
-        if path and not (contents or source or url):
-            assert path
-            if not self.is_file(path):
-                func('touch "%(path)s"' % locals())
-
-        # 2) A URL is specified (path is optional)
-        elif url:
-            if not path:
-                path = os.path.basename(urlparse(url).path)
-
-            if not self.is_file(path) or md5 and self.md5sum(path) != md5:
-                func('wget --progress=dot:mega "%(url)s" -O "%(path)s"' % locals())
-
-        # 3) A local filename, or a content string, is specified
-        else:
-            if source:
-                assert not contents
-                t = None
-            else:
-                fd, source = mkstemp()
-                t = os.fdopen(fd, 'w')
-                t.write(contents)
-                t.close()
-
-            if verify_remote:
-                # Avoid reading the whole file into memory at once
-                digest = hashlib.md5()
-                f = open(source, 'rb')
-                try:
-                    while True:
-                        d = f.read(BLOCKSIZE)
-                        if not d:
-                            break
-                        digest.update(d)
-                finally:
-                    f.close()
+        # The path's type, owner, group and mode are all looked up with a single command.
+        with self.cached_stats([path] if path else None, use_sudo=use_sudo):
+            # 1) Only a path is given
+            if path and not (contents or source or url):
+                assert path
+                if not self.is_file(path):
+                    invalidate_stats(path)
+                    func('touch "%(path)s"' % locals())
+
+            # 2) A URL is specified (path is optional)
+            elif url:
+                if not path:
+                    path = os.path.basename(urlparse(url).path)
+
+                if not self.is_file(path) or md5 and self.md5sum(path) != md5:
+                    invalidate_stats(path)
+                    func('wget --progress=dot:mega "%(url)s" -O "%(path)s"' % locals())
+
+            # 3) A local filename, or a content string, is specified
             else:
-                digest = None
-
-            if (not self.is_file(path, use_sudo=use_sudo) or
-                    (verify_remote and
-                        self.md5sum(path, use_sudo=use_sudo) != digest.hexdigest())):
-                with self.settings(hide('running')):
-                    self.put(local_path=source, remote_path=path, use_sudo=use_sudo, temp_dir=temp_dir)
-
-            if t is not None:
-                os.unlink(source)
-
-        # Ensure correct owner
-        if use_sudo and owner is None:
-            owner = 'root'
-        if (owner and self.get_owner(path, use_sudo) != owner) or \
-           (group and self.get_group(path, use_sudo) != group):
-            func('chown %(owner)s:%(group)s "%(path)s"' % locals())
-
-        # Ensure correct mode
-        if use_sudo and mode is None:
-            mode = oct(0666 & ~int(self.umask(use_sudo=True), base=8))
-        if mode and self.get_mode(path, use_sudo) != mode:
-            func('chmod %(mode)s "%(path)s"' % locals())
+                if source:
+                    assert not contents
+                    t = None
+                else:
+                    fd, source = mkstemp()
+                    t = os.fdopen(fd, 'w')
+                    t.write(contents)
+                    t.close()
+
+                if verify_remote:
+                    # Avoid reading the whole file into memory at once
+                    digest = hashlib.md5()
+                    f = open(source, 'rb')
+                    try:
+                        while True:
+                            d = f.read(BLOCKSIZE)
+                            if not d:
+                                break
+                            digest.update(d)
+                    finally:
+                        f.close()
+                else:
+                    digest = None
+
+                if (not self.is_file(path, use_sudo=use_sudo) or
+                        (verify_remote and
+                            self.md5sum(path, use_sudo=use_sudo) != digest.hexdigest())):
+                    with self.settings(hide('running')):
+                        self.put(local_path=source, remote_path=path, use_sudo=use_sudo, temp_dir=temp_dir)
+
+                if t is not None:
+                    os.unlink(source)
+
+            # Ensure correct owner
+            if use_sudo and owner is None:
+                owner = 'root'
+            if (owner and self.get_owner(path, use_sudo) != owner) or \
+               (group and self.get_group(path, use_sudo) != group):
+                invalidate_stats(path)
+                func('chown %(owner)s:%(group)s "%(path)s"' % locals())
+
+            # Ensure correct mode
+            if use_sudo and mode is None:
+                mode = oct(0666 & ~int(self.umask(use_sudo=True), base=8))
+            if mode and self.get_mode(path, use_sudo) != mode:
+                invalidate_stats(path)
+                func('chmod %(mode)s "%(path)s"' % locals())
 
 file = FileSatchel() # pylint: disable=redefined-builtin
@@ -0,0 +1,216 @@
+"""
+Incremental scanning and hashing of local directory trees.
+
+A persistent index of each tree is kept under the burlap data directory, recording the size, modification time,
+inode and hash of every file, so subsequent scans only rehash the files that changed.
+"""
+from __future__ import print_function
+
+import os
+import json
+import time
+import errno
+import hashlib
+import tempfile
+from fnmatch import fnmatchcase
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from fabric.api import env
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Increment whenever the format of the persisted index changes, so older indexes are discarded.
+INDEX_VERSION = 1
+
+# Files at least this many bytes are hashed on the worker pool instead of inline.
+LARGE_FILE_SIZE = 1024*1024
+
+# Files modified this many seconds before a scan started, or later, may still be changing
+# within the resolution of their modification time, so their hashes are never reused.
+RACY_SECONDS = 2
+
+CHUNK_SIZE = 1024*1024
+
+def _matches(name, patterns):
+    return any(fnmatchcase(name, pattern) for pattern in patterns)
+
+def _iter_dir(path):
+    """
+    Returns a generator yielding (name, path, is_dir, is_file, stat) for each entry in a directory, without following symlinks.
+    """
+    if scandir is not None:
+        for entry in scandir(path):
+            is_dir = entry.is_dir(follow_symlinks=False)
+            is_file = entry.is_file(follow_symlinks=False)
+            yield entry.name, entry.path, is_dir, is_file, (entry.stat(follow_symlinks=False) if is_file else None)
+    else:
+        import stat as _stat
+        for name in os.listdir(path):
+            fqfn = os.path.join(path, name)
+            st = os.lstat(fqfn)
+            is_file = _stat.S_ISREG(st.st_mode)
+            yield name, fqfn, _stat.S_ISDIR(st.st_mode), is_file, (st if is_file else None)
+
+def iter_files(base_dir, patterns=None, ignore=None):
+    """
+    Returns a generator yielding a (path, stat) tuple for each regular file under base_dir, like `find base_dir -type f`.
+
+    patterns = A list of shell-style patterns, at least one of which each file name must match.
+    ignore = A list of shell-style patterns, none of which each file name may match.
+    """
+    patterns = patterns or ['*']
+    ignore = ignore or []
+    pending = [base_dir]
+    while pending:
+        path = pending.pop()
+        try:
+            entries = list(_iter_dir(path))
+        except OSError as e:
+            # Directories may disappear while they're being scanned.
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                continue
+            raise
+        for name, fqfn, is_dir, is_file, st in entries:
+            if is_dir:
+                pending.append(fqfn)
+            elif is_file and _matches(name, patterns) and not _matches(name, ignore):
+                yield fqfn, st
+
+def get_file_md5(path):
+    m = hashlib.md5()
+    with open(path, 'rb') as fin:
+        while True:
+            chunk = fin.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            m.update(chunk)
+    return m.hexdigest()
+
+def get_last_modified_timestamp(path, ignore=None):
+    """
+    Returns the most recent modification time of any file under the given path, or None if there are no files.
+    """
+    if os.path.isfile(path):
+        return os.stat(path).st_mtime
+    if not os.path.isdir(path):
+        return
+    return max([st.st_mtime for _, st in iter_files(path, ignore=ignore)] or [None])
+
+class FileIndex(object):
+    """
+    A persistent index of the files in a local directory tree matching one or more name patterns.
+    """
+
+    def __init__(self, base_dir, patterns=None, ignore=None, index_dir=None, workers=None):
+        self.base_dir = base_dir
+        self.patterns = sorted(patterns or ['*'])
+        self.ignore = sorted(ignore or [])
+        self.index_dir = index_dir or os.path.join(env.get('burlap_data_dir') or '.burlap', 'fsindex')
+        self.workers = workers or cpu_count()
+
+    def __repr__(self):
+        return '<%s %s %s>' % (type(self).__name__, self.base_dir, ' '.join(self.patterns))
+
+    @property
+    def index_filename(self):
+        key = json.dumps([os.path.abspath(self.base_dir), self.patterns, self.ignore])
+        return os.path.join(self.index_dir, '%s.json' % hashlib.md5(key.encode('utf-8')).hexdigest())
+
+    def load(self):
+        """
+        Returns the persisted index, as a dictionary of the form {path: [size, mtime, inode, hash]}.
+        """
+        try:
+            with open(self.index_filename) as fin:
+                data = json.load(fin)
+        except (IOError, ValueError):
+            return {}
+        if data.get('version') != INDEX_VERSION:
+            return {}
+        return data.get('files') or {}
+
+    def save(self, files):
+        """
+        Atomically replaces the persisted index.
+        """
+        if not os.path.isdir(self.index_dir):
+            try:
+                os.makedirs(self.index_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        fd, tmp_fn = tempfile.mkstemp(dir=self.index_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fout:
+                json.dump({'version': INDEX_VERSION, 'files': files}, fout, separators=(',', ':'))
+            os.rename(tmp_fn, self.index_filename)
+        except Exception:
+            os.remove(tmp_fn)
+            raise
+
+    def update(self):
+        """
+        Scans the tree, rehashing only the files that changed since the last scan, and persists the updated index.
+
+        Returns a dictionary of the form {path: hash}, with paths relative to the base directory.
+        """
+        started = time.time()
+        last_files = self.load()
+        files = {}
+        small_files = []
+        large_files = []
+        for fqfn, st in iter_files(self.base_dir, patterns=self.patterns, ignore=self.ignore):
+            path = os.path.relpath(fqfn, self.base_dir)
+            entry = [st.st_size, st.st_mtime, st.st_ino, None]
+            last = last_files.get(path)
+            if last and last[:3] == entry[:3] and last[3]:
+                entry[3] = last[3]
+            elif st.st_size >= LARGE_FILE_SIZE:
+                large_files.append(path)
+            else:
+                small_files.append(path)
+            files[path] = entry
+
+        if large_files and self.workers > 1:
+            pool = ThreadPool(min(self.workers, len(large_files)))
+            try:
+                hashes = pool.map(get_file_md5, [os.path.join(self.base_dir, path) for path in large_files])
+            finally:
+                pool.close()
+                pool.join()
+            for path, file_hash in zip(large_files, hashes):
+                files[path][3] = file_hash
+        else:
+            small_files.extend(large_files)
+
+        for path in small_files:
+            files[path][3] = get_file_md5(os.path.join(self.base_dir, path))
+
+        # Don't trust the hash of any file that may still be changing within its timestamp's resolution.
+        persisted = {}
+        for path, entry in files.items():
+            if entry[1] >= started - RACY_SECONDS:
+                entry = entry[:3] + [None]
+            persisted[path] = entry
+        self.save(persisted)
+
+        return dict((path, entry[3]) for path, entry in files.items())
+
+    def get_digest(self):
+        """
+        Returns a hash of the contents and relative paths of all files in the tree, independent of scan order.
+        """
+        m = hashlib.md5()
+        for path, file_hash in sorted(self.update().items()):
+            line = '%s  %s\n' % (file_hash, path)
+            if not isinstance(line, bytes):
+                line = line.encode('utf-8')
+            m.update(line)
+        return m.hexdigest()
@@ -12,6 +12,7 @@ from burlap import Satchel
 from burlap.constants import *
 from burlap.decorators import task, task_or_dryrun
 from burlap.common import str_to_callable
+from burlap.facts import invalidate_facts
 
 def iter_hostnames():
     from burlap.common import get_hosts_retriever, get_verbose
@@ -408,6 +409,9 @@ class HostnameSatchel(Satchel):
                 #Deprecated in Ubuntu 15?
                 #r.sudo('service hostname restart; sleep 3')
                 r.sudo('hostname {hostname}')
+                # Ensure the new hostname is used instead of the cached one.
+                invalidate_facts()
+                self.genv.get('_ip_to_hostname', {}).pop(self.genv.host_string, None)
                 r.reboot()#new_hostname=hostname)
 
 class HostsFileSatchel(Satchel):
@@ -467,6 +471,9 @@ class TimezoneSatchel(Satchel):
 
     name = 'timezone'
 
+    # Configuring only runs commands on the host.
+    concurrent_deploy = True
+
     def set_defaults(self):
         self.env.timezone = 'UTC'
 
@@ -29,14 +29,12 @@ class ManifestSatchel(Satchel):
         pprint(ret, indent=4)
 
     @task
-    @runs_once
     def get_current(self, name):
         name = name.strip().lower()
         func = common.manifest_recorder[name]
         return func()
 
     @task
-    @runs_once
     def get_last(self, name):
         from burlap.deploy import deploy as deploy_satchel
         name = common.assert_valid_satchel(name)
@@ -28,6 +28,17 @@ class MongoDBSatchel(DatabaseSatchel):
         self.env.load_command = 'mongorestore --drop --gzip --noIndexRestore --archive={remote_dump_fn}'
         #https://docs.mongodb.com/v3.0/tutorial/build-indexes-in-the-background/
 
+        # Used by dumpload() to stream the database from one host into another.
+        self.env.dump_stream_command = 'mongodump -h {db_host}:{db_port} -v --username={db_user} --password={db_password} --archive'
+        self.env.dump_stream_table_pattern = r'writing (\S+) to'
+        self.env.load_stream_command = 'mongorestore --drop --noIndexRestore --archive'
+
+        # Used by get_size() and loadable().
+        self.env.size_command = 'mongo {db_host}:{db_port}/{db_name} --quiet --username={db_user} --password={db_password} ' \
+            '--eval "var s = db.stats(); print(s.dataSize + s.indexSize);"'
+        self.env.table_sizes_command = 'mongo {db_host}:{db_port}/{db_name} --quiet --username={db_user} --password={db_password} ' \
+            '--eval "db.getCollectionNames().forEach(c => print(c + \'|\' + db[c].stats().size + \'|\' + db[c].stats().totalIndexSize));"'
+
         self.env.db_port = 9001
 
         self.env.watchdog_enabled = False
@@ -103,6 +114,10 @@ class MongoDBSatchel(DatabaseSatchel):
         else:
             raise NotImplementedError
 
+    def prepare_stream_load(self, name=None, site=None):
+        # The load stream command drops each collection before restoring it, so there's nothing to prepare.
+        pass
+
     @task
     @runs_once
     def load(self, dump_fn='', prep_only=0, force_upload=0, from_local=0, name=None, site=None, dest_dir=None):
@@ -137,13 +152,15 @@ class MongoDBSatchel(DatabaseSatchel):
 #                 r.put(
 #                     local_path=r.env.dump_fn,
 #                     remote_path=r.env.remote_dump_fn)
-            r.local('rsync -rvz --progress --no-p --no-g '
-                '--rsh "ssh -o StrictHostKeyChecking=no -i {key_filename}" '
-                '{dump_fn} {user}@{host_string}:{remote_dump_fn}')
+            self.upload_snapshot(name=name, site=site, local_dump_fn=r.env.dump_fn, remote_dump_fn=r.env.remote_dump_fn)
 
         if self.is_local and not prep_only and not self.dryrun:
             assert os.path.isfile(r.env.dump_fn), missing_local_dump_error
 
+        # Check the snapshot wasn't corrupted before the existing collections are dropped.
+        if not prep_only:
+            self.verify_snapshot(r)
+
         r.run_or_local(r.env.load_command)
 
     @task
@@ -58,6 +58,30 @@ class MySQLSatchel(DatabaseSatchel):
         self.env.load_command = 'gunzip < {remote_dump_fn} | mysql -u {db_root_username} ' \
             '--password="{db_root_password}" --host={db_host} -D {db_name}'
 
+        # Used by dumpload() to stream the database from one host into another.
+        self.env.dump_stream_command = 'mysqldump --opt --verbose --max_allowed_packet={max_allowed_packet} ' \
+            '--force --single-transaction --quick --user {db_user} ' \
+            '--password="{db_password}" -h {db_host} {db_name}'
+        self.env.dump_stream_table_pattern = r'Retrieving table structure for table (\S+?)\.\.\.'
+        self.env.load_stream_command = 'mysql -u {db_root_username} --password="{db_root_password}" --host={db_host} -D {db_name}'
+
+        # Used by get_size() and loadable().
+        self.env.size_command = 'mysql --batch --skip-column-names -u {db_user} --password="{db_password}" -h {db_host} ' \
+            '--execute="SELECT COALESCE(SUM(data_length + index_length), 0) FROM information_schema.tables WHERE table_schema = \'{db_name}\';"'
+        self.env.table_sizes_command = 'mysql --batch --skip-column-names -u {db_user} --password="{db_password}" -h {db_host} ' \
+            '--execute="SELECT table_name, data_length, index_length FROM information_schema.tables WHERE table_schema = \'{db_name}\';"'
+
+        # Used by load_table() to query the source as the database's user, and to change the destination as root.
+        self.env.query_command = 'mysql --batch --skip-column-names -u {db_user} --password="{db_password}" -h {db_host} ' \
+            '-D {db_name} --execute="{sql}"'
+        self.env.root_query_command = 'mysql --batch --skip-column-names -u {db_root_username} --password="{db_root_password}" ' \
+            '--host={db_host} -D {db_name} --execute="SET foreign_key_checks = 0; {sql}"'
+        # Chunks are loaded in parallel, so the dump doesn't lock the table or disable its keys itself.
+        self.env.table_dump_command = 'mysqldump --no-create-info --skip-triggers --skip-add-locks --skip-disable-keys ' \
+            '--max_allowed_packet={max_allowed_packet} --single-transaction --quick --user {db_user} --password="{db_password}" -h {db_host} --where="{where}" {db_name} {table}'
+        self.env.table_load_command = 'mysql -u {db_root_username} --password="{db_root_password}" --host={db_host} ' \
+            '--init-command="SET foreign_key_checks = 0, unique_checks = 0" -D {db_name}'
+
         self.env.preload_commands = []
         self.env.character_set = 'utf8'
         self.env.collate = 'utf8_general_ci'
@@ -254,23 +278,16 @@ class MySQLSatchel(DatabaseSatchel):
         else:
             raise NotImplementedError('Unknown method: %s' % method)
 
-    @task
-    def dumpload(self, site=None, role=None):
-        """
-        Dumps and loads a database snapshot simultaneously.
-        Requires that the destination server has direct database access
-        to the source server.
-
-        This is better than a serial dump+load when:
-        1. The network connection is reliable.
-        2. You don't need to save the dump file.
-
-        The benefits of this over a dump+load are:
-        1. Usually runs faster, since the load and dump happen in parallel.
-        2. Usually takes up less disk space since no separate dump file is
-            downloaded.
-        """
-        raise NotImplementedError
+    def get_table_key_sql(self, table):
+        return "SELECT column_name, data_type FROM information_schema.columns " \
+            "WHERE table_schema = DATABASE() AND table_name = '%s' AND column_key = 'PRI'" % table
+
+    def prepare_table_load(self, query, table):
+        # Only MyISAM tables can defer updating their non-unique indexes. InnoDB tables instead skip unique checks while loading.
+        query('TRUNCATE TABLE %s; ALTER TABLE %s DISABLE KEYS' % (table, table))
+
+    def finish_table_load(self, query, table, prepared):
+        query('ALTER TABLE %s ENABLE KEYS; ANALYZE TABLE %s' % (table, table))
 
     @task
     def drop_database(self, name):
@@ -408,6 +425,10 @@ class MySQLSatchel(DatabaseSatchel):
         if self.is_local and not prep_only and not self.dryrun:
             assert os.path.isfile(r.env.dump_fn), missing_local_dump_error
 
+        # Check the snapshot wasn't corrupted before the existing database is dropped.
+        if not prep_only:
+            self.verify_snapshot(r)
+
         if force_host:
             r.env.db_host = force_host
 
@@ -6,6 +6,7 @@ Network
 from fabric.api import hide, run, settings, sudo
 
 from burlap.files import file # pylint: disable=redefined-builtin
+from burlap.facts import get_facts
 
 is_file = file.is_file
 
@@ -14,12 +15,15 @@ def interfaces():
     """
     Get the list of network interfaces. Will return all datalinks on SmartOS.
     """
-    with settings(hide('running', 'stdout')):
-        if is_file('/usr/sbin/dladm'):
-            res = run('/usr/sbin/dladm show-link')
-        else:
-            res = sudo('/sbin/ifconfig -s')
-    return [line.split(' ')[0] for line in res.splitlines()[1:]]
+    facts = get_facts()
+    if 'dladm_links' in facts:
+        res = facts['dladm_links']
+    elif facts.get('ifconfig_links'):
+        res = facts['ifconfig_links']
+    else:
+        # Systems without ifconfig only list their interfaces under sysfs, without a header.
+        return [str(_) for _ in (facts.get('sys_class_net') or '').split()]
+    return [str(line.split(' ')[0]) for line in res.splitlines()[1:]]
 
 
 def address(interface):
@@ -16,6 +16,11 @@ class NTPClientSatchel(ServiceSatchel):
 
     name = 'ntpclient'
 
+    @property
+    def concurrent_deploy(self):
+        # Stopping a disabled service temporarily sets warn_only in the global environment.
+        return bool(self.env.enabled)
+
     @property
     def packager_system_packages(self):
         return {
@@ -12,6 +12,9 @@ class PackagerSatchel(Satchel):
 
     name = 'packager'
 
+    # The manifest only reads settings and local requirement files.
+    concurrent_record_manifest = True
+
     def set_defaults(self):
         self.env.apt_requirments_fn = 'apt-requirements.txt'
         self.env.yum_requirments_fn = 'yum-requirements.txt'
@@ -13,12 +13,16 @@ from fabric.api import cd, hide, sudo, settings#, runs_once
 
 from burlap import Satchel
 from burlap.constants import *
-from burlap.db import DatabaseSatchel
+from burlap.db import DatabaseSatchel, fill_command
 from burlap.decorators import task
 
 POSTGIS = 'postgis'
 POSTGRESQL = 'postgresql'
 
+# Snapshot formats.
+CUSTOM = 'custom'
+DIRECTORY = 'directory'
+
 def _run_as_pg(command):
     """
     Run command as 'postgres' user
@@ -150,6 +154,48 @@ class PostgreSQLSatchel(DatabaseSatchel):
         #self.env.load_command = 'gunzip < {remote_dump_fn} | pg_restore --jobs=8 -U {db_root_username} --format=c --create --dbname={db_name}'
         self.env.load_command = 'gunzip < {remote_dump_fn} | pg_restore -U {db_root_username} --host={db_host} --format=c --create --dbname={db_name}'
 
+        # The snapshot format, either custom, for a single gzipped file, or directory, for a directory of compressed files
+        # that's dumped and restored with parallel jobs.
+        self.env.dump_format = CUSTOM
+
+        # The number of parallel jobs used to dump and restore directory snapshots. Defaults to the number of CPUs on the host.
+        self.env.jobs = None
+
+        self.env.dump_directory_fn_template = '{dump_dest_dir}/db_{db_type}_{SITE}_{ROLE}_{db_name}_$(date +%Y%m%d).dir'
+
+        # pg_dump requires that the directory doesn't exist.
+        self.env.dump_directory_command = 'rm -Rf {dump_fn} && time pg_dump -U {db_user} --no-password --blobs --format=d --jobs={jobs} '\
+            '--schema=public --host={db_host} --file={dump_fn} {db_name}'
+
+        # The sections of directory snapshots restored one after another.
+        # Restoring the post-data section last means indexes and constraints are built after the data is loaded, in parallel.
+        # Set to an empty list to restore everything with a single command.
+        self.env.load_sections = ['pre-data', 'data', 'post-data']
+
+        self.env.load_directory_command = 'pg_restore -U {db_root_username} --host={db_host} --format=d --jobs={jobs} {load_section_option} '\
+            '--dbname={db_name} {remote_dump_fn}'
+
+        # Used by dumpload() to stream the database from one host into another.
+        self.env.dump_stream_command = 'pg_dump -U {db_user} --no-password --blobs --format=c --schema=public --host={db_host} --verbose {db_name}'
+        self.env.dump_stream_table_pattern = r'dumping contents of table "?([^"\s]+)'
+        self.env.load_stream_command = 'sudo -n -u {postgres_user} pg_restore -U {db_root_username} --host={db_host} --format=c --dbname={db_name}'
+
+        # Used by get_size() and loadable().
+        self.env.size_command = 'PGPASSWORD=\'{db_password}\' psql -U {db_user} --no-password --host={db_host} -At ' \
+            '-c "SELECT pg_database_size(\'{db_name}\');" {db_name}'
+        self.env.table_sizes_command = 'PGPASSWORD=\'{db_password}\' psql -U {db_user} --no-password --host={db_host} -At ' \
+            '-c "SELECT c.relname, pg_table_size(c.oid), pg_indexes_size(c.oid) FROM pg_class c ' \
+            'JOIN pg_namespace n ON n.oid = c.relnamespace WHERE c.relkind = \'r\' AND n.nspname = \'public\';" {db_name}'
+
+        # Used by load_table() to query the source as the database's user, and to change the destination as root.
+        self.env.query_command = 'PGPASSWORD=\'{db_password}\' psql -U {db_user} --no-password --host={db_host} -At -c "{sql}" {db_name}'
+        self.env.root_query_command = 'sudo -n -u {postgres_user} psql -U {db_root_username} --host={db_host} -At -c "{sql}" {db_name}'
+        self.env.table_dump_command = 'PGPASSWORD=\'{db_password}\' psql -U {db_user} --no-password --host={db_host} ' \
+            '-c "COPY (SELECT * FROM {table} WHERE {where}) TO STDOUT" {db_name}'
+        # Foreign keys aren't enforced while loading, so tables can be loaded in any order.
+        self.env.table_load_command = 'sudo -n -u {postgres_user} psql -U {db_root_username} --host={db_host} ' \
+            '-v ON_ERROR_STOP=1 -c "SET session_replication_role = replica" -c "COPY {table} FROM STDIN" {db_name}'
+
         self.env.createlangs = ['plpgsql'] # plpythonu
         self.env.postgres_user = 'postgres'
         self.env.encoding = 'UTF8'
@@ -213,6 +259,29 @@ class PostgreSQLSatchel(DatabaseSatchel):
         else:
             raise NotImplementedError
 
+    def is_directory_dump(self, r):
+        return r.env.dump_format == DIRECTORY
+
+    def get_jobs(self, r):
+        """
+        Returns the number of parallel jobs used for directory snapshots, defaulting to the number of CPUs on the current host.
+        """
+        from burlap.system import cpus
+        return int(r.env.jobs or 0) or cpus()
+
+    def get_dump_command(self, r):
+        # A dump command overridden for the site or database is used as given, whatever the snapshot format.
+        if self.is_directory_dump(r) and r.env.dump_command == self.env.dump_command:
+            return fill_command(r.env.dump_directory_command, jobs=str(self.get_jobs(r)))
+        return super(PostgreSQLSatchel, self).get_dump_command(r)
+
+    def get_default_db_fn(self, fn_template=None, dest_dir=None, name=None, site=None):
+        if not fn_template:
+            r = self.database_renderer(name=name, site=site)
+            if self.is_directory_dump(r):
+                fn_template = r.env.dump_directory_fn_template
+        return super(PostgreSQLSatchel, self).get_default_db_fn(fn_template=fn_template, dest_dir=dest_dir, name=name, site=site)
+
     @task
     def write_pgpass(self, name=None, site=None, use_sudo=0, root=0):
         """
@@ -243,28 +312,6 @@ class PostgreSQLSatchel(DatabaseSatchel):
             r.env.pgpass_path,
             use_sudo=use_sudo)
 
-    @task
-    def dumpload(self, site=None, role=None):
-        """
-        Dumps and loads a database snapshot simultaneously.
-        Requires that the destination server has direct database access
-        to the source server.
-
-        This is better than a serial dump+load when:
-        1. The network connection is reliable.
-        2. You don't need to save the dump file.
-
-        The benefits of this over a dump+load are:
-        1. Usually runs faster, since the load and dump happen in parallel.
-        2. Usually takes up less disk space since no separate dump file is
-            downloaded.
-        """
-        r = self.database_renderer(site=site, role=role)
-        r.run('pg_dump -c --host={host_string} --username={db_user} '
-            '--blobs --format=c {db_name} -n public | '
-            'pg_restore -U {db_postgresql_postgres_user} --create '
-            '--dbname={db_name}')
-
     @task
     def drop_views(self, name=None, site=None):
         """
@@ -380,7 +427,7 @@ class PostgreSQLSatchel(DatabaseSatchel):
         r = self.database_renderer(name=name, site=site)
 
         # Render the snapshot filename.
-        r.env.dump_fn = self.get_default_db_fn(fn_template=dump_fn, dest_dir=dest_dir)
+        r.env.dump_fn = self.get_default_db_fn(fn_template=dump_fn, dest_dir=dest_dir, name=name, site=site)
 
         from_local = int(from_local)
 
@@ -398,7 +445,7 @@ class PostgreSQLSatchel(DatabaseSatchel):
 
         if not prep_only and not self.is_local:
             if not self.dryrun:
-                assert os.path.isfile(r.env.dump_fn), missing_local_dump_error
+                assert os.path.exists(r.env.dump_fn), missing_local_dump_error
             #r.pc('Uploading PostgreSQL database snapshot...')
 #                 r.put(
 #                     local_path=r.env.dump_fn,
@@ -409,7 +456,11 @@ class PostgreSQLSatchel(DatabaseSatchel):
             self.upload_snapshot(name=name, site=site, local_dump_fn=r.env.dump_fn, remote_dump_fn=r.env.remote_dump_fn)
 
         if self.is_local and not prep_only and not self.dryrun:
-            assert os.path.isfile(r.env.dump_fn), missing_local_dump_error
+            assert os.path.exists(r.env.dump_fn), missing_local_dump_error
+
+        # Check the snapshot wasn't corrupted before the existing database is dropped.
+        if not prep_only:
+            self.verify_snapshot(r)
 
         if force_host:
             r.env.db_host = force_host
@@ -441,7 +492,16 @@ class PostgreSQLSatchel(DatabaseSatchel):
             r.sudo('createlang -U {db_root_username} --host={db_host} {createlang} {db_name} || true', user=r.env.postgres_user)
 
         if not prep_only:
-            r.sudo(r.env.load_command, user=r.env.postgres_user)
+            if self.is_directory_dump(r):
+                # pg_dump creates the directory readable only by its owner, which is the user that uploaded it,
+                # but it's restored as the postgres user.
+                r.sudo('chown -R {postgres_user} {remote_dump_fn}')
+                load_command = fill_command(r.env.load_directory_command, jobs=str(self.get_jobs(r)))
+                for section in r.env.load_sections or [None]:
+                    r.env.load_section_option = '--section=%s' % section if section else ''
+                    r.sudo(load_command, user=r.env.postgres_user)
+            else:
+                r.sudo(r.env.load_command, user=r.env.postgres_user)
 
     @task
     def shell(self, name='default', site=None, **kwargs):
@@ -493,16 +553,26 @@ class PostgreSQLSatchel(DatabaseSatchel):
         print(v)
         return v
 
-    @task
-    def load_table(self, table_name, src, dst='localhost', name=None, site=None):
-        """
-        Directly transfers a table between two databases.
-        """
-        #TODO: incomplete
-        r = self.database_renderer(name=name, site=site)
-        r.env.table_name = table_name
-        r.run('psql --user={dst_db_user} --host={dst_db_host} --command="DROP TABLE IF EXISTS {table_name} CASCADE;"')
-        r.run('pg_dump -t {table_name} --user={dst_db_user} --host={dst_db_host} | psql --user={src_db_user} --host={src_db_host}')
+    def get_table_key_sql(self, table):
+        return "SELECT a.attname, format_type(a.atttypid, NULL) FROM pg_index i " \
+            "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) " \
+            "WHERE i.indrelid = '%s'::regclass AND i.indisprimary" % table
+
+    def prepare_table_load(self, query, table):
+        # Indexes backing constraints can't be dropped on their own, so only the rest are dropped, and later recreated.
+        indexes = [_.split('|', 1) for _ in query(
+            "SELECT i.indexrelid::regclass, pg_get_indexdef(i.indexrelid) FROM pg_index i "
+            "WHERE i.indrelid = '%s'::regclass AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)" % table
+        ).splitlines() if '|' in _]
+        # TRUNCATE fails on tables referenced by a foreign key, so the rows are deleted without enforcing foreign keys instead.
+        sql = ['SET session_replication_role = replica', 'DELETE FROM %s' % table]
+        if indexes:
+            sql.append('DROP INDEX %s' % ', '.join(index_name for index_name, _ in indexes))
+        query('; '.join(sql))
+        return [index_sql for _, index_sql in indexes]
+
+    def finish_table_load(self, query, table, prepared):
+        query('; '.join(list(prepared or []) + ['ANALYZE %s' % table]))
 
     @task
     def write_pg_hba_conf(self):
@@ -228,6 +228,9 @@ class ServiceManagementSatchel(Satchel):
         """
         for service in self.genv.services:
             service = service.strip().upper()
+            # Forget any configuration changes reported by a previous deployment.
+            if service in common.services:
+                common.services[service].config_changed = None
             funcs = common.service_pre_deployers.get(service)
             if funcs:
                 print('Running pre-deployments for service %s...' % (service,))
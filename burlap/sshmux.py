@@ -0,0 +1,132 @@
+"""
+Shared OpenSSH connections for the rsync and ssh commands burlap runs locally.
+
+Every `rsync --rsh "ssh ..."` or piped `ssh` transfer normally negotiates its own SSH connection, separate from Fabric's.
+Instead, the first transfer to each host starts an OpenSSH ControlMaster, which all later transfers to that host reuse.
+The masters are closed when the run ends.
+"""
+from __future__ import print_function
+
+import os
+import re
+import atexit
+import getpass
+import tempfile
+import threading
+import subprocess
+
+from fabric.api import env
+from fabric.network import normalize
+
+from burlap import Satchel
+from burlap.constants import *
+from burlap.decorators import task
+
+# Used when the sshmux satchel hasn't been loaded, so its settings aren't in the environment.
+DEFAULT_ENABLED = 1
+DEFAULT_PERSIST = 600
+
+# Hosts a master may have been started for during the current run, of the form {host_string: control path}.
+_masters = {}
+_masters_lock = threading.Lock()
+
+# Matches the ssh command passed to rsync, or run directly at the start of a pipeline stage,
+# so the control options can be added after it.
+RSH_PATTERN = re.compile(r'''((?:--rsh[= ]|-e )["']?ssh|(?:^|[|&;]) *ssh)(?= )''')
+
+def is_enabled():
+    return bool(int(env.get('sshmux_enabled', DEFAULT_ENABLED)))
+
+def get_control_dir():
+    """
+    Returns the directory holding the control sockets, creating it if it doesn't exist.
+
+    Sockets are kept outside the project, since their paths are limited to around 100 characters.
+    """
+    control_dir = env.get('sshmux_control_dir') or os.path.join(tempfile.gettempdir(), 'burlap-ssh-%s' % getpass.getuser())
+    if not os.path.isdir(control_dir):
+        try:
+            os.makedirs(control_dir, 0o700)
+        except OSError:
+            if not os.path.isdir(control_dir):
+                raise
+    return control_dir
+
+def get_control_path():
+    # %C is a hash of the local host, remote host, port and user, so each connection gets its own short path.
+    return os.path.join(get_control_dir(), '%C')
+
+def get_control_options(host_string=None):
+    """
+    Returns the ssh options that share a single master connection to the given host, or the current host,
+    or an empty string if multiplexing is disabled.
+
+    The master is started by the first command using these options, and persists in the background until the run ends.
+    """
+    host_string = host_string or env.host_string
+    if not is_enabled() or not host_string or host_string in LOCALHOSTS:
+        return ''
+    control_path = get_control_path()
+    with _masters_lock:
+        if not _masters:
+            atexit.register(close_masters)
+        _masters[host_string] = control_path
+    return '-o ControlMaster=auto -o ControlPath=%s -o ControlPersist=%s' % (
+        control_path, env.get('sshmux_persist', DEFAULT_PERSIST))
+
+def add_control_options(cmd, host_string=None):
+    """
+    Adds the control options to each ssh command used for a transfer in the given shell command.
+    """
+    if 'ControlPath' in cmd or not RSH_PATTERN.search(cmd):
+        return cmd
+    options = get_control_options(host_string)
+    if not options:
+        return cmd
+    return RSH_PATTERN.sub(lambda m: '%s %s' % (m.group(1), options), cmd)
+
+def close_master(host_string, control_path):
+    """
+    Tells the master connection to the given host to exit, if it's still running.
+    """
+    user, host, port = normalize(host_string)
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call(
+            ['ssh', '-O', 'exit', '-o', 'ControlPath=%s' % control_path, '-p', str(port), '%s@%s' % (user, host)],
+            stdout=devnull, stderr=devnull) == 0
+
+def close_masters():
+    """
+    Closes every master connection started during the current run.
+    """
+    with _masters_lock:
+        masters = list(_masters.items())
+        _masters.clear()
+    return [host_string for host_string, control_path in masters if close_master(host_string, control_path)]
+
+class SSHMuxSatchel(Satchel):
+    """
+    Shares one SSH connection per host between the rsync transfers run locally.
+    """
+
+    name = 'sshmux'
+
+    def set_defaults(self):
+        # If true, rsync transfers reuse a master connection to each host.
+        self.env.enabled = DEFAULT_ENABLED
+
+        # The number of seconds an idle master stays open. It's closed when the run ends regardless.
+        self.env.persist = DEFAULT_PERSIST
+
+        # The directory holding the control sockets. Defaults to a user-specific directory under the system's temporary directory.
+        self.env.control_dir = None
+
+    @task
+    def close(self):
+        """
+        Closes the master connections started during the current run.
+        """
+        for host_string in close_masters():
+            self.vprint('Closed master connection to %s.' % host_string)
+
+sshmux = SSHMuxSatchel()
@@ -200,8 +200,14 @@ class SupervisorSatchel(ServiceSatchel):
 
     @task
     def write_configs(self, site=None, upload=1):
+        """
+        Renders supervisord.conf and every service configuration, uploading them unless upload is false.
+
+        Returns true if any uploaded file was changed.
+        """
 
         site = site or ALL
+        changed = False
 
         verbose = self.verbose
 
@@ -227,7 +233,7 @@ class SupervisorSatchel(ServiceSatchel):
                     remote_fn = os.path.join(self.env.conf_dir, conf_name)
                     if int(upload):
                         local_fn = self.write_to_file(conf_content)
-                        self.put_or_dryrun(local_path=local_fn, remote_path=remote_fn, use_sudo=True)
+                        changed = self.put_or_dryrun(local_path=local_fn, remote_path=remote_fn, use_sudo=True).changed or changed
 
                     process_groups.append(os.path.splitext(conf_name)[0])
 
@@ -235,19 +241,23 @@ class SupervisorSatchel(ServiceSatchel):
 
         if int(upload):
             fn = self.render_to_file(self.env.config_template)
-            self.put_or_dryrun(local_path=fn, remote_path=self.env.config_path, use_sudo=True)
+            changed = self.put_or_dryrun(local_path=fn, remote_path=self.env.config_path, use_sudo=True).changed or changed
+
+        return changed
 
     def deploy_services(self, site=None):
         """
         Collects the configurations for all registered services and writes
         the appropriate supervisord.conf file.
+
+        Returns true if supervisord.conf or any service configuration was changed.
         """
 
         verbose = self.verbose
 
         r = self.local_renderer
         if not r.env.manage_configs:
-            return
+            return False
 #
 #         target_sites = self.genv.available_sites_by_host.get(hostname, None)
 
@@ -261,7 +271,7 @@ class SupervisorSatchel(ServiceSatchel):
             r.sudo('rm -Rf /etc/supervisor/conf.d/*')
 
         #TODO:check available_sites_by_host and remove dead?
-        self.write_configs(site=site)
+        changed = self.write_configs(site=site)
         for _site, site_data in self.iter_sites(site=site, renderer=self.render_paths):
             if verbose:
                 print('deploy_services.site:', _site)
@@ -293,9 +303,6 @@ class SupervisorSatchel(ServiceSatchel):
 
         self.env.services_rendered = '\n'.join(supervisor_services)
 
-        fn = self.render_to_file(self.env.config_template)
-        r.put(local_path=fn, remote_path=self.env.config_path, use_sudo=True)
-
         # We use supervisorctl to configure supervisor, but this will throw a uselessly vague
         # error message is supervisor isn't running.
         if not self.is_running():
@@ -305,6 +312,8 @@ class SupervisorSatchel(ServiceSatchel):
             r.env.pg = pg
             r.sudo('supervisorctl add {pg}')
 
+        return changed
+
     @task(precursors=['packager', 'user', 'rabbitmq'])
     def configure(self, **kwargs):
         kwargs.setdefault('site', ALL)
@@ -313,6 +322,6 @@ class SupervisorSatchel(ServiceSatchel):
 #         if not last_manifest or not last_manifest.get('configured'):
 #             configure()
 
-        self.deploy_services(**kwargs)
+        self.config_changed = self.deploy_services(**kwargs)
 
 supervisor = SupervisorSatchel()
@@ -9,6 +9,7 @@ from fabric.api import hide, run, settings
 from burlap.files import file # pylint: disable=redefined-builtin
 from burlap.utils import read_lines, run_as_root
 from burlap.constants import *
+from burlap.facts import get_facts, invalidate_facts
 
 is_file = file.is_file
 
@@ -51,35 +52,35 @@ def distrib_id():
 
     """
 
-    with settings(hide('running', 'stdout')):
-        kernel = (run('uname -s') or '').strip().lower()
-        if kernel == LINUX:
-            # lsb_release works on Ubuntu and Debian >= 6.0
-            # but is not always included in other distros
-            if is_file('/usr/bin/lsb_release'):
-                id_ = run('lsb_release --id --short').strip().lower()
-                if id in ['arch', 'archlinux']:  # old IDs used before lsb-release 1.4-14
-                    id_ = ARCH
-                return id_
-            else:
-                if is_file('/etc/debian_version'):
-                    return DEBIAN
-                elif is_file('/etc/fedora-release'):
-                    return FEDORA
-                elif is_file('/etc/arch-release'):
-                    return ARCH
-                elif is_file('/etc/redhat-release'):
-                    release = run('cat /etc/redhat-release')
-                    if release.startswith('Red Hat Enterprise Linux'):
-                        return REDHAT
-                    elif release.startswith('CentOS'):
-                        return CENTOS
-                    elif release.startswith('Scientific Linux'):
-                        return SLES
-                elif is_file('/etc/gentoo-release'):
-                    return GENTOO
-        elif kernel == SUNOS:
-            return SUNOS
+    facts = get_facts()
+    kernel = (facts.get('kernel') or '').strip().lower()
+    if kernel == LINUX:
+        # lsb_release works on Ubuntu and Debian >= 6.0
+        # but is not always included in other distros
+        if facts.get('lsb_release_bin'):
+            id_ = str(facts.get('lsb_id') or '').strip().lower()
+            if id_ in ['arch', 'archlinux']:  # old IDs used before lsb-release 1.4-14
+                id_ = ARCH
+            return id_
+        else:
+            if facts.get('debian_version'):
+                return DEBIAN
+            elif facts.get('fedora_release'):
+                return FEDORA
+            elif facts.get('arch_release'):
+                return ARCH
+            elif facts.get('redhat_release'):
+                release = facts['redhat_release']
+                if release.startswith('Red Hat Enterprise Linux'):
+                    return REDHAT
+                elif release.startswith('CentOS'):
+                    return CENTOS
+                elif release.startswith('Scientific Linux'):
+                    return SLES
+            elif facts.get('gentoo_release'):
+                return GENTOO
+    elif kernel == SUNOS:
+        return SUNOS
 
 
 def distrib_release():
@@ -94,13 +95,13 @@ def distrib_release():
             print(u"CentOS 6.2 has been released. Please upgrade.")
 
     """
-    with settings(hide('running', 'stdout')):
-        kernel = (run('uname -s') or '').strip().lower()
-        if kernel == LINUX:
-            return run('lsb_release -r --short')
+    facts = get_facts()
+    kernel = (facts.get('kernel') or '').strip().lower()
+    if kernel == LINUX:
+        return str(facts.get('lsb_release') or '')
 
-        elif kernel == SUNOS:
-            return run('uname -v')
+    elif kernel == SUNOS:
+        return str(facts.get('kernel_version') or '')
 
 
 def distrib_codename():
@@ -115,8 +116,7 @@ def distrib_codename():
             print(u"Ubuntu 12.04 LTS detected")
 
     """
-    with settings(hide('running', 'stdout')):
-        return run('lsb_release --codename --short')
+    return str(get_facts().get('lsb_codename') or '')
 
 
 def distrib_desc():
@@ -125,10 +125,10 @@ def distrib_desc():
 
     For example: ``Debian GNU/Linux 6.0.7 (squeeze)``.
     """
-    with settings(hide('running', 'stdout')):
-        if not is_file('/etc/redhat-release'):
-            return run('lsb_release --desc --short')
-        return run('cat /etc/redhat-release')
+    facts = get_facts()
+    if not facts.get('redhat_release'):
+        return str(facts.get('lsb_desc') or '')
+    return str(facts['redhat_release'])
 
 
 def distrib_family():
@@ -167,6 +167,7 @@ def set_hostname(hostname, persist=True):
     run_as_root('hostname %s' % hostname)
     if persist:
         run_as_root('echo %s >/etc/hostname' % hostname)
+    invalidate_facts()
 
 
 def get_sysctl(key):
@@ -250,9 +251,7 @@ def get_arch():
             print(u"Running on a 64-bit Intel/AMD system")
 
     """
-    with settings(hide('running', 'stdout')):
-        arch = run('uname -m')
-        return arch
+    return str(get_facts().get('arch') or '')
 
 
 def cpus():
@@ -266,10 +265,7 @@ def cpus():
         nb_workers = 2 * cpus() + 1
 
     """
-    with settings(hide('running', 'stdout')):
-        res = run('python -c "import multiprocessing; '
-                  'print(multiprocessing.cpu_count())"')
-        return int(res)
+    return int(get_facts()['cpus'])
 
 
 def using_systemd():
@@ -285,7 +281,7 @@ def using_systemd():
             pass
 
     """
-    return run('which systemctl', quiet=True).succeeded
+    return bool(get_facts().get('systemctl'))
 
 
 def time():
@@ -2,6 +2,9 @@ from __future__ import print_function
 
 import os
 import sys
+import atexit
+import shutil
+import tempfile
 import unittest
 from commands import getstatusoutput
 # from pprint import pprint
@@ -10,11 +13,16 @@ from burlap.common import set_state, get_state, clear_state, init_env, default_e
     is_callable
 #from burlap.deploy import init_env as deploy_init_env, delete_plan_data_dir, clear_fs_cache
 
+# Cached facts, templates and indexes are written here instead of into the current directory.
+burlap_data_dir = tempfile.mkdtemp(prefix='burlap_unittests_')
+atexit.register(shutil.rmtree, burlap_data_dir, True)
+
 def clear_runs_once(func):
     if hasattr(func, 'return_value'):
         print('clearing runs_once on %s' % func)
         print('return_value:', func.return_value)
-        print('return_value:', func.wrapped.return_value)
+        if hasattr(func, 'wrapped'):
+            print('return_value:', func.wrapped.return_value)
         print('__dict__:', func.__dict__)
         # Fabric wraps function using a class that passes through get/hasattr
         # so we have to try deleting the attribute on a few levels.
@@ -119,7 +127,7 @@ class TestCase(unittest.TestCase):
         print('setUp: Clearing custom runs_once methods...')
         from burlap.common import runs_once_methods
         for meth in runs_once_methods:
-            clear_runs_once(func)
+            clear_runs_once(meth)
 
         # Ensure all satchels re-push all their local variables back into the global env.
         print('setUp: Clearing satchels...')
@@ -132,6 +140,7 @@ class TestCase(unittest.TestCase):
         # in case we're using burlap to deploy locally.
         deploy_satchel.env.lockfile_path = '/tmp/burlap_unittests/deploy.lock'
         deploy_satchel.env.data_dir = '/tmp/burlap_unittests'
+        env.burlap_data_dir = burlap_data_dir
 
         # Since these tests are automated, if we ever get a prompt, we should immediately fail,
         # because no action should ever be user-interactive.
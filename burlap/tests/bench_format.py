@@ -0,0 +1,52 @@
+"""
+Microbenchmark for common.format(), comparing cold renders, that parse every format string, against cached renders.
+
+Run with:
+
+    python -m burlap.tests.bench_format
+"""
+from __future__ import print_function
+
+import timeit
+
+from burlap import common
+
+LENV = {
+    'application_name': 'someappname',
+    'site': 'sitename',
+    'wsgi_path': '/usr/local/{apache_application_name}/src/wsgi/{apache_site}.wsgi',
+    'web_user': 'www-data',
+    'web_group': 'www-data',
+}
+
+GENV = {
+    'apache_root': '/etc/apache2',
+    'host_string': 'web1',
+}
+
+COMMANDS = [
+    'chown -R {apache_web_user}:{apache_web_group} {apache_root}',
+    'mkdir -p {wsgi_path}',
+    "getent hosts {host_string} | awk '{{ print $1 }}'",
+    'echo "*/5 * * * * {web_user} /usr/bin/check {site} > /dev/null 2>&1"',
+    'rm -f /tmp/static',
+]
+
+def render_all():
+    for cmd in COMMANDS:
+        common.format(cmd, lenv=LENV, genv=GENV, prefix='apache')
+
+def render_all_cold():
+    common.clear_format_cache()
+    render_all()
+
+def main(number=20000):
+    cold = timeit.timeit(render_all_cold, number=number)
+    warm = timeit.timeit(render_all, number=number)
+    print('%i renders of %i commands' % (number, len(COMMANDS)))
+    print('cold: %.3fs (%.1fus per command)' % (cold, cold/number/len(COMMANDS)*1e6))
+    print('cached: %.3fs (%.1fus per command)' % (warm, warm/number/len(COMMANDS)*1e6))
+    print('speedup: %.1fx' % (cold/warm))
+
+if __name__ == '__main__':
+    main()
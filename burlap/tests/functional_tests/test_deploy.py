@@ -175,7 +175,12 @@ class DeployTests(TestCase):
                 deploy_funcs = sorted(deploy_funcs)
                 print('deploy_funcs:', deploy_funcs)
                 assert deploy_funcs == [
-                    ('apache.configure', None),
+                    ('apache.configure_auth_basic', None),
+                    ('apache.configure_media', None),
+                    ('apache.configure_modevasive', None),
+                    ('apache.configure_modrpaf', None),
+                    ('apache.configure_modsecurity', None),
+                    ('apache.configure_sites', None),
                     ('mysql.configure', None),
                     ('mysqlclient.configure', None),
                     ('ntpclient.configure', None),
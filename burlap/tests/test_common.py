@@ -132,6 +132,57 @@ set_by_include3: 'some special setting'
         assert config['overridden_by_local'] == 'hello world'
         assert config['set_by_include3'] == 'some special setting'
 
+    def test_settings_cache(self):
+        import shutil
+        from mock import patch
+        import burlap
+
+        d = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        try:
+            os.makedirs(os.path.join(d, 'roles/all'))
+            os.makedirs(os.path.join(d, 'roles/prod'))
+            open(os.path.join(d, 'roles/all/settings.yaml'), 'w').write('a: 1\nb: 2\n')
+            open(os.path.join(d, 'roles/prod/settings.yaml'), 'w').write('inherits: all\nb: 3\n')
+            os.chdir(d)
+            with patch.object(burlap, '_yaml_files', None):
+                assert load_yaml_settings('prod') == {'a': 1, 'b': 3, 'includes': []}
+                assert os.path.isfile(burlap.SETTINGS_CACHE_FN)
+
+                # Confirm unchanged files aren't parsed again, in this process or the next.
+                with patch('yaml.load') as mock_load:
+                    config = load_yaml_settings('prod')
+                    assert config == {'a': 1, 'b': 3, 'includes': []}
+                    assert load_yaml_settings('all') == {'a': 1, 'b': 2, 'includes': []}
+                    burlap._yaml_files = None
+                    assert load_yaml_settings('prod') == config
+                    assert not mock_load.called
+
+                # Confirm cached settings aren't changed by the configs they're merged into.
+                config['a'] = 4
+                assert load_yaml_settings('all')['a'] == 1
+
+                # Confirm changed files are parsed again.
+                open(os.path.join(d, 'roles/all/settings.yaml'), 'w').write('a: 55\nb: 2\n')
+                assert load_yaml_settings('prod')['a'] == 55
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(d)
+
+    def test_format(self):
+        from burlap.common import format as _format, compile_format
+
+        lenv = {'a': 'A', 'b': '{c}', 'c': 'C'}
+        genv = {'test_d': 'D'}
+        assert _format('{a} {b} {d}', lenv, genv, prefix='test') == 'A C D'
+        assert _format("awk '{{ print $1 }}' {a}", lenv, genv) == "awk '{{ print $1 }}' A"
+        assert _format('{a} {e:>3}', lenv, genv, ignored_variables=['e:>3']) == 'A {e:>3}'
+        assert _format(r'\{a', lenv, genv) == '{a'
+
+        # Confirm format strings are only compiled once.
+        assert compile_format('{a} {b}', prefix='test') is compile_format('{a} {b}', prefix='test')
+        assert compile_format('{a} {b}', prefix='test') is not compile_format('{a} {b}', prefix='other')
+
     def test_renderer(self):
 
         test = self.get_test_satchel()
@@ -186,6 +237,73 @@ set_by_include3: 'some special setting'
         r.env.wsgi_path = '/usr/local/{apache_application_name}/src/wsgi/{apache_site}.wsgi'
         assert r.format(r.env.wsgi_path) == '/usr/local/someappname/src/wsgi/sitename.wsgi'
 
+    def test_indexed_env(self):
+        from fabric.api import settings
+        from burlap.common import IndexedEnv, get_component_settings
+
+        assert isinstance(env, IndexedEnv)
+        env.idx_a = 1
+        env['idx_b'] = 2
+        env.idxother_c = 3
+        assert dict(env.iter_prefixed('idx')) == {'a': 1, 'b': 2}
+
+        # Confirm the index follows every kind of change.
+        env.update({'idx_d': 4}, idx_e=5)
+        env.setdefault('idx_f', 6)
+        del env['idx_a']
+        env.pop('idx_b')
+        with settings(idx_g=7):
+            assert get_component_settings(prefixes=['idx']) == {'d': 4, 'e': 5, 'f': 6, 'g': 7}
+        assert get_component_settings(prefixes=['idx']) == {'d': 4, 'e': 5, 'f': 6}
+
+    def test_env_layers(self):
+        env.layer_a = [1]
+        env.layer_b = 2
+        outer = env.push_layer()
+        env.layer_a = [1, 2]
+        env.layer_c = 3
+        env._layer_cache = 4
+        inner = env.push_layer()
+        env.layer_b = 5
+        del env['layer_c']
+        env.pop_layer(inner)
+        assert (env.layer_a, env.layer_b, env.layer_c) == ([1, 2], 2, 3)
+        env.pop_layer(outer)
+        assert (env.layer_a, env.layer_b) == ([1], 2)
+        assert 'layer_c' not in env
+        # Confirm private variables outlive layers.
+        assert env._layer_cache == 4
+
+        # Confirm layers popped out of order are reverted by the layer above.
+        outer = env.push_layer()
+        env.layer_b = 6
+        inner = env.push_layer()
+        env.pop_layer(outer)
+        assert env.layer_b == 6
+        env.pop_layer(inner)
+        assert env.layer_b == 2
+
+    def test_renderer_dispatch(self):
+        from mock import patch
+
+        test = self.get_test_satchel()
+        r = test.local_renderer
+        r.env.var1 = 'a'
+
+        # Confirm wrapped methods are cached.
+        assert r.run is r.run
+        assert r.vprint is r.vprint
+
+        # Confirm a method replaced on the satchel isn't shadowed by the cache.
+        with patch.object(test, 'run', side_effect=lambda cmd, *args, **kwargs: cmd):
+            assert r.run('echo {var1}') == 'echo a'
+        assert r.run is r.run
+
+        # Confirm the cache is dropped along with the renderer.
+        run = r.run
+        test.clear_local_renderer()
+        assert test.local_renderer.run is not run
+
     def test_iter_sites(self):
 
         test = self.get_test_satchel()
@@ -211,9 +329,12 @@ set_by_include3: 'some special setting'
         site_iter.next()
         print('env.SITE:', env.SITE)
         assert env.SITE == 'site1'
+        assert env.site == 'mysite'
         site_iter.next()
         print('env.SITE:', env.SITE)
         assert env.SITE == 'site2'
+        # Confirm settings from the previous site don't leak into the next one.
+        assert env.get('site') == env0.get('site')
 
     def test_append(self):
 
@@ -234,6 +355,33 @@ set_by_include3: 'some special setting'
         print('content1:', content)
         assert content.count(text) == 1
 
+    def test_put_unchanged(self):
+
+        test = self.get_test_satchel()
+
+        test.genv.host_string = 'localhost'
+
+        _, local_fn = tempfile.mkstemp()
+        _, remote_fn = tempfile.mkstemp()
+        with open(local_fn, 'w') as fout:
+            fout.write('ServerName localhost\n')
+
+        # Confirm only the first upload changes the remote file.
+        ret = test.put(local_path=local_fn, remote_path=remote_fn)
+        assert ret == [remote_fn]
+        assert ret.changed
+        assert open(remote_fn).read() == 'ServerName localhost\n'
+        assert test.prefetch_remote_hashes([remote_fn, '/tmp/missing-burlap-file']).get('/tmp/missing-burlap-file') is None
+        ret = test.put(local_path=local_fn, remote_path=remote_fn)
+        assert ret == [remote_fn]
+        assert not ret.changed
+
+        with open(local_fn, 'w') as fout:
+            fout.write('ServerName example.com\n')
+        assert test.upload_content(content='ServerName example.com\n', fn=remote_fn, use_sudo=False)
+        assert not test.put(local_path=local_fn, remote_path=remote_fn).changed
+        assert test.put(local_path=local_fn, remote_path=remote_fn, check_changed=False).changed
+
     def test_set_verbose(self):
         from burlap.common import set_verbose, get_verbose
 
@@ -315,6 +463,51 @@ set_by_include3: 'some special setting'
             b_satchel.unregister()
             c_satchel.unregister()
 
+    def test_lazy_satchels(self):
+        import shutil
+        import burlap
+        from burlap.common import lazy_satchels, load_satchels
+
+        # Confirm the index describes the tasks of eagerly imported submodules.
+        index = burlap.build_satchel_index({'apache': 'apache'})
+        assert index['satchels']['APACHE'] == 'apache'
+        assert 'configure' in index['namespaces']['apache']['tasks']
+
+        # Confirm placeholder tasks dispatch to the actual task.
+        module = burlap.LazyModule('apache', 'apache', index['namespaces']['apache']['tasks'])
+        assert module.configure.name == 'configure'
+        assert module.configure.load() is sys.modules['apache'].configure
+
+        # Confirm lazily loaded satchels don't override existing settings with their defaults.
+        d = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(d, 'lazypkg'))
+            open(os.path.join(d, 'lazypkg', '__init__.py'), 'w').close()
+            with open(os.path.join(d, 'lazypkg', 'lazysatchel.py'), 'w') as fout:
+                fout.write(
+                    'from burlap import Satchel\n'
+                    'class LazySatchel(Satchel):\n'
+                    '    name = "lazy"\n'
+                    '    def set_defaults(self):\n'
+                    '        self.env.a = 1\n'
+                    '        self.env.b = 2\n'
+                    'lazy = LazySatchel()\n')
+            sys.path.insert(0, d)
+            env.lazy_b = 3
+            lazy_satchels['LAZY'] = 'lazypkg.lazysatchel'
+            load_satchels(['lazy'])
+            assert 'LAZY' not in lazy_satchels
+            assert get_satchel('lazy').env.a == 1
+            assert env.lazy_b == 3
+        finally:
+            sys.path.remove(d)
+            shutil.rmtree(d)
+            lazy_satchels.pop('LAZY', None)
+            if 'LAZY' in all_satchels:
+                get_satchel('lazy').unregister()
+            sys.modules.pop('lazypkg.lazysatchel', None)
+            sys.modules.pop('lazypkg', None)
+
     def test_state_clearing(self):
         from burlap.common import get_state, clear_state, set_state, all_satchels
 
@@ -322,12 +515,12 @@ set_by_include3: 'some special setting'
         print('actual satchels:\n', actual)
         expected = [
             'APACHE', 'AVAHI', 'BLUETOOTH', 'BUILDBOT', 'CELERY', 'CLOUDFRONT', 'CRON',
-            'DEBUG', 'DEPLOY', 'DEPLOYMENTNOTIFIER', 'DJ', 'DNS', 'EC2MONITOR', 'ELASTICSEARCH', 'FILE',
+            'DEBUG', 'DEPLOY', 'DEPLOYMENTNOTIFIER', 'DJ', 'DNS', 'EC2MONITOR', 'ELASTICSEARCH', 'FACTS', 'FILE',
             'GIT', 'GITCHECKER', 'GITTRACKER', 'GPSD', 'GROUP', 'HOST', 'HOSTNAME', 'HOSTSFILE',
             'IP', 'JIRAHELPER', 'JSHINT', 'LOCALES', 'LOGINNOTIFIER', 'MANIFEST', 'MONGODB', 'MOTION', 'MYSQL', 'MYSQLCLIENT', 'NM',
             'NTPCLIENT', 'PACKAGER', 'PHANTOMJS', 'PIP', 'POSTFIX', 'POSTGRESQL', 'POSTGRESQLCLIENT', 'PROJECT',
             'RABBITMQ', 'RPI', 'RSYNC', 'S3', 'SELENIUM', 'SERVICE', 'SNORT', 'SOFTWARERAID',
-            'SSHNICE', 'SSL', 'SUPERVISOR', 'TARBALL', 'TIMEZONE', 'UBUNTUMULTIVERSE',
+            'SSHMUX', 'SSHNICE', 'SSL', 'SUPERVISOR', 'TARBALL', 'TIMEZONE', 'UBUNTUMULTIVERSE',
             'UNATTENDEDUPGRADES', 'USER', 'VAGRANT', 'VIRTUALBOX',
         ]
         print('expected satchels:\n', expected)
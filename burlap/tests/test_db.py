@@ -0,0 +1,123 @@
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+
+from mock import patch
+
+from burlap.common import get_satchel, env
+from burlap.db import get_stream_args, get_stream_script, relay_stream, write_snapshot_manifest, verify_snapshot_manifest, \
+    split_key_range
+from burlap.tests.base import TestCase
+
+class DbTests(TestCase):
+
+    def test_relay_stream(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            dst_fn = os.path.join(tmp_dir, 'loaded')
+            src_args = get_stream_args('localhost', get_stream_script(
+                'for t in users posts; do echo "dumping contents of table $t" >&2; seq 1 50000; done | gzip -1 | tee {fifo}'))
+            dst_args = get_stream_args('localhost', get_stream_script('tee {fifo} | gzip -d > %s' % dst_fn))
+            stats = relay_stream(src_args, dst_args, table_pattern=r'dumping contents of table (\S+)')
+            assert stats['tables'] == ['users', 'posts']
+            assert stats['size'] > 0
+            with open(dst_fn) as fin:
+                assert len(fin.read().splitlines()) == 100000
+
+            # Confirm a failed load is reported.
+            dst_args = get_stream_args('localhost', get_stream_script('tee {fifo} | gzip -d | false'))
+            with self.assertRaises(Exception):
+                relay_stream(src_args, dst_args)
+
+            # Confirm an endless source is stopped, instead of blocking forever, when the load exits early.
+            src_args = get_stream_args('localhost', get_stream_script('cat /dev/zero | tee {fifo}'))
+            dst_args = get_stream_args('localhost', get_stream_script('tee {fifo} | head -c 10000000 > /dev/null; exit 3'))
+            with self.assertRaises(Exception) as cm:
+                relay_stream(src_args, dst_args)
+            assert 'exited early with status 3' in str(cm.exception)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_snapshot_manifest(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            dump_fn = os.path.join(tmp_dir, 'db.dir')
+            os.makedirs(os.path.join(dump_fn, 'blobs'))
+            for name in ('toc.dat', 'blobs/1.dat.gz'):
+                with open(os.path.join(dump_fn, name), 'w') as fout:
+                    fout.write(name)
+            write_snapshot_manifest(dump_fn)
+            with open(dump_fn + '.sha256') as fin:
+                assert sorted(_.split()[1] for _ in fin) == ['db.dir/blobs/1.dat.gz', 'db.dir/toc.dat']
+            assert verify_snapshot_manifest(dump_fn) == []
+
+            with open(os.path.join(dump_fn, 'toc.dat'), 'a') as fout:
+                fout.write('corrupted')
+            assert verify_snapshot_manifest(dump_fn) == ['db.dir/toc.dat']
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_loadable(self):
+        postgresql = get_satchel('postgresql')
+        databases = {'default': {'db_host': 'localhost', 'db_user': 'app', 'db_password': 'secret'}}
+        with patch.dict(env, postgresql_databases=databases):
+            postgresql.clear_caches()
+            r = postgresql.database_renderer()
+        outputs = {
+            ('db1', 'src'): '1000000\nusers|600000|300000\nposts|50000|10000\n',
+            ('db2', 'dst'): '200000\n',
+            ('db2', 'df'): '1200\n',
+        }
+
+        def run_on_host(host_string, command):
+            key = 'df' if command.startswith('df') else ('src' if '&&' in command else 'dst')
+            return outputs[(host_string, key)]
+
+        with patch.object(postgresql, 'get_role_database', side_effect=[('db1', r), ('db2', r)]), \
+        patch('burlap.db.run_on_host', side_effect=run_on_host):
+            # 1228800 free + 200000 existing - 1000000 loaded - 300000 largest index - 300000 snapshot
+            assert not postgresql.loadable('prod', 'dev')
+        with patch.object(postgresql, 'get_role_database', side_effect=[('db1', r), ('db2', r)]), \
+        patch('burlap.db.run_on_host', side_effect=run_on_host):
+            assert postgresql.loadable('prod', 'dev', stream=1)
+
+    def test_split_key_range(self):
+        assert split_key_range(1, 1000000, 4) == [(None, 250001), (250001, 500001), (500001, 750001), (750001, None)]
+        assert split_key_range(1, 1000, 4, min_chunk_size=500) == [(None, 501), (501, None)]
+        assert split_key_range(5, 5, 4, min_chunk_size=100) == [(None, None)]
+
+    def test_load_table(self):
+        postgresql = get_satchel('postgresql')
+        databases = {'default': {'db_host': 'localhost', 'db_user': 'app', 'db_password': 'secret'}}
+        with patch.dict(env, postgresql_databases=databases):
+            postgresql.clear_caches()
+            r = postgresql.database_renderer()
+        queries = []
+
+        def run_on_host(host_string, command):
+            queries.append((host_string, command))
+            if 'indisprimary' in command:
+                return 'id|integer\n'
+            elif 'MIN(id)' in command:
+                return '1|400000\n'
+            elif 'pg_get_indexdef' in command:
+                return 'users_email|CREATE INDEX users_email ON public.users USING btree (email)\n'
+            return ''
+
+        with patch.object(postgresql, 'get_role_database', side_effect=[('db1', r), ('db2', r)]), \
+        patch.object(postgresql, 'get_stream_compression', return_value=('gzip -1', 'gzip -d')), \
+        patch('burlap.db.run_on_host', side_effect=run_on_host), \
+        patch('burlap.db.relay_stream') as mock_relay:
+            postgresql.load_table('users', 'prod', 'dev')
+
+        scripts = sorted(call[0][0][-1] for call in mock_relay.call_args_list)
+        assert len(scripts) == 4
+        assert 'WHERE id >= 100001 AND id < 200001) TO STDOUT' in scripts[1]
+        assert 'WHERE id >= 300001) TO STDOUT' in scripts[3]
+
+        # Confirm the indexes are dropped before the load and recreated afterwards.
+        dst_queries = [command for host_string, command in queries if host_string == 'db2']
+        assert 'SET session_replication_role = replica; DELETE FROM users; DROP INDEX users_email' in dst_queries[1]
+        assert 'CREATE INDEX users_email ON public.users USING btree (email); ANALYZE users' in dst_queries[2]
@@ -0,0 +1,319 @@
+"""
+Tests for the deploy module.
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from mock import patch
+
+from burlap import exceptions
+from burlap.common import env, Satchel, clear_state
+from burlap.decorators import task, runs_once
+from burlap.deploy import deploy as deploy_satchel, HostPrefixedStream
+from burlap.tests.base import TestCase
+
+class DeployTests(TestCase):
+
+    def test_host_prefixed_stream(self):
+        fout = StringIO()
+        stream = HostPrefixedStream(fout, 'web1')
+        print('hello', file=stream)
+        stream.write('a')
+        stream.write('b\n\nc\n')
+        stream.write('[web1] out: already prefixed\n')
+        stream.write(u'caf\xe9\n')
+        assert fout.getvalue() == '[web1] hello\n[web1] ab\n\n[web1] c\n[web1] out: already prefixed\n[web1] caf\xc3\xa9\n'
+
+    def test_execute_parallel(self):
+
+        @runs_once
+        def notify():
+            return 'notified'
+
+        def deploy_host():
+            if env.host_string == 'web2':
+                raise Exception('Deployment failed.')
+            # Confirm tasks that only run once are only run by the first host.
+            return ['APACHE', notify()]
+
+        results = deploy_satchel.execute_parallel(deploy_host, hosts=['web1', 'web2', 'web3'], pool_size=2)
+        print('results:', results)
+        assert results == {
+            'web1': (True, ['APACHE', 'notified']),
+            'web2': (False, 'Deployment failed.'),
+            'web3': (True, ['APACHE', None]),
+        }
+        assert notify() == 'notified'
+
+    def test_get_current_thumbprint(self):
+
+        # Purge any pre-existing satchels from global registeries so we only get results for our custom satchels.
+        clear_state()
+
+        class ASatchel(Satchel):
+            name = 'a'
+            concurrent_record_manifest = True
+            def set_defaults(self):
+                self.env.param = 1
+            def configure(self):
+                pass
+
+        class BSatchel(Satchel):
+            name = 'b'
+            def set_defaults(self):
+                self.env.param = 2
+            def configure(self):
+                pass
+
+        class CSatchel(Satchel):
+            name = 'c'
+            concurrent_record_manifest = True
+            def set_defaults(self):
+                self.env.param = 3
+            def record_manifest(self):
+                raise Exception('Unable to read settings.')
+            def configure(self):
+                pass
+
+        satchels = [ASatchel(), BSatchel(), CSatchel()]
+        try:
+            env.services = ['a', 'b']
+            expected = {
+                'A': {'param': 1, 'enabled': True},
+                'B': {'param': 2, 'enabled': True},
+            }
+            assert deploy_satchel.get_current_thumbprint() == expected
+            assert deploy_satchel.get_current_thumbprint(serial=1) == expected
+
+            # Confirm only recorders that opted in are run on threads.
+            with patch('burlap.deploy.run_concurrently', return_value=[]) as mock_run_concurrently:
+                deploy_satchel.get_current_thumbprint()
+            assert [key for key, _ in mock_run_concurrently.call_args[0][0]] == ['A']
+
+            # Confirm a failing recorder is reported by component.
+            env.services = ['a', 'b', 'c']
+            with self.assertRaises(exceptions.AbortDeployment) as cm:
+                deploy_satchel.get_current_thumbprint()
+            assert 'components: C' in str(cm.exception)
+
+        finally:
+            for satchel in satchels:
+                satchel.unregister()
+
+    def test_concurrent_recorders(self):
+        packager = deploy_satchel.get_satchel('packager')
+        buildbot = deploy_satchel.get_satchel('buildbot')
+        env.services = ['packager', 'buildbot']
+        with patch('burlap.deploy.get_facts') as mock_get_facts, \
+        patch('burlap.deploy.run_concurrently', return_value=[]) as mock_run_concurrently:
+            deploy_satchel.get_current_thumbprint()
+            assert mock_get_facts.called
+            assert [key for key, _ in mock_run_concurrently.call_args[0][0]] == ['BUILDBOT', 'PACKAGER']
+
+            # Confirm they can still be forced to run one at a time.
+            mock_run_concurrently.reset_mock()
+            with patch.dict('burlap.deploy.manifest_recorder', {packager.name: lambda: {}, buildbot.name: lambda: {}}):
+                assert deploy_satchel.get_current_thumbprint(serial=1) == {'PACKAGER': {}, 'BUILDBOT': {}}
+            assert not mock_run_concurrently.called
+
+    def test_plan_levels(self):
+
+        # Purge any pre-existing satchels from global registeries so we only get results for our custom satchels.
+        clear_state()
+
+        deployed = []
+
+        class ASatchel(Satchel):
+            name = 'a'
+            def set_defaults(self):
+                self.env.param = 1
+            @task(precursors=['c'])
+            def configure(self):
+                deployed.append(self.name)
+
+        class BSatchel(Satchel):
+            name = 'b'
+            concurrent_deploy = True
+            def set_defaults(self):
+                self.env.param = 2
+            @task
+            def configure(self):
+                raise Exception('Unable to configure.')
+
+        class CSatchel(Satchel):
+            name = 'c'
+            concurrent_deploy = True
+            def set_defaults(self):
+                self.env.param = 3
+            @task
+            def configure(self):
+                deployed.append(self.name)
+
+        class DSatchel(Satchel):
+            name = 'd'
+            concurrent_deploy = True
+            def set_defaults(self):
+                self.env.param = 4
+            @task
+            def configure(self):
+                deployed.append(self.name)
+
+        satchels = [ASatchel(), BSatchel(), CSatchel(), DSatchel()]
+        try:
+            env.services = ['a', 'b', 'c', 'd']
+            deploy_satchel.env.exclusive_components = ['D']
+            with patch.object(deploy_satchel, 'get_previous_thumbprint', return_value={}):
+                component_order, plan_levels = deploy_satchel.get_plan_levels()
+                assert component_order == ['B', 'C', 'D', 'A']
+                assert [[component for component, _ in level] for level in plan_levels] == [['D'], ['B', 'C'], ['A']]
+
+                # Confirm components that haven't opted in are never deployed alongside another.
+                with patch.object(CSatchel, 'concurrent_deploy', False):
+                    _, exclusive_levels = deploy_satchel.get_plan_levels()
+                    assert [[component for component, _ in level] for level in exclusive_levels] == [['C'], ['D'], ['B'], ['A']]
+
+                _, plan_funcs = deploy_satchel.get_component_funcs()
+                assert [func_name for func_name, _ in plan_funcs] == ['d.configure', 'b.configure', 'c.configure', 'a.configure']
+
+            # Confirm a failing component doesn't stop the rest of its level, but is reported.
+            with self.assertRaises(exceptions.AbortDeployment) as cm, patch.dict(env, deploy_level_workers=2):
+                deploy_satchel.run_plan_level(plan_levels[1])
+            assert 'components: B' in str(cm.exception)
+            assert deployed == ['c']
+
+        finally:
+            for satchel in satchels:
+                satchel.unregister()
+
+    def test_concurrent_deploy(self):
+        # Confirm only the bundled satchels that never modify the global environment opt in.
+        assert deploy_satchel.get_satchel('timezone').concurrent_deploy
+        assert not deploy_satchel.get_satchel('cron').concurrent_deploy
+        ntpclient = deploy_satchel.get_satchel('ntpclient')
+        assert ntpclient.concurrent_deploy
+        with patch.dict(env, ntpclient_enabled=False):
+            assert not ntpclient.concurrent_deploy
+
+    def test_key_scoped_deployers(self):
+
+        # Purge any pre-existing satchels from global registeries so we only get results for our custom satchels.
+        clear_state()
+
+        class ASatchel(Satchel):
+            name = 'a'
+            def set_defaults(self):
+                self.env.site_name = 'example.com'
+                self.env.site_port = 80
+                self.env.media_root = '/media'
+            @task(keys=['site_*', '!site_port'])
+            def configure_sites(self):
+                pass
+            @task(keys=['media_*'])
+            def configure_media(self):
+                pass
+            @task(precursors=['b'])
+            def configure(self):
+                self.configure_sites()
+                self.configure_media()
+
+        class BSatchel(Satchel):
+            name = 'b'
+            def set_defaults(self):
+                self.env.param = 1
+            @task
+            def configure(self):
+                pass
+
+        satchels = [ASatchel(), BSatchel()]
+        try:
+            env.services = ['a', 'b']
+            previous_tp = deploy_satchel.get_current_thumbprint()
+            env.a_site_name = 'example.org'
+            env.a_site_port = 8080
+            env.b_param = 2
+            with patch.object(deploy_satchel, 'get_previous_thumbprint', return_value=previous_tp):
+                component_order, plan_levels = deploy_satchel.get_plan_levels()
+            assert component_order == ['B', 'A']
+            plan = [
+                (func_name, changed_keys)
+                for level in plan_levels
+                for _, component_funcs in level
+                for func_name, _, changed_keys in component_funcs
+            ]
+            assert plan == [('b.configure', None), ('a.configure_sites', ['site_name'])]
+
+        finally:
+            for satchel in satchels:
+                satchel.unregister()
+
+    def test_remote_manifest_cache(self):
+        env.services = []
+
+        if not os.path.isdir(deploy_satchel.env.data_dir):
+            os.makedirs(deploy_satchel.env.data_dir)
+        with open(deploy_satchel.manifest_filename, 'w') as fout:
+            fout.write('DEPLOY: {}\n')
+
+        def _get(remote_path, local_path):
+            local_path.write(open(remote_path).read())
+
+        with patch('burlap.deploy.get', side_effect=_get) as mock_get:
+            assert deploy_satchel.get_previous_thumbprint() == {'DEPLOY': {}}
+            assert deploy_satchel.get_previous_thumbprint(components='deploy') == {'DEPLOY': {}}
+            assert deploy_satchel.get_previous_thumbprint(components='apache') == {}
+            assert mock_get.call_count == 1
+
+            # Confirm clearing caches forces a new download.
+            deploy_satchel.reset_all_satchels()
+            assert deploy_satchel.get_previous_thumbprint() == {'DEPLOY': {}}
+            assert mock_get.call_count == 2
+
+    def test_sharded_manifest(self):
+        env.services = []
+        env.burlap_data_dir = tempfile.mkdtemp()
+        try:
+            deploy_satchel.init()
+
+            # Confirm a legacy manifest is read transparently.
+            with open(deploy_satchel.manifest_filename, 'w') as fout:
+                fout.write('DEPLOY:\n  param: 1\nMANIFEST:\n  param: !!python/tuple [1, 2]\n')
+
+            def _get(remote_path, local_path):
+                local_path.write(open(remote_path, 'rb').read())
+
+            with patch('burlap.deploy.get', side_effect=_get) as mock_get:
+                legacy = deploy_satchel.get_previous_thumbprint()
+                assert legacy == {'DEPLOY': {'param': 1}, 'MANIFEST': {'param': (1, 2)}}
+                assert mock_get.call_count == 1
+
+                # Confirm migrating converts it to an index plus one shard per component, and removes the legacy manifest.
+                deploy_satchel.migrate_manifest()
+                assert not os.path.isfile(deploy_satchel.manifest_filename)
+                assert os.path.isfile(deploy_satchel.manifest_index_filename)
+                assert os.path.isfile(deploy_satchel.manifest_dir + '/DEPLOY.yaml.gz')
+                assert os.path.isfile(deploy_satchel.manifest_dir + '/MANIFEST.yaml.gz')
+
+                # Confirm shards written by us are read from the local cache.
+                assert deploy_satchel.get_previous_thumbprint() == legacy
+                assert mock_get.call_count == 1
+
+                # Confirm only the shards for the requested components are downloaded.
+                shutil.rmtree(deploy_satchel.local_manifest_cache_dir)
+                deploy_satchel.reset_all_satchels()
+                assert deploy_satchel.get_previous_thumbprint(components='manifest') == {'MANIFEST': {'param': (1, 2)}}
+                assert mock_get.call_count == 2
+
+                # Confirm a shard that doesn't match its hash is treated as undeployed.
+                deploy_satchel.reset_all_satchels()
+                with open(deploy_satchel.manifest_index_filename) as fin:
+                    index = fin.read()
+                with open(deploy_satchel.manifest_index_filename, 'w') as fout:
+                    fout.write(index.replace('"DEPLOY": "', '"DEPLOY": "0'))
+                assert deploy_satchel.get_previous_thumbprint() == {'MANIFEST': {'param': (1, 2)}}
+
+        finally:
+            shutil.rmtree(env.burlap_data_dir)
@@ -0,0 +1,65 @@
+from __future__ import print_function
+
+import os
+import shutil
+import socket
+import tempfile
+
+from mock import patch
+
+from burlap import facts
+from burlap.common import env, get_os_version, get_packager
+from burlap.constants import *
+from burlap.system import distrib_id, cpus, using_systemd
+from burlap.network import interfaces
+from burlap.tests.base import TestCase
+
+UBUNTU_FACTS = {
+    'hostname': 'web1',
+    'kernel': 'Linux',
+    'arch': 'x86_64',
+    'cpus': '4',
+    'lsb_release_file': 'DISTRIB_ID=Ubuntu\nDISTRIB_RELEASE=16.04\nDISTRIB_CODENAME=xenial',
+    'debian_version': 'stretch/sid',
+    'lsb_release_bin': '1',
+    'lsb_id': 'Ubuntu',
+    'packagers': 'apt-get',
+    'systemctl': '/bin/systemctl',
+    'ifconfig_links': 'Iface MTU Met RX-OK\neth0 1500 0 100\nlo 65536 0 10',
+    'version': facts.FACTS_VERSION,
+}
+
+class FactsTests(TestCase):
+
+    def test_gather_facts(self):
+        data_dir = tempfile.mkdtemp()
+        try:
+            with patch.dict(env, burlap_data_dir=data_dir, facts_ttl=60):
+                facts.clear_facts()
+                ret = facts.get_facts('localhost')
+                assert ret['hostname'] == socket.gethostname()
+                assert int(ret['cpus']) > 0
+                assert os.path.isfile(facts.get_facts_fn('localhost'))
+
+                # Confirm facts are cached in memory and on disk.
+                with patch('burlap.facts.gather_facts') as mock_gather:
+                    assert facts.get_facts('localhost') is ret
+                    facts.clear_facts()
+                    assert facts.get_facts('localhost') == ret
+                    assert not mock_gather.called
+
+                    # Confirm a refresh ignores both caches.
+                    mock_gather.return_value = dict(ret, hostname='other')
+                    assert facts.get_facts('localhost', refresh=True)['hostname'] == 'other'
+        finally:
+            facts.clear_facts()
+            shutil.rmtree(data_dir)
+
+    def test_helpers(self):
+        with patch('burlap.facts._facts', {env.host_string or 'localhost': UBUNTU_FACTS}):
+            assert get_os_version() == ('linux', UBUNTU, '16.04')
+            assert get_packager() == APT
+            assert distrib_id() == UBUNTU
+            assert cpus() == 4
+            assert using_systemd()
+            assert interfaces() == ['eth0', 'lo']
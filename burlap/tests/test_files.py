@@ -0,0 +1,114 @@
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+from mock import patch
+from fabric.operations import _AttributeString
+
+from burlap import files
+from burlap.common import env, files_exists_or_dryrun
+from burlap.files import file # pylint: disable=redefined-builtin
+from burlap.tests.base import TestCase
+
+def fake_run(cmd, *args, **kwargs):
+    """
+    Runs a command locally, the way Fabric's run() would on a remote host.
+    """
+    proc = subprocess.Popen(['sh', '-c', cmd], stdout=subprocess.PIPE)
+    ret = _AttributeString(proc.communicate()[0].decode('utf-8').rstrip('\n'))
+    ret.failed = proc.returncode != 0
+    ret.succeeded = not ret.failed
+    return ret
+
+class FilesTests(TestCase):
+
+    def test_stat_many(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(tmp_dir, 'a.conf')
+            with open(fn, 'w') as fout:
+                fout.write('hello')
+            link_fn = os.path.join(tmp_dir, 'b.conf')
+            os.symlink(fn, link_fn)
+            missing_fn = os.path.join(tmp_dir, 'missing.conf')
+
+            files.clear_stats()
+            with patch.dict(env, host_string='web1'), \
+            patch('burlap.files._run', side_effect=fake_run) as mock_run, \
+            patch('burlap.common._run', side_effect=fake_run), \
+            patch('burlap.facts.get_fact', return_value='md5sum'):
+                stats = file.stat_many([fn, link_fn, tmp_dir, missing_fn], checksum=True)
+                assert mock_run.call_count == 1
+                assert stats[fn] == files.local_stat(fn, checksum=True)
+                assert stats[fn]['checksum'] == '5d41402abc4b2a76b9719d911017c592'
+                assert stats[fn]['size'] == 5
+                assert stats[link_fn]['type'] == 'file' and stats[link_fn]['link']
+                assert stats[tmp_dir]['type'] == 'dir'
+                assert stats[missing_fn] is None
+
+                # Confirm stats aren't reused outside a cached block, since any command may change them.
+                assert not file.is_file(missing_fn)
+                fake_run('touch %s' % missing_fn)
+                assert file.is_file(missing_fn)
+                assert mock_run.call_count == 3
+                os.remove(missing_fn)
+
+                # Confirm the single-path helpers are answered from the batch looked up by a cached block.
+                mock_run.reset_mock()
+                with file.cached_stats([fn, link_fn, tmp_dir, missing_fn]):
+                    assert file.is_file(fn)
+                    assert file.is_link(link_fn)
+                    assert file.is_dir(tmp_dir)
+                    assert not file.is_file(missing_fn)
+                    assert file.get_mode(fn) == stats[fn]['mode']
+                    assert mock_run.call_count == 1
+
+                    # Confirm writes invalidate the affected paths.
+                    file.copy(fn, missing_fn)
+                    assert file.is_file(missing_fn)
+                    assert mock_run.call_count == 2
+                    file.remove(tmp_dir, recursive=True)
+                    assert not file.is_file(fn)
+                    assert mock_run.call_count == 3
+                assert not files._stats
+
+                # Confirm existence checks report a path as missing, like Fabric's exists(), if its stat can't be parsed.
+                with patch('burlap.files._run', return_value=fake_run('echo garbage')):
+                    assert not files_exists_or_dryrun(link_fn)
+                    with self.assertRaises(SystemExit):
+                        file.stat(link_fn)
+        finally:
+            files.clear_stats()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_watch(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fn1 = os.path.join(tmp_dir, 'a.conf')
+            fn2 = os.path.join(tmp_dir, 'b.conf')
+            with open(fn1, 'w') as fout:
+                fout.write('hello')
+            with patch.dict(env, host_string='web1'), \
+            patch('burlap.files._run', side_effect=fake_run) as mock_run, \
+            patch('burlap.facts.get_fact', return_value='md5sum'):
+                assert file.md5sum(fn1) == '5d41402abc4b2a76b9719d911017c592'
+                assert file.md5sum(fn2) is None
+
+                # Confirm all files are checked with one command on entry and one on exit.
+                mock_run.reset_mock()
+                with files.watch([fn1, fn2]) as config:
+                    pass
+                assert not config.changed
+                assert mock_run.call_count == 2
+
+                callback = []
+                with files.watch([fn1, fn2], callback=lambda: callback.append(1)) as config:
+                    with open(fn2, 'w') as fout:
+                        fout.write('world')
+                assert config.changed
+                assert callback == [1]
+        finally:
+            shutil.rmtree(tmp_dir)
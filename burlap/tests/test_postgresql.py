@@ -0,0 +1,54 @@
+from __future__ import print_function
+
+from mock import patch
+
+from burlap.common import get_satchel, set_dryrun, env
+from burlap.tests.base import TestCase
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+class PostgreSQLTests(TestCase):
+
+    def test_directory_dump(self):
+        postgresql = get_satchel('postgresql')
+        set_dryrun(1)
+        databases = {'default': {'db_host': 'localhost', 'db_user': 'app', 'db_password': 'secret', 'db_type': 'postgresql'}}
+        with patch.dict(env, host_string='db1', user='deploy', key_filename='key.pem', SITE='mysite', ROLE='prod',
+                        postgresql_dump_format='directory', postgresql_databases=databases), \
+        patch('burlap.system.cpus', side_effect=[8, 4]), \
+        patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            postgresql.clear_caches()
+            postgresql.dump(dest_dir='/tmp')
+            postgresql.load(dump_fn='/tmp/db.dir')
+        output = mock_stdout.getvalue()
+        assert 'pg_dump -U app --no-password --blobs --format=d --jobs=8' in output
+        assert 'xargs -0 sha256sum > db_postgresql_mysite_prod_default_' in output
+        assert 'rsync -rv --partial --progress --no-p --no-g --delete --rsh' in output
+        assert '/tmp/db.dir /tmp/db.dir.sha256 deploy@db1:/tmp/' in output
+
+        # Confirm the snapshot is verified before the existing database is dropped.
+        assert output.index('sha256sum --check --quiet db.dir.sha256') < output.index('dropdb')
+
+        # Confirm the uploaded directory is readable by the user that restores it.
+        assert output.index('chown -R postgres /tmp/db.dir') < output.index('--section=pre-data')
+        for section in ('pre-data', 'data', 'post-data'):
+            # The jobs are counted on the loading host, separately from the dumping host.
+            assert '--format=d --jobs=4 --section=%s --dbname=default /tmp/db.dir' % section in output
+
+    def test_directory_dump_site_command(self):
+        postgresql = get_satchel('postgresql')
+        set_dryrun(1)
+        databases = {'default': {'db_host': 'localhost', 'db_user': 'app', 'db_password': 'secret', 'db_type': 'postgresql'}}
+        sites = {'mysite': {'postgresql_dump_command': 'custom_pg_dump > {dump_fn}'}}
+        with patch.dict(env, host_string='db1', user='deploy', key_filename='key.pem', SITE='mysite', ROLE='prod', sites=sites,
+                        postgresql_dump_format='directory', postgresql_databases=databases), \
+        patch('burlap.system.cpus', return_value=8), \
+        patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            postgresql.clear_caches()
+            postgresql.dump(dest_dir='/tmp')
+        output = mock_stdout.getvalue()
+        assert 'custom_pg_dump > ' in output
+        assert '--format=d --jobs=8' not in output
@@ -1,7 +1,7 @@
 from __future__ import print_function
 import os
 import sys
-# import tempfile
+import tempfile
 import shutil # pylint: disable=unused-import
 from commands import getstatusoutput
 
@@ -184,3 +184,33 @@ junk = JunkSatchel()
             ))
         print('ret:', ret)
         assert ret == "[smtp.test.com]:1234 myusername:mypassword"
+
+    def test_render_to_string_cache(self):
+        from mock import patch
+        from burlap.common import env, get_jinja_env, clear_template_cache
+
+        cache_dir = tempfile.mkdtemp()
+        extra = dict(postfix_host='smtp.test.com', postfix_username='myusername', postfix_password='mypassword')
+        try:
+            with patch.dict(env, burlap_data_dir=cache_dir, postfix_port=1234):
+                clear_template_cache()
+                jinja_env = get_jinja_env()
+                ret = render_to_string('postfix/etc_postfix_sasl_sasl_passwd', extra)
+                assert ret == "[smtp.test.com]:1234 myusername:mypassword"
+
+                # Confirm the environment and compiled template are reused.
+                assert get_jinja_env() is jinja_env
+                template = jinja_env.get_template('postfix/etc_postfix_sasl_sasl_passwd')
+                assert jinja_env.get_template('postfix/etc_postfix_sasl_sasl_passwd') is template
+                assert os.listdir(os.path.join(cache_dir, 'jinja'))
+
+                # Confirm lazy lookups render the same thing.
+                assert render_to_string('postfix/etc_postfix_sasl_sasl_passwd', extra, lazy=True) == ret
+
+            # Confirm nothing is written to disk without a data directory.
+            with patch.dict(env, burlap_data_dir=None, postfix_port=1234):
+                assert get_jinja_env().bytecode_cache is None
+                assert render_to_string('postfix/etc_postfix_sasl_sasl_passwd', extra) == ret
+        finally:
+            clear_template_cache()
+            shutil.rmtree(cache_dir)
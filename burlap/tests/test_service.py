@@ -20,3 +20,18 @@ class ServiceTests(TestCase):
             set_dryrun(1)
             print('self.genv.services:', service.genv.services)
             service.post_deploy()
+
+    def test_post_deploy_unchanged(self):
+        service = get_satchel('service')
+        apache = get_satchel('apache')
+        service.genv.services.append(apache.name)
+        with patch.object(apache, 'reload') as mock_reload:
+            apache.config_changed = False
+            service.post_deploy()
+            assert not mock_reload.called
+
+            # Confirm a new deployment forgets the previous result.
+            service.pre_deploy()
+            assert apache.config_changed is None
+            service.post_deploy()
+            assert mock_reload.called
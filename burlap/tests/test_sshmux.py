@@ -0,0 +1,33 @@
+from __future__ import print_function
+
+import tempfile
+import shutil
+
+from mock import patch
+
+from burlap import sshmux
+from burlap.common import env
+from burlap.tests.base import TestCase
+
+class SSHMuxTests(TestCase):
+
+    def test_add_control_options(self):
+        control_dir = tempfile.mkdtemp()
+        try:
+            with patch.dict(env, sshmux_control_dir=control_dir, sshmux_persist=60, host_string='deploy@web1'):
+                with patch('burlap.sshmux._masters', {}), patch('atexit.register') as mock_register:
+                    cmd = sshmux.add_control_options('rsync -rvz --rsh "ssh -i key.pem" src deploy@web1:dst')
+                    assert cmd == (
+                        'rsync -rvz --rsh "ssh -o ControlMaster=auto -o ControlPath=%s/%%C -o ControlPersist=60 -i key.pem" '
+                        'src deploy@web1:dst') % control_dir
+                    assert sshmux._masters == {'deploy@web1': control_dir + '/%C'}
+                    assert mock_register.call_count == 1
+
+                    # Commands without rsync transfers, or that already use a master, are left unchanged.
+                    assert sshmux.add_control_options('ls -la') == 'ls -la'
+                    assert sshmux.add_control_options(cmd) == cmd
+
+                with patch.dict(env, sshmux_enabled=0):
+                    assert sshmux.add_control_options('rsync -e ssh src dst') == 'rsync -e ssh src dst'
+        finally:
+            shutil.rmtree(control_dir)
@@ -0,0 +1,97 @@
+from __future__ import print_function
+
+import os
+import time
+import shutil
+import tempfile
+
+from mock import patch
+
+from burlap.common import get_last_modified_timestamp, reset_all_satchels, Satchel
+from burlap.trackers import BaseTracker, FilesystemTracker, SettingsTracker
+from burlap.tests.base import TestCase
+
+class TrackerTests(TestCase):
+
+    def test_filesystem_tracker(self):
+        base_dir = tempfile.mkdtemp()
+        index_dir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(base_dir, 'a/b'))
+            for fn, content in [('a/one.py', '1'), ('a/b/two.py', '2'), ('a/b/three.txt', '3')]:
+                with open(os.path.join(base_dir, fn), 'w') as fout:
+                    fout.write(content)
+                # Backdate the files so their hashes can be reused by the next scan.
+                os.utime(os.path.join(base_dir, fn), (time.time() - 60, time.time() - 60))
+
+            with patch('burlap.fsindex.env', {'burlap_data_dir': index_dir}):
+                tracker = FilesystemTracker(base_dir=base_dir, extensions='*.py')
+                thumbprint = tracker.get_thumbprint()
+                assert thumbprint == FilesystemTracker(base_dir=base_dir, extensions='*.py').get_thumbprint()
+
+                # Confirm unchanged files aren't rehashed.
+                with patch('burlap.fsindex.get_file_md5') as mock_md5:
+                    assert tracker.get_thumbprint() == thumbprint
+                    assert not mock_md5.called
+
+                # Confirm ignored extensions don't affect the thumbprint.
+                with open(os.path.join(base_dir, 'a/b/three.txt'), 'w') as fout:
+                    fout.write('33')
+                assert tracker.get_thumbprint() == thumbprint
+
+                # Confirm only the changed file is rehashed.
+                with open(os.path.join(base_dir, 'a/b/two.py'), 'w') as fout:
+                    fout.write('22')
+                with patch('burlap.fsindex.get_file_md5', return_value='0') as mock_md5:
+                    assert tracker.get_thumbprint() != thumbprint
+                    mock_md5.assert_called_once_with(os.path.join(base_dir, 'a/b/two.py'))
+
+            assert get_last_modified_timestamp(base_dir, ignore=['*.py']) == round(os.stat(os.path.join(base_dir, 'a/b/three.txt')).st_mtime, 2)
+            assert get_last_modified_timestamp(os.path.join(base_dir, 'missing')) is None
+
+        finally:
+            shutil.rmtree(base_dir)
+            shutil.rmtree(index_dir)
+
+    def test_thumbprint_memo(self):
+        calls = []
+
+        class CountingTracker(BaseTracker):
+            memoize_thumbprint = True
+            def natural_key(self):
+                return ('counting',)
+            def get_thumbprint(self):
+                calls.append(1)
+                return len(calls)
+
+        class MySatchel(Satchel):
+            name = 'counting'
+            def set_defaults(self):
+                pass
+            def get_trackers(self):
+                return [CountingTracker(action=lambda: None, modifies_inputs=True)]
+
+        satchel = MySatchel()
+        key = '_tracker_%s' % CountingTracker().get_natural_key_hash()
+        try:
+            with patch.object(MySatchel, 'last_manifest', {key: 0}):
+                assert satchel.has_changes
+                satchel.configure()
+                assert calls == [1]
+
+                # Confirm an action that modifies its inputs forces the thumbprint to be recalculated.
+                assert satchel.record_manifest()[key] == 2
+
+                # Confirm the thumbprint is cached until the next run.
+                assert satchel.record_manifest()[key] == 2
+                reset_all_satchels()
+                assert CountingTracker().get_current_thumbprint() == 3
+
+                # Confirm settings are never memoized, so changes made during the run are seen.
+                satchel.env.value = 1
+                tracker = SettingsTracker(satchel, 'value')
+                assert tracker.get_current_thumbprint() == {'value': 1}
+                satchel.env.value = 2
+                assert tracker.get_current_thumbprint() == {'value': 2}
+        finally:
+            satchel.unregister()
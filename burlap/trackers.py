@@ -4,14 +4,39 @@ import os
 import hashlib
 import pickle
 from copy import deepcopy
-from commands import getoutput
+
+from fabric.api import env
+
+from burlap.fsindex import FileIndex
+
+# Thumbprints calculated during the current run, of the form {(host_string, natural key hash): thumbprint}.
+_thumbprints = {}
+
+# Hashes of natural keys, of the form {natural key: hash}.
+_natural_key_hashes = {}
+
+def clear_thumbprints():
+    """
+    Forgets all thumbprints calculated during the current run.
+    """
+    _thumbprints.clear()
 
 class BaseTracker(object):
 
-    def __init__(self, action=None):
+    # If true, the thumbprint is calculated at most once per run and host, because doing so scans the filesystem or network.
+    # Trackers that only read settings are always recalculated, so changes made during the run are seen.
+    memoize_thumbprint = False
+
+    def __init__(self, action=None, modifies_inputs=False):
+        """
+        action = The callable run when a change is detected.
+        modifies_inputs = If true, the action changes what this tracker tracks,
+            so its thumbprint is recalculated after the action runs.
+        """
         if action:
             assert callable(action), 'Action %s is not callable.' % action
         self.action = action
+        self.modifies_inputs = modifies_inputs
 
     def natural_key(self):
         """
@@ -20,9 +45,20 @@ class BaseTracker(object):
         raise NotImplementedError
 
     def get_natural_key_hash(self):
+        natural_key = self.natural_key()
+        try:
+            return _natural_key_hashes[natural_key]
+        except (KeyError, TypeError):
+            pass
         m = hashlib.md5()
-        m.update(pickle.dumps(self.natural_key()))
-        return m.digest()
+        m.update(pickle.dumps(natural_key))
+        key_hash = m.digest()
+        try:
+            _natural_key_hashes[natural_key] = key_hash
+        except TypeError:
+            # Unhashable keys can't be cached.
+            pass
+        return key_hash
 
     def get_thumbprint(self):
         """
@@ -30,8 +66,25 @@ class BaseTracker(object):
         """
         raise NotImplementedError
 
+    def get_current_thumbprint(self):
+        """
+        Returns the thumbprint of the item being tracked, calculating it at most once per run and host if it's memoized.
+        """
+        if not self.memoize_thumbprint:
+            return self.get_thumbprint()
+        key = (env.host_string, self.get_natural_key_hash())
+        if key not in _thumbprints:
+            _thumbprints[key] = self.get_thumbprint()
+        return _thumbprints[key]
+
+    def invalidate(self):
+        """
+        Forgets the current thumbprint, so it's recalculated the next time it's needed.
+        """
+        _thumbprints.pop((env.host_string, self.get_natural_key_hash()), None)
+
     def is_changed(self, last_thumbprint):
-        current_thumbprint = self.get_thumbprint()
+        current_thumbprint = self.get_current_thumbprint()
         #print('is_changed.tracker:', self)
         #print('is_changed.last_thumbprint:', last_thumbprint)
         #print('is_changed.current_thumbprint:', current_thumbprint)
@@ -43,6 +96,8 @@ class BaseTracker(object):
         """
         if self.action:
             self.action()
+            if self.modifies_inputs:
+                self.invalidate()
 
 class FilesystemTracker(BaseTracker):
     """
@@ -52,9 +107,14 @@ class FilesystemTracker(BaseTracker):
 
         base_dir = The absolute or relative local directory to search.
         extensions = A space delimited list of extension patterns to limit the search.
-            These patterns are feed directly to the `find` command.
+            These patterns are matched against file names like the `find -name` command.
+
+    Files are hashed incrementally, using an index persisted under the burlap data directory,
+    so only files changed since the last scan are rehashed.
     """
 
+    memoize_thumbprint = True
+
     def __init__(self, base_dir='.', extensions='*.*', *args, **kwargs):
         assert os.path.isdir(base_dir), 'Directory %s does not exist.' % base_dir
         extensions = extensions.strip()
@@ -73,10 +133,7 @@ class FilesystemTracker(BaseTracker):
         """
         Calculates the current thumbprint of the item being tracked.
         """
-        extensions = self.extensions.split(' ')
-        name_str = ' -or '.join('-name "%s"' % ext for ext in extensions)
-        cmd = 'find ' + self.base_dir + r' -type f \( ' + name_str + r' \) -exec md5sum {} \; | sort -k 2 | md5sum'
-        return getoutput(cmd)
+        return FileIndex(self.base_dir, patterns=self.extensions.split()).get_digest()
 
 class SettingsTracker(BaseTracker):
     """
@@ -148,5 +205,10 @@ class ORTracker(BaseTracker):
         """
         d = {}
         for tracker in self.trackers:
-            d[type(tracker).__name__] = tracker.get_thumbprint()
+            d[type(tracker).__name__] = tracker.get_current_thumbprint()
         return d
+
+    def invalidate(self):
+        super(ORTracker, self).invalidate()
+        for tracker in self.trackers:
+            tracker.invalidate()
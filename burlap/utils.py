@@ -81,14 +81,14 @@ def oct(v, **kwargs): # pylint: disable=redefined-builtin
     return eval('_oct(%s, **kwargs)' % v) # pylint: disable=eval-used
 
 
-def get_file_hash(fin, block_size=2**20):
+def get_file_hash(fin, block_size=2**20, hash_name='sha512'):
     """
     Iteratively builds a file hash without loading the entire file into memory.
     Designed to process an arbitrary binary file.
     """
     if isinstance(fin, basestring):
-        fin = open(fin)
-    h = hashlib.sha512()
+        fin = open(fin, 'rb')
+    h = hashlib.new(hash_name)
     while True:
         data = fin.read(block_size)
         if not data: